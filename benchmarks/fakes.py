@@ -0,0 +1,265 @@
+"""
+压测用的本地假服务 - Telegram Bot API、Spotify API 和 yt-dlp
+不访问网络，记录机器人发出的所有请求
+"""
+import asyncio
+import hashlib
+import json
+import re
+import time
+import uuid
+from collections import defaultdict, deque
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+from aiohttp import web
+
+
+class FakeTelegramServer:
+    """假的Bot API服务器
+
+    实现机器人用到的方法（getMe、sendMessage、editMessageText、sendAudio、answerInlineQuery等），
+    记录每次调用，并让压测脚本等待某个聊天（或某个内联查询）中出现符合条件的调用。
+    flood_limit 大于0时模拟Telegram的限流：同一聊天1秒内超过 flood_limit 次请求时返回429和retry_after。
+    """
+
+    BOT_ID = 100000
+
+    def __init__(self, latency: float = 0.0, upload_latency: float = 0.0, flood_limit: int = 0):
+        self.latency = latency
+        self.upload_latency = upload_latency
+        self.flood_limit = flood_limit
+        self.flood_errors = 0
+        self.calls: Dict[str, int] = defaultdict(int)
+        self._recent: Dict[int, deque] = defaultdict(deque)  # {chat_id: 最近1秒内的请求时间}
+        self._message_ids: Dict[int, int] = defaultdict(int)
+        self._waiters: Dict[int, List] = defaultdict(list)  # {chat_id: [(条件, future)]}
+
+    def routes(self) -> List[web.RouteDef]:
+        return [web.post(r'/bot{token}/{method}', self._handle)]
+
+    def wait_for(self, chat_id, predicate: Callable[[str, Dict], bool]) -> asyncio.Future:
+        """
+        等待聊天中出现满足条件的调用，必须在发送触发更新之前调用
+
+        chat_id 为 ('inline', 查询ID) 时等待对内联查询的回答
+
+        Returns:
+            结果为 (方法名, 返回的Message) 的future
+        """
+        future = asyncio.get_running_loop().create_future()
+        self._waiters[chat_id].append((predicate, future))
+        return future
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        method = request.match_info['method']
+        params = dict(await request.post())
+        self.calls[method] += 1
+
+        chat_id = params.get('chat_id')
+        if self.flood_limit and chat_id is not None and self._flooded(int(chat_id)):
+            self.flood_errors += 1
+            return web.json_response({
+                'ok': False, 'error_code': 429, 'description': 'Too Many Requests: retry after 1',
+                'parameters': {'retry_after': 1},
+            }, status=429)
+
+        if method == 'sendAudio':
+            # 上传文件时读取完整内容，模拟上传耗时
+            audio = params.get('audio')
+            if hasattr(audio, 'file'):
+                audio.file.read()
+                if self.upload_latency:
+                    await asyncio.sleep(self.upload_latency)
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        result = self._result(method, params)
+        if chat_id is not None:
+            self._notify(int(chat_id), method, params, result)
+        elif method == 'answerInlineQuery':
+            self._notify(('inline', params['inline_query_id']), method, params, result)
+
+        return web.json_response({'ok': True, 'result': result})
+
+    def _flooded(self, chat_id: int) -> bool:
+        now = time.monotonic()
+        recent = self._recent[chat_id]
+        while recent and now - recent[0] >= 1:
+            recent.popleft()
+        if len(recent) >= self.flood_limit:
+            return True
+        recent.append(now)
+        return False
+
+    def _result(self, method: str, params: Dict):
+        if method == 'getMe':
+            return {
+                'id': self.BOT_ID, 'is_bot': True, 'first_name': 'Bench', 'username': 'bench_bot',
+                'can_join_groups': True, 'can_read_all_group_messages': False, 'supports_inline_queries': True,
+            }
+
+        if method in ('sendMessage', 'editMessageText', 'sendAudio'):
+            chat_id = int(params['chat_id'])
+            if method == 'editMessageText':
+                message_id = int(params['message_id'])
+            else:
+                self._message_ids[chat_id] += 1
+                message_id = self._message_ids[chat_id]
+
+            message = {
+                'message_id': message_id,
+                'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private'},
+                'from': {'id': self.BOT_ID, 'is_bot': True, 'first_name': 'Bench'},
+            }
+            if 'text' in params:
+                message['text'] = params['text']
+            if 'reply_markup' in params:
+                message['reply_markup'] = json.loads(params['reply_markup'])
+            if method == 'sendAudio':
+                audio = params.get('audio')
+                file_id = audio if isinstance(audio, str) else f"fake-{uuid.uuid4().hex}"
+                message['audio'] = {
+                    'file_id': file_id,
+                    'file_unique_id': hashlib.md5(file_id.encode()).hexdigest()[:16],
+                    'duration': int(params.get('duration') or 0),
+                }
+            return message
+
+        return True
+
+    def _notify(self, chat_id, method: str, params: Dict, result):
+        waiters = self._waiters.get(chat_id)
+        if not waiters:
+            return
+
+        for item in list(waiters):
+            predicate, future = item
+            if future.done():
+                waiters.remove(item)
+            elif predicate(method, params):
+                future.set_result((method, result))
+                waiters.remove(item)
+
+
+class FakeSpotifyAPI:
+    """假的Spotify令牌和搜索接口，结果由关键词确定性生成"""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls = 0
+
+    def routes(self) -> List[web.RouteDef]:
+        return [
+            web.post('/spotify/api/token', self._token),
+            web.get('/spotify/v1/search', self._search),
+        ]
+
+    async def _token(self, request: web.Request) -> web.Response:
+        return web.json_response({'access_token': 'fake', 'token_type': 'Bearer', 'expires_in': 3600})
+
+    async def _search(self, request: web.Request) -> web.Response:
+        self.calls += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        query = request.query.get('q', '')
+        limit = int(request.query.get('limit', 5))
+        items = []
+        for idx in range(limit):
+            track_id = hashlib.md5(f"{query}|{idx}".encode()).hexdigest()[:22]
+            items.append({
+                'id': track_id,
+                'name': f"{query} #{idx}",
+                'artists': [{'name': f"Artist {idx}"}],
+                'album': {'name': f"Album {idx}", 'images': []},
+                'duration_ms': 180000 + idx * 1000,
+                'popularity': 50,
+                'preview_url': None,
+                'external_urls': {'spotify': f"https://open.spotify.com/track/{track_id}"},
+            })
+        return web.json_response({'tracks': {'items': items}})
+
+
+class FakeYoutubeDL:
+    """替代 yt_dlp.YoutubeDL 的假实现
+
+    ytsearchN: 返回确定性的搜索结果；下载时写出指定大小的合成音频文件，
+    分几次调用下载进度回调，并像FFmpegExtractAudio一样调用后处理回调。耗时用 time.sleep 模拟，和真实下载一样占用线程。
+    """
+
+    search_latency = 0.2
+    download_latency = 0.5
+    transcode_latency = 0.1
+    audio_bytes = 256 * 1024
+    instances = 0
+
+    def __init__(self, params: Optional[Dict] = None):
+        params = dict(params or {})
+        outtmpl = params.get('outtmpl', '%(title)s.%(ext)s')
+        params['outtmpl'] = {'default': outtmpl} if isinstance(outtmpl, str) else dict(outtmpl)
+        self.params = params
+        FakeYoutubeDL.instances += 1
+
+    def extract_info(self, url: str, download: bool = True) -> Dict:
+        match = re.match(r'ytsearch(\d*):(.*)', url)
+        if match:
+            time.sleep(self.search_latency)
+            limit = int(match.group(1) or 1)
+            return {'entries': [self._entry(match.group(2), idx) for idx in range(limit)]}
+
+        video_id = url.rsplit('=', 1)[-1].rsplit('/', 1)[-1]
+        info = {'id': video_id, 'title': f"Video {video_id}", 'ext': 'webm'}
+        if download:
+            self._download(info)
+        return info
+
+    def prepare_filename(self, info: Dict) -> str:
+        return (
+            self.params['outtmpl']['default']
+            .replace('%(title)s', info['title'])
+            .replace('%(id)s', info['id'])
+            .replace('%(ext)s', info['ext'])
+        )
+
+    def close(self):
+        pass
+
+    def _entry(self, query: str, idx: int) -> Dict:
+        video_id = hashlib.md5(f"{query}|{idx}".encode()).hexdigest()[:11]
+        return {
+            'id': video_id,
+            'title': f"{query} #{idx}",
+            'uploader': f"Artist {idx} - Topic",
+            'url': f"https://www.youtube.com/watch?v={video_id}",
+            'duration': 180 + idx,
+            'view_count': 1000 * (idx + 1),
+        }
+
+    def _download(self, info: Dict):
+        steps = 5
+        for step in range(1, steps + 1):
+            time.sleep(self.download_latency / steps)
+            downloaded = self.audio_bytes * step // steps
+            for hook in self.params.get('progress_hooks') or []:
+                hook({
+                    'status': 'downloading' if step < steps else 'finished',
+                    'downloaded_bytes': downloaded,
+                    'total_bytes': self.audio_bytes,
+                    'speed': downloaded / (self.download_latency * step / steps or 1),
+                    'info_dict': info,
+                })
+        source = Path(self.prepare_filename(info))
+        source.write_bytes(b'\0' * self.audio_bytes)
+
+        postprocessors = self.params.get('postprocessors') or []
+        if not postprocessors:
+            return
+
+        hooks = self.params.get('postprocessor_hooks') or []
+        for hook in hooks:
+            hook({'status': 'started', 'postprocessor': 'ExtractAudio', 'info_dict': info})
+        time.sleep(self.transcode_latency)
+        source.replace(source.with_suffix(f".{postprocessors[0]['preferredcodec']}"))
+        for hook in hooks:
+            hook({'status': 'finished', 'postprocessor': 'ExtractAudio', 'info_dict': info})
@@ -0,0 +1,260 @@
+"""
+下载历史翻页基准 - 在大表上测量游标翻页的查询计划和延迟
+
+生成 --rows 条下载历史（分布在 --users 个用户中，另有一个记录特别多的用户），
+用与 MusicBot._load_history_page 相同的查询读取最新一页、深处的较早/较新页和关键词筛选，
+输出每种查询的 EXPLAIN QUERY PLAN 和延迟分位数，并和同样深度的 OFFSET 翻页对比。
+之后在同一张表上通过机器人使用的引擎配置（WAL、synchronous=NORMAL、连接池）和
+WriteBehindQueue.flush 批量写入新记录，测量单条和整批写入的延迟。
+--index 可以换成旧的单列索引或不建索引，比较复合索引 (user_id, downloaded_at DESC, id DESC) 的效果。
+不需要网络，在仓库根目录运行：
+
+    python -m benchmarks.history_pagination --rows 1000000
+    python -m benchmarks.history_pagination --rows 1000000 --index user_id
+"""
+import argparse
+import asyncio
+import os
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Callable, Dict, List
+
+HEAVY_USER = 1  # 记录特别多的用户
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='下载历史翻页基准')
+    parser.add_argument('--rows', type=int, default=1_000_000, help='下载历史总记录数')
+    parser.add_argument('--users', type=int, default=2000, help='用户数')
+    parser.add_argument('--heavy-rows', type=int, default=100_000, help='其中一个用户的记录数')
+    parser.add_argument('--depth', type=int, default=5000, help='深处翻页的页码')
+    parser.add_argument('--queries', type=int, default=200, help='每种查询执行的次数')
+    parser.add_argument('--flushes', type=int, default=100, help='每种写入测量的批量写入次数')
+    parser.add_argument('--index', choices=['composite', 'user_id', 'none'], default='composite',
+                        help='composite: 当前的复合索引；user_id: 旧的单列索引；none: 不建索引')
+    parser.add_argument('--page-size', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=1)
+    return parser.parse_args(argv)
+
+
+def populate(db_path: Path, args):
+    """准备数据：用sqlite3直接批量写入，比逐条经过ORM快得多（不是机器人的写入方式，写入延迟另外测量）"""
+    rng = random.Random(args.seed)
+    start = datetime(2024, 1, 1)
+    span = 365 * 24 * 3600
+
+    def rows():
+        for idx in range(args.rows):
+            user_id = HEAVY_USER if idx < args.heavy_rows else rng.randint(2, args.users + 1)
+            # 时间取整到秒，同一用户偶尔会有相同时间的记录，需要id区分先后
+            downloaded_at = start + timedelta(seconds=rng.randrange(span))
+            yield (
+                user_id, f"Song {idx} {rng.choice(['love', 'night', 'rain', 'summer', 'road'])}",
+                f"Artist {rng.randrange(5000)}", 'youtube', None, 200, 4_000_000,
+                downloaded_at.strftime('%Y-%m-%d %H:%M:%S.%f')
+            )
+
+    conn = sqlite3.connect(db_path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=OFF")
+    conn.executemany(
+        "INSERT INTO download_history (user_id, song_title, artist, source, source_url, duration, file_size, "
+        "downloaded_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+        rows()
+    )
+    conn.commit()
+
+    if args.index != 'composite':
+        conn.execute("DROP INDEX ix_download_history_user_time_id")
+    if args.index == 'user_id':
+        conn.execute("CREATE INDEX ix_download_history_user_id ON download_history (user_id)")
+    conn.execute("ANALYZE")
+    conn.commit()
+    conn.close()
+
+
+def history_page_stmt(user_id: int, page_size: int, keyword=None, cursor=None, newer=False):
+    """与 MusicBot._load_history_page 相同的查询"""
+    from sqlalchemy import or_, select, tuple_
+    from database import DownloadHistory
+
+    position = tuple_(DownloadHistory.downloaded_at, DownloadHistory.id)
+    stmt = select(DownloadHistory).where(DownloadHistory.user_id == user_id)
+    if keyword:
+        escaped = keyword.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        pattern = f"%{escaped}%"
+        stmt = stmt.where(or_(
+            DownloadHistory.song_title.ilike(pattern, escape='\\'),
+            DownloadHistory.artist.ilike(pattern, escape='\\')
+        ))
+
+    if newer:
+        stmt = stmt.where(position > tuple_(*cursor)).order_by(
+            DownloadHistory.downloaded_at.asc(), DownloadHistory.id.asc()
+        )
+    else:
+        if cursor:
+            stmt = stmt.where(position < tuple_(*cursor))
+        stmt = stmt.order_by(DownloadHistory.downloaded_at.desc(), DownloadHistory.id.desc())
+    return stmt.limit(page_size + 1)
+
+
+def offset_page_stmt(user_id: int, page_size: int, page: int):
+    """对比用的OFFSET翻页"""
+    from sqlalchemy import select
+    from database import DownloadHistory
+
+    return (
+        select(DownloadHistory)
+        .where(DownloadHistory.user_id == user_id)
+        .order_by(DownloadHistory.downloaded_at.desc(), DownloadHistory.id.desc())
+        .offset(page * page_size)
+        .limit(page_size + 1)
+    )
+
+
+async def explain(session, stmt) -> List[str]:
+    """EXPLAIN QUERY PLAN 的每一步"""
+    from sqlalchemy import text
+    from sqlalchemy.dialects import sqlite
+
+    compiled = stmt.compile(dialect=sqlite.dialect(paramstyle='named'))
+    result = await session.execute(text(f"EXPLAIN QUERY PLAN {compiled}"), compiled.params)
+    return [row[-1] for row in result]
+
+
+async def measure(session_factory, make_stmt: Callable[[], object], queries: int) -> Dict:
+    durations = []
+    for _ in range(queries):
+        stmt = make_stmt()
+        start = time.perf_counter()
+        async with session_factory() as session:
+            result = await session.execute(stmt)
+            list(result.scalars())
+        durations.append(time.perf_counter() - start)
+
+    durations.sort()
+    return {
+        'p50': durations[len(durations) // 2],
+        'p99': durations[min(len(durations) - 1, int(len(durations) * 0.99))],
+        'mean': statistics.fmean(durations),
+    }
+
+
+async def measure_flush(queue, rng: random.Random, args, batch: int) -> Dict:
+    """每次放入 batch 条下载历史后调用 flush，测量每次 flush 的耗时"""
+    durations = []
+    for _ in range(args.flushes):
+        for _ in range(batch):
+            queue.save_history(
+                user_id=rng.randint(1, args.users + 1), song_title='New Song', artist='Artist',
+                source='youtube', source_url=None, duration=200, file_size=4_000_000
+            )
+        start = time.perf_counter()
+        await queue.flush()
+        durations.append(time.perf_counter() - start)
+
+    if queue.failures:
+        raise RuntimeError(f"批量写入失败 {queue.failures} 次")
+
+    durations.sort()
+    return {
+        'p50': durations[len(durations) // 2],
+        'p99': durations[min(len(durations) - 1, int(len(durations) * 0.99))],
+        'mean': statistics.fmean(durations),
+    }
+
+
+async def run(args):
+    workdir = Path(tempfile.mkdtemp(prefix='history-bench-'))
+    db_path = workdir / 'history.db'
+    os.environ.update({
+        'TELEGRAM_BOT_TOKEN': os.environ.get('TELEGRAM_BOT_TOKEN', '123456:bench'),
+        'DATABASE_URL': f"sqlite+aiosqlite:///{db_path}",
+        'DOWNLOAD_PATH': str(workdir / 'downloads'),
+        'LOG_FILE': str(workdir / 'bot.log'),
+    })
+
+    from loguru import logger
+    logger.remove()
+    logger.add(sys.stderr, level='WARNING')
+
+    import config
+    import database
+    from write_behind import WriteBehindQueue
+
+    # 建表和索引与机器人启动时相同，然后关闭连接再批量写入
+    await database.init_db(os.environ['DATABASE_URL'])
+    await database.close_db()
+
+    start = time.perf_counter()
+    populate(db_path, args)
+    print(f"写入 {args.rows} 条记录（{args.users} 个用户，用户 {HEAVY_USER} 有 {args.heavy_rows} 条），"
+          f"索引 {args.index}，耗时 {time.perf_counter() - start:.1f}s\n")
+
+    # 之后按机器人的引擎配置打开，不再运行迁移（否则会补回被删除的复合索引）
+    await database.init_db(os.environ['DATABASE_URL'], migrate=False)
+    session_factory = database.AsyncSessionLocal
+
+    rng = random.Random(args.seed)
+    size = args.page_size
+
+    # 深处翻页的游标：第 depth 页第一条记录之前的位置
+    async with session_factory() as session:
+        deep = (await session.execute(offset_page_stmt(HEAVY_USER, size, args.depth))).scalars().first()
+    if deep is None:
+        print(f"用户 {HEAVY_USER} 的记录不足 {args.depth} 页，请调小 --depth")
+        await database.close_db()
+        return
+    cursor = (deep.downloaded_at, deep.id)
+
+    cases = [
+        ('最新一页（随机用户）',
+         lambda: history_page_stmt(rng.randint(2, args.users + 1), size)),
+        ('最新一页（大用户）',
+         lambda: history_page_stmt(HEAVY_USER, size)),
+        (f'第{args.depth}页 较早（游标）',
+         lambda: history_page_stmt(HEAVY_USER, size, cursor=cursor)),
+        (f'第{args.depth}页 较新（游标）',
+         lambda: history_page_stmt(HEAVY_USER, size, cursor=cursor, newer=True)),
+        (f'第{args.depth}页（OFFSET对比）',
+         lambda: offset_page_stmt(HEAVY_USER, size, args.depth)),
+        ('关键词筛选（大用户）',
+         lambda: history_page_stmt(HEAVY_USER, size, keyword='rain')),
+    ]
+
+    summary = []
+    for label, make_stmt in cases:
+        async with session_factory() as session:
+            plan = await explain(session, make_stmt())
+        stats = await measure(session_factory, make_stmt, args.queries)
+        summary.append((label, stats))
+        print(f"{label}:")
+        for step in plan:
+            print(f"    {step}")
+        print()
+
+    # 写入：与 save_download_history 相同，记录进入 WriteBehindQueue，由 flush 在一个事务中写入
+    for label, batch in (('写入 1 条', 1), (f'写入 {config.DB_FLUSH_MAX_ROWS} 条（一批）', config.DB_FLUSH_MAX_ROWS)):
+        stats = await measure_flush(WriteBehindQueue(flush_interval=60, max_batch=batch), rng, args, batch)
+        summary.append((label, stats))
+
+    print(f"{'操作':<24}{'p50':>12}{'p99':>12}{'平均':>12}")
+    for label, stats in summary:
+        print(f"{label:<24}{stats['p50'] * 1000:>10.2f}ms{stats['p99'] * 1000:>10.2f}ms{stats['mean'] * 1000:>10.2f}ms")
+
+    await database.close_db()
+
+
+def main(argv=None):
+    asyncio.run(run(parse_args(argv)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,377 @@
+"""
+离线压测 - 用假的Telegram、YouTube和Spotify服务驱动 MusicBot
+
+模拟大量用户按比例执行 搜索 / 点击下载 / 查看历史 / 内联查询 / 帮助，统计吞吐量、延迟分位数、内存和CPU。
+不需要网络，在仓库根目录运行：
+
+    python -m benchmarks.load_test --users 2000 --concurrency 200
+
+下载高峰时轻量命令的延迟（/help 的p99）：
+
+    python -m benchmarks.load_test --users 300 --concurrency 300 --actions 4 \
+        --mix search=1,click=6,help=3 --download-latency 3
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from pathlib import Path
+from typing import Dict, List, Optional
+from aiohttp import web
+
+from benchmarks.fakes import FakeSpotifyAPI, FakeTelegramServer, FakeYoutubeDL
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='MusicBot离线压测')
+    parser.add_argument('--users', type=int, default=1000, help='模拟用户总数')
+    parser.add_argument('--concurrency', type=int, default=100, help='同时活跃的用户数')
+    parser.add_argument('--actions', type=int, default=5, help='每个用户执行的操作数')
+    parser.add_argument('--mix', default='search=5,click=3,history=2', help='操作比例，可加入 inline=N、help=N')
+    parser.add_argument('--keystroke-interval', type=float, default=0.08, help='内联查询逐字输入的间隔(秒)')
+    parser.add_argument('--queries', type=int, default=200, help='不同搜索关键词的数量（越少缓存命中越多）')
+    parser.add_argument('--timeout', type=float, default=120, help='单个操作的超时(秒)')
+    parser.add_argument('--search-latency', type=float, default=0.2, help='假YouTube搜索耗时(秒)')
+    parser.add_argument('--download-latency', type=float, default=0.5, help='假下载耗时(秒)')
+    parser.add_argument('--transcode-latency', type=float, default=0.1, help='假转码耗时(秒)')
+    parser.add_argument('--audio-kb', type=int, default=256, help='合成音频文件大小(KB)')
+    parser.add_argument('--spotify-latency', type=float, default=0.1, help='假Spotify接口耗时(秒)，负数表示关闭Spotify')
+    parser.add_argument('--flood-limit', type=int, default=0,
+                        help='假Bot API每个聊天每秒允许的请求数，超出返回429，0表示不限')
+    parser.add_argument('--api-latency', type=float, default=0.0, help='假Bot API每次调用的耗时(秒)')
+    parser.add_argument('--prefetch', type=int, default=0, help='预取每次搜索的前几个结果，0表示关闭')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', help='把结果另外写入JSON文件')
+    return parser.parse_args(argv)
+
+
+def parse_mix(value: str) -> Dict[str, float]:
+    mix = {}
+    for part in value.split(','):
+        name, weight = part.split('=')
+        mix[name.strip()] = float(weight)
+    return mix
+
+
+def percentile(values: List[float], p: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p))]
+
+
+def rss_mb() -> float:
+    """当前常驻内存(MB)"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024 / 1024
+    except OSError:
+        return 0.0
+
+
+class LoadTest:
+    """压测驱动：把构造的更新放入应用的更新队列，在假服务器上等待机器人的回复"""
+
+    def __init__(self, args, bot, telegram: FakeTelegramServer):
+        self.args = args
+        self.bot = bot
+        self.telegram = telegram
+        self.mix = parse_mix(args.mix)
+        self.random = random.Random(args.seed)
+        self.update_id = 0
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.errors: Dict[str, int] = defaultdict(int)
+
+    def _next_update_id(self) -> int:
+        self.update_id += 1
+        return self.update_id
+
+    def _user(self, user_id: int) -> Dict:
+        return {'id': user_id, 'is_bot': False, 'first_name': f"user{user_id}", 'language_code': 'zh'}
+
+    def _message_update(self, user_id: int, text: str) -> Dict:
+        message = {
+            'message_id': self._next_update_id(),
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': self._user(user_id),
+            'text': text,
+        }
+        if text.startswith('/'):
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+        return {'update_id': self._next_update_id(), 'message': message}
+
+    def _callback_update(self, user_id: int, message: Dict, data: str) -> Dict:
+        return {
+            'update_id': self._next_update_id(),
+            'callback_query': {
+                'id': str(self._next_update_id()),
+                'from': self._user(user_id),
+                'chat_instance': str(user_id),
+                'message': message,
+                'data': data,
+            }
+        }
+
+    def _inline_update(self, user_id: int, query: str) -> Dict:
+        return {
+            'update_id': self._next_update_id(),
+            'inline_query': {
+                'id': str(self._next_update_id()),
+                'from': self._user(user_id),
+                'query': query,
+                'offset': '',
+            }
+        }
+
+    async def _send(self, kind: str, chat_id, data: Dict, predicate) -> Optional[Dict]:
+        """发送一条更新并等待机器人的最终回复，记录延迟"""
+        from telegram import Update
+
+        waiter = self.telegram.wait_for(chat_id, predicate)
+        start = time.perf_counter()
+        await self.bot.app.update_queue.put(Update.de_json(data, self.bot.app.bot))
+        try:
+            _, result = await asyncio.wait_for(waiter, timeout=self.args.timeout)
+        except asyncio.TimeoutError:
+            self.errors[f"{kind}_timeout"] += 1
+            return None
+
+        self.latencies[kind].append(time.perf_counter() - start)
+        return result
+
+    async def search(self, user_id: int) -> Optional[Dict]:
+        # 关键词热度大致符合长尾分布，热门关键词会命中共享缓存
+        rank = min(int(self.random.paretovariate(1.2)), self.args.queries)
+        query = f"song {rank}"
+
+        def done(method, params):
+            text = params.get('text', '')
+            return method == 'editMessageText' and (
+                (text.startswith('🎵') and '⏳' not in text) or text.startswith('❌')
+            )
+
+        result = await self._send('search', user_id, self._message_update(user_id, query), done)
+        if result and result.get('reply_markup'):
+            return result
+        if result:
+            self.errors['search_empty'] += 1
+        return None
+
+    async def click(self, user_id: int, results_message: Dict):
+        buttons = [
+            button['callback_data']
+            for row in results_message['reply_markup']['inline_keyboard']
+            for button in row
+            if button.get('callback_data', '').startswith('download_')
+        ]
+
+        def done(method, params):
+            return method == 'sendMessage' and params.get('text', '')[:1] in ('✅', '❌', '⚠')
+
+        data = self._callback_update(user_id, results_message, self.random.choice(buttons))
+        result = await self._send('click', user_id, data, done)
+        if result and not result['text'].startswith('✅'):
+            self.errors['click_failed'] += 1
+
+    async def history(self, user_id: int):
+        def done(method, params):
+            return method == 'sendMessage' and params.get('text', '')[:1] in ('📜', '📭', '❌')
+
+        await self._send('history', user_id, self._message_update(user_id, '/history'), done)
+
+    async def help(self, user_id: int):
+        def done(method, params):
+            return method == 'sendMessage' and '完整指南' in params.get('text', '')
+
+        await self._send('help', user_id, self._message_update(user_id, '/help'), done)
+
+    async def inline(self, user_id: int):
+        """逐字输入关键词，只等待最后一个查询的回答，延迟从最后一次输入算起"""
+        from telegram import Update
+
+        rank = min(int(self.random.paretovariate(1.2)), self.args.queries)
+        query = f"song {rank}"
+        for length in range(max(1, len(query) - 3), len(query)):
+            data = self._inline_update(user_id, query[:length])
+            await self.bot.app.update_queue.put(Update.de_json(data, self.bot.app.bot))
+            await asyncio.sleep(self.args.keystroke_interval)
+
+        data = self._inline_update(user_id, query)
+        await self._send(
+            'inline', ('inline', data['inline_query']['id']), data,
+            lambda method, params: method == 'answerInlineQuery'
+        )
+
+    async def run_user(self, user_id: int):
+        results_message = None
+        names = list(self.mix)
+        weights = [self.mix[name] for name in names]
+
+        for step in range(self.args.actions):
+            action = 'search' if step == 0 else self.random.choices(names, weights)[0]
+            if action == 'click' and results_message is None:
+                action = 'search'
+
+            if action == 'search':
+                results_message = await self.search(user_id) or results_message
+            elif action == 'click':
+                await self.click(user_id, results_message)
+            elif action == 'inline':
+                await self.inline(user_id)
+            elif action == 'help':
+                await self.help(user_id)
+            else:
+                await self.history(user_id)
+
+    async def run(self) -> Dict:
+        slots = asyncio.Semaphore(self.args.concurrency)
+
+        async def user_task(user_id: int):
+            async with slots:
+                await self.run_user(user_id)
+
+        cpu_start = time.process_time()
+        wall_start = time.perf_counter()
+        await asyncio.gather(*(user_task(1000 + idx) for idx in range(self.args.users)))
+        wall = time.perf_counter() - wall_start
+        cpu = time.process_time() - cpu_start
+
+        total = sum(len(values) for values in self.latencies.values())
+        report = {
+            'users': self.args.users,
+            'concurrency': self.args.concurrency,
+            'wall_seconds': wall,
+            'operations': total,
+            'throughput_ops': total / wall if wall else 0.0,
+            'cpu_seconds': cpu,
+            'cpu_utilization': cpu / wall if wall else 0.0,
+            'rss_mb': rss_mb(),
+            'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            'latency': {
+                kind: {
+                    'count': len(values),
+                    'p50': percentile(values, 0.50),
+                    'p90': percentile(values, 0.90),
+                    'p99': percentile(values, 0.99),
+                    'max': max(values),
+                }
+                for kind, values in self.latencies.items()
+            },
+            'errors': dict(self.errors),
+            'api_calls': dict(self.telegram.calls),
+            'flood_errors': self.telegram.flood_errors,
+            'ydl_instances': FakeYoutubeDL.instances,
+        }
+        from outbound import outbound_scheduler
+        report['outbound'] = outbound_scheduler.stats()
+        if self.args.prefetch:
+            from prefetch import prefetcher
+            report['prefetch'] = prefetcher.stats()
+        return report
+
+
+def print_report(report: Dict):
+    print()
+    print(f"用户 {report['users']} | 并发 {report['concurrency']} | 耗时 {report['wall_seconds']:.1f}s")
+    print(f"吞吐量 {report['throughput_ops']:.1f} 操作/秒 ({report['operations']} 个操作)")
+    print(f"CPU {report['cpu_seconds']:.1f}s ({report['cpu_utilization']:.0%}) | "
+          f"内存 {report['rss_mb']:.0f}MB (峰值 {report['max_rss_mb']:.0f}MB)")
+    print()
+    print(f"{'操作':<10}{'次数':>8}{'p50':>10}{'p90':>10}{'p99':>10}{'max':>10}")
+    for kind, stats in sorted(report['latency'].items()):
+        print(
+            f"{kind:<10}{stats['count']:>8}"
+            f"{stats['p50'] * 1000:>8.0f}ms{stats['p90'] * 1000:>8.0f}ms"
+            f"{stats['p99'] * 1000:>8.0f}ms{stats['max'] * 1000:>8.0f}ms"
+        )
+    if report['errors']:
+        print(f"\n错误: {report['errors']}")
+    print(f"Bot API调用: {report['api_calls']}")
+    print(f"429限流: {report['flood_errors']} | 出站调度: {report['outbound']}")
+    if 'prefetch' in report:
+        print(f"预取: {report['prefetch']}")
+
+
+async def main(args) -> Dict:
+    telegram = FakeTelegramServer(latency=args.api_latency, flood_limit=args.flood_limit)
+    spotify = FakeSpotifyAPI(latency=max(args.spotify_latency, 0))
+
+    web_app = web.Application(client_max_size=64 * 1024 * 1024)
+    web_app.add_routes(telegram.routes() + spotify.routes())
+    runner = web.AppRunner(web_app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    base_url = f"http://127.0.0.1:{port}"
+
+    # 配置在导入时读取，必须先设置环境变量再导入机器人
+    workdir = Path(tempfile.mkdtemp(prefix='bot-bench-'))
+    os.environ.update({
+        'TELEGRAM_BOT_TOKEN': '123456:BENCH',
+        'TELEGRAM_API_BASE_URL': base_url,
+        'DATABASE_URL': f"sqlite+aiosqlite:///{workdir / 'bench.db'}",
+        'STATE_DB_PATH': str(workdir / 'state.db'),
+        'DOWNLOAD_PATH': str(workdir / 'downloads'),
+        'LOG_FILE': str(workdir / 'bot.log'),
+        'LOG_LEVEL': 'WARNING',
+        'METRICS_PORT': '0',
+        'BOT_MODE': 'polling',
+        'WORKER_PROCESSES': '1',
+    })
+    if args.prefetch:
+        os.environ.update({'PREFETCH_ENABLED': 'true', 'PREFETCH_TOP_K': str(args.prefetch)})
+    if args.spotify_latency >= 0:
+        os.environ.update({
+            'SPOTIFY_CLIENT_ID': 'bench',
+            'SPOTIFY_CLIENT_SECRET': 'bench',
+            'SPOTIFY_API_BASE_URL': f"{base_url}/spotify/v1/",
+            'SPOTIFY_TOKEN_URL': f"{base_url}/spotify/api/token",
+        })
+    else:
+        os.environ['SPOTIFY_CLIENT_ID'] = ''
+
+    import yt_dlp
+    FakeYoutubeDL.search_latency = args.search_latency
+    FakeYoutubeDL.download_latency = args.download_latency
+    FakeYoutubeDL.transcode_latency = args.transcode_latency
+    FakeYoutubeDL.audio_bytes = args.audio_kb * 1024
+    yt_dlp.YoutubeDL = FakeYoutubeDL
+
+    from loguru import logger
+    logger.remove()
+    logger.add(sys.stderr, level='WARNING')
+
+    from bot import MusicBot
+
+    bot = MusicBot()
+    bot.build_application(with_updater=False)
+    await bot.app.initialize()
+    await bot.post_init(bot.app)
+    await bot.app.start()
+
+    try:
+        report = await LoadTest(args, bot, telegram).run()
+    finally:
+        await bot.app.stop()
+        await bot.app.shutdown()
+        await bot.post_shutdown(bot.app)
+        await runner.cleanup()
+
+    report['workdir'] = str(workdir)
+    return report
+
+
+if __name__ == '__main__':
+    arguments = parse_args()
+    result = asyncio.run(main(arguments))
+    print_report(result)
+    if arguments.json:
+        Path(arguments.json).write_text(json.dumps(result, indent=2, ensure_ascii=False))
@@ -0,0 +1,138 @@
+"""
+YoutubeDL实例池微基准 - 比较每次调用新建YoutubeDL（改动前）和复用 YoutubeDLPool 中的实例
+
+搜索本身用 FakeYoutubeDL 代替，不需要网络，耗时只包括创建实例和调用的开销。
+--setup real 时每个实例还会像真实的 yt_dlp.YoutubeDL 一样初始化并加载YouTube搜索提取器，
+--setup fake 时只测量实例池本身的开销。在仓库根目录运行：
+
+    python -m benchmarks.ydl_pool --calls 50
+    python -m benchmarks.ydl_pool --calls 500 --threads 4 --setup fake
+"""
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, List
+
+from benchmarks.fakes import FakeYoutubeDL
+
+# 与 YouTubeDownloader.search 相同的选项
+SEARCH_OPTS = {
+    'quiet': True,
+    'no_warnings': True,
+    'extract_flat': True,
+    'skip_download': True,
+}
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='YoutubeDL实例池微基准')
+    parser.add_argument('--calls', type=int, default=50, help='每种方式的搜索次数')
+    parser.add_argument('--threads', type=int, default=1, help='执行搜索的线程数')
+    parser.add_argument('--setup', choices=['real', 'fake'], default='real',
+                        help='real: 实例初始化使用真实的yt-dlp；fake: 只测量实例池开销')
+    parser.add_argument('--max-uses', type=int, default=1000, help='实例池中每个实例的最大使用次数')
+    return parser.parse_args(argv)
+
+
+def make_backend(setup: str, real_youtube_dl):
+    """返回替代 yt_dlp.YoutubeDL 的类，搜索结果来自 FakeYoutubeDL"""
+    if setup == 'fake':
+        return FakeYoutubeDL
+
+    class RealSetupYoutubeDL(FakeYoutubeDL):
+        """创建时和真实实例一样初始化yt-dlp并加载搜索提取器"""
+
+        def __init__(self, params=None):
+            super().__init__(params)
+            self._real = real_youtube_dl(dict(params or {}))
+            self._real.get_info_extractor('YoutubeSearch')
+
+        def close(self):
+            self._real.close()
+
+    return RealSetupYoutubeDL
+
+
+def run(label: str, search, calls: int, threads: int) -> Dict:
+    """用 threads 个线程执行 calls 次搜索，返回每次调用的耗时统计"""
+    created_before = FakeYoutubeDL.instances
+
+    def timed(idx: int) -> float:
+        start = time.perf_counter()
+        search(f"song {idx}")
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        durations: List[float] = list(executor.map(timed, range(calls)))
+    elapsed = time.perf_counter() - start
+
+    durations.sort()
+    return {
+        'label': label,
+        'elapsed': elapsed,
+        'mean': statistics.fmean(durations),
+        'p50': durations[len(durations) // 2],
+        'p99': durations[min(len(durations) - 1, int(len(durations) * 0.99))],
+        'instances': FakeYoutubeDL.instances - created_before,
+    }
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    workdir = Path(tempfile.mkdtemp(prefix='ydl-pool-bench-'))
+    os.environ.update({
+        'TELEGRAM_BOT_TOKEN': os.environ.get('TELEGRAM_BOT_TOKEN', '123456:bench'),
+        'DOWNLOAD_PATH': str(workdir / 'downloads'),
+        'LOG_FILE': str(workdir / 'bot.log'),
+    })
+
+    import yt_dlp
+    FakeYoutubeDL.search_latency = 0.0
+    yt_dlp.YoutubeDL = make_backend(args.setup, yt_dlp.YoutubeDL)
+
+    from loguru import logger
+    logger.remove()
+    logger.add(sys.stderr, level='WARNING')
+
+    from youtube_downloader import YoutubeDLPool
+
+    def fresh_search(query: str):
+        # 改动前：每次搜索都新建实例，用完关闭
+        ydl = yt_dlp.YoutubeDL(SEARCH_OPTS)
+        try:
+            return ydl.extract_info(f"ytsearch5:{query}", download=False)
+        finally:
+            ydl.close()
+
+    pool = YoutubeDLPool(max_uses=args.max_uses)
+
+    def pooled_search(query: str):
+        with pool.get('search', SEARCH_OPTS) as ydl:
+            return ydl.extract_info(f"ytsearch5:{query}", download=False)
+
+    results = [
+        run('每次新建', fresh_search, args.calls, args.threads),
+        run('实例池', pooled_search, args.calls, args.threads),
+    ]
+
+    print(f"\n搜索 {args.calls} 次 | 线程 {args.threads} | 实例初始化 {args.setup}\n")
+    print(f"{'方式':<10}{'总耗时':>10}{'平均':>12}{'p50':>12}{'p99':>12}{'新建实例':>10}")
+    for result in results:
+        print(
+            f"{result['label']:<10}{result['elapsed']:>9.2f}s"
+            f"{result['mean'] * 1000:>10.3f}ms{result['p50'] * 1000:>10.3f}ms"
+            f"{result['p99'] * 1000:>10.3f}ms{result['instances']:>10}"
+        )
+    fresh, pooled = results
+    print(f"\n平均耗时 每次新建/实例池 = {fresh['mean'] / pooled['mean']:.1f} | 实例池统计: {pool.stats()}")
+
+
+if __name__ == '__main__':
+    main()
@@ -4,25 +4,59 @@ Telegram音乐机器人主程序
 """
 import os
 import asyncio
+import json
+import signal
+import time
 from pathlib import Path
-from datetime import datetime
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from datetime import datetime, timedelta
+from typing import Optional, Union
+from urllib.parse import parse_qs, urlparse
+from telegram import (
+    Update,
+    InlineKeyboardButton,
+    InlineKeyboardMarkup,
+    InlineQueryResultArticle,
+    InlineQueryResultCachedAudio,
+    InlineQueryResultsButton,
+    InputTextMessageContent
+)
 from telegram.ext import (
     Application,
     CommandHandler,
     CallbackQueryHandler,
+    InlineQueryHandler,
     MessageHandler,
     ContextTypes,
     filters
 )
 from telegram.constants import ParseMode
+from telegram.error import BadRequest, RetryAfter
 from loguru import logger
-from sqlalchemy import select
+from sqlalchemy import or_, select, tuple_
 
 import config
-from database import init_db, close_db, AsyncSessionLocal, User, DownloadHistory, UserPreference
-from youtube_downloader import youtube_downloader
-from spotify_searcher import spotify_searcher
+import database
+from cache import SQLiteBackend, create_backend, file_id_cache, query_cache
+from circuit_breaker import BackendUnavailable, breakers
+from database import init_db, close_db, DownloadHistory, UserPreference
+from download_scheduler import download_scheduler, DownloadQueueFull, UserDownloadLimit
+from download_store import download_store
+from lanes import lanes, LaneFull, LaneUpdateProcessor, INTERACTIVE, SEARCH, DOWNLOAD, BACKGROUND, PREFETCH
+from metrics import (
+    registry, loop_lag_monitor, MetricsServer,
+    SEARCH_DURATION, SEARCH_RESULTS, UPLOAD_DURATION, DB_DURATION, INLINE_ANSWER_DURATION,
+    CACHE_HITS, CACHE_MISSES, CACHE_ENTRIES, COMPONENT_STATS
+)
+from outbound import outbound_scheduler
+from prefetch import prefetcher
+from progress import ProgressMessage, edit_throttle
+from sharding import ShardedFrontend
+from singleflight import download_flight
+from track_resolver import track_resolver
+from webhook_server import WebhookServer
+from write_behind import db_writer
+from youtube_downloader import youtube_downloader, QUALITY_PROFILES, DEFAULT_QUALITY
+from spotify_searcher import spotify_searcher, parse_collection_url
 
 
 # 配置日志
@@ -34,13 +68,38 @@ logger.add(
     encoding="utf-8"
 )
 
+# 处理器实际使用的更新类型，其余类型不让Telegram推送
+ALLOWED_UPDATES = [Update.MESSAGE, Update.CALLBACK_QUERY, Update.INLINE_QUERY]
+
+# 走搜索通道的命令，其余命令走交互通道
+SEARCH_COMMANDS = {'search', 'youtube', 'spotify', 'playlist', 'album'}
+
+# 历史记录翻页游标中时间戳的起点
+HISTORY_CURSOR_EPOCH = datetime(1970, 1, 1)
+
 
 class MusicBot:
     """音乐机器人类"""
 
     def __init__(self):
         self.app = None
-        self.search_cache = {}  # 用户搜索结果缓存 {chat_id: results}
+        # 用户搜索结果缓存 {chat_id: results}
+        self.search_cache = create_backend(
+            'search',
+            max_size=config.SEARCH_CACHE_MAX_SIZE,
+            ttl_seconds=config.CACHE_EXPIRE_MINUTES * 60
+        )
+        # 历史记录搜索的关键词 {"chat_id:message_id": keyword}
+        self.history_cache = create_backend(
+            'history',
+            max_size=config.SEARCH_CACHE_MAX_SIZE,
+            ttl_seconds=config.CACHE_EXPIRE_MINUTES * 60
+        )
+        self.playlist_jobs = {}  # 正在进行的播放列表下载 {user_id: task}，准备期间为占位的future
+        self.inline_jobs = {}  # 正在处理的内联查询 {user_id: task}
+        self.worker_index = 0  # 多进程模式下的worker编号
+        self.metrics_server = None
+        registry.add_collector(self._collect_metrics)
 
     async def start_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """处理/start命令"""
@@ -59,8 +118,9 @@ class MusicBot:
 /search <歌曲名> - 搜索音乐
 /youtube <歌曲名> - 仅在YouTube搜索
 /spotify <歌曲名> - 仅在Spotify搜索
+/playlist <链接> - 下载Spotify播放列表或专辑
 /settings - 查看和修改设置
-/history - 查看下载历史
+/history [关键词] - 查看或搜索下载历史
 /help - 查看帮助
 
 💡 快速开始：
@@ -84,21 +144,30 @@ class MusicBot:
 /youtube <歌曲名> - 仅在YouTube搜索
 /spotify <歌曲名> - 仅在Spotify搜索
 
+📃 播放列表：
+/playlist <链接> - 下载Spotify播放列表或专辑中的全部歌曲
+/playlist stop - 停止正在进行的播放列表下载
+
 ⚙️ 设置命令：
 /settings - 查看和修改个人设置
-/history - 查看下载历史
+/history - 查看下载历史，点击可重新获取歌曲
+/history <关键词> - 在下载历史中搜索
 
 🎯 使用技巧：
 1. 直接发送歌曲名称即可搜索
 2. 可以同时搜索歌手和歌名，如: "周杰伦 晴天"
 3. Spotify搜索会自动在YouTube下载音频
-4. 下载的音频为MP3格式，音质192kbps
+4. 默认发送原始音质的M4A音频，可在 /settings 中改为MP3
 
 ⚠️ 限制说明：
 • 单个文件最大 50MB
 • 歌曲时长最长 10分钟
 • 每次搜索最多显示 5个结果
 
+📤 内联模式：
+在任意聊天中输入 @机器人用户名 歌曲名，选择结果即可分享，
+下载过的歌曲会直接发送音频
+
 💡 提示：
 - 使用 /settings 可以设置默认搜索源
 - 所有下载记录都会保存在历史中
@@ -118,6 +187,147 @@ class MusicBot:
         """处理/spotify命令 - 仅搜索Spotify"""
         await self._handle_search(update, context, source='spotify')
 
+    async def playlist_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """处理/playlist命令 - 下载Spotify播放列表或专辑中的全部歌曲"""
+        user = update.effective_user
+
+        if context.args and context.args[0] == 'stop':
+            task = self.playlist_jobs.get(user.id)
+            if task:
+                task.cancel()
+                await update.message.reply_text("⏹️ 正在停止播放列表下载...")
+            else:
+                await update.message.reply_text("📭 当前没有正在进行的播放列表下载")
+            return
+
+        parsed = parse_collection_url(context.args[0]) if context.args else None
+        if not parsed:
+            await update.message.reply_text(
+                "❌ 请提供Spotify播放列表或专辑链接\n"
+                "例如: /playlist https://open.spotify.com/playlist/..."
+            )
+            return
+
+        if not spotify_searcher.enabled:
+            await update.message.reply_text("❌ 未配置Spotify，无法读取播放列表")
+            return
+
+        if user.id in self.playlist_jobs:
+            await update.message.reply_text("⚠️ 你已有一个播放列表正在下载，发送 /playlist stop 可以停止")
+            return
+
+        # 第一次await之前先占住名额，同一用户连续发送的 /playlist 不会同时开始；
+        # 准备期间收到 /playlist stop 时取消占位，不再启动下载
+        reservation = asyncio.get_running_loop().create_future()
+        self.playlist_jobs[user.id] = reservation
+        try:
+            kind, collection_id = parsed
+            info = await spotify_searcher.get_collection_info(kind, collection_id)
+            if not info:
+                await update.message.reply_text("❌ 无法读取该播放列表，请确认链接是否正确并且公开")
+                return
+
+            background = lanes[BACKGROUND]
+            if background.full():
+                await update.message.reply_text("⚠️ 当前后台任务过多，请稍后再试")
+                return
+
+            if reservation.cancelled():
+                return
+
+            info['total'] = min(info['total'], config.PLAYLIST_MAX_TRACKS)
+            status = await update.message.reply_text(
+                f"📃 {info['name']}\n共 {info['total']} 首，{'排队等待中' if background.busy() else '开始下载'}..."
+            )
+            if reservation.cancelled():
+                await status.edit_text(f"📃 {info['name']}\n\n⏹️ 播放列表下载已停止")
+                return
+
+            # 播放列表耗时很长，放到后台通道执行，不阻塞其他消息的处理
+            task = context.application.create_task(
+                background.run(self._run_playlist(update.message, status, kind, collection_id, info, user.id))
+            )
+            self.playlist_jobs[user.id] = task
+            task.add_done_callback(
+                lambda done: self.playlist_jobs.pop(user.id, None) if self.playlist_jobs.get(user.id) is done else None
+            )
+        finally:
+            if self.playlist_jobs.get(user.id) is reservation:
+                del self.playlist_jobs[user.id]
+
+    async def _run_playlist(self, message, status, kind: str, collection_id: str, info: dict, user_id: int):
+        """
+        播放列表下载流水线
+
+        逐页读取歌曲放入有界队列，由固定数量的worker匹配、下载并发送，
+        每首歌完成后立即发送；状态消息按固定间隔更新进度。
+        """
+        progress = {'sent': 0, 'failed': 0}
+        workers = max(1, min(config.PLAYLIST_CONCURRENCY, config.DOWNLOADS_PER_USER))
+        queue = asyncio.Queue(maxsize=workers * 2)
+
+        async def produce():
+            count = 0
+            async for track in spotify_searcher.iter_collection_tracks(kind, collection_id):
+                if count >= info['total']:
+                    break
+                await queue.put(track)
+                count += 1
+            for _ in range(workers):
+                await queue.put(None)
+
+        async def work():
+            while (track := await queue.get()) is not None:
+                if await self._deliver_playlist_track(message, track, user_id):
+                    progress['sent'] += 1
+                else:
+                    progress['failed'] += 1
+
+        async def report():
+            last_text = None
+            while True:
+                await asyncio.sleep(config.PLAYLIST_PROGRESS_INTERVAL)
+                text = self._playlist_progress_text(info, progress)
+                if text != last_text:
+                    try:
+                        await status.edit_text(text)
+                        last_text = text
+                    except Exception as e:
+                        logger.warning(f"更新播放列表进度失败: {e}")
+
+        reporter = asyncio.create_task(report())
+        result_text = "⏹️ 播放列表下载已停止"
+        try:
+            await asyncio.gather(produce(), *(work() for _ in range(workers)))
+            result_text = "✅ 播放列表下载完成"
+        finally:
+            reporter.cancel()
+            try:
+                await status.edit_text(f"{self._playlist_progress_text(info, progress)}\n\n{result_text}")
+            except Exception as e:
+                logger.warning(f"更新播放列表进度失败: {e}")
+
+    async def _deliver_playlist_track(self, message, track: dict, user_id: int) -> bool:
+        """发送播放列表中的一首歌，下载队列繁忙时稍后重试"""
+        for _ in range(config.PLAYLIST_RETRIES + 1):
+            try:
+                return await self.deliver_track(message, track, user_id)
+            except (DownloadQueueFull, UserDownloadLimit):
+                await asyncio.sleep(config.PLAYLIST_RETRY_DELAY)
+            except Exception as e:
+                logger.error(f"播放列表歌曲下载失败: {track['title']}: {e}")
+                return False
+        return False
+
+    def _playlist_progress_text(self, info: dict, progress: dict) -> str:
+        """播放列表进度文本"""
+        done = progress['sent'] + progress['failed']
+        return (
+            f"📃 {info['name']}\n"
+            f"⏬ 进度: {done}/{info['total']}\n"
+            f"✅ 已发送: {progress['sent']} | ❌ 失败: {progress['failed']}"
+        )
+
     async def _handle_search(self, update: Update, context: ContextTypes.DEFAULT_TYPE, source: str = 'both'):
         """
         统一的搜索处理方法
@@ -148,38 +358,193 @@ class MusicBot:
         msg = await update.message.reply_text(f"🔍 正在{source_text}搜索: {query}...")
 
         try:
-            results = []
-
-            # YouTube搜索
-            if source in ['youtube', 'both']:
-                yt_results = await youtube_downloader.search(query, limit=5)
-                results.extend(yt_results)
+            async def show_partial(partial: list, pending: list):
+                # 先到的结果立即展示，点击也能直接使用
+                await self.search_cache.set(str(chat_id), partial)
+                await self.send_search_results(update, partial, msg, pending=pending)
 
-            # Spotify搜索
-            if source in ['spotify', 'both'] and spotify_searcher.enabled:
-                sp_results = await spotify_searcher.search(query, limit=5)
-                results.extend(sp_results)
+            failed = []
+            results = await self._search_sources(query, source, on_partial=show_partial, failed=failed)
 
             if not results:
-                await msg.edit_text("❌ 没有找到相关歌曲，请换个关键词试试")
+                if failed:
+                    # 来源出错时不要让用户以为是关键词的问题
+                    await msg.edit_text(f"⚠️ {'、'.join(failed)} 暂时无法访问，请稍后再试")
+                else:
+                    await msg.edit_text("❌ 没有找到相关歌曲，请换个关键词试试")
                 return
 
             # 保存搜索结果到缓存
-            self.search_cache[chat_id] = results
+            await self.search_cache.set(str(chat_id), results)
 
             # 构建结果消息和按钮
             await self.send_search_results(update, results, msg)
 
+            if config.PREFETCH_ENABLED:
+                context.application.create_task(self._run_prefetch(self._prefetch_results(chat_id, user.id, results)))
+
         except Exception as e:
             logger.error(f"搜索失败: {e}")
             await msg.edit_text("❌ 搜索时出错，请稍后再试")
 
-    async def send_search_results(self, update: Update, results: list, msg):
-        """发送搜索结果"""
+    async def _run_prefetch(self, coroutine):
+        """在预取通道中执行预取，排队已满时直接跳过"""
+        try:
+            await lanes[PREFETCH].run(coroutine)
+        except LaneFull:
+            logger.debug("预取通道排队已满，跳过预取")
+
+    async def _prefetch_results(self, chat_id: int, user_id: int, results: list):
+        """
+        在用户选择之前预取排名靠前的结果
+
+        Spotify结果先匹配YouTube视频，已有file_id的歌曲不需要下载。
+        预取通过 download_flight 进行，用户点击时直接加入进行中的下载。
+        """
+        try:
+            quality = await self.get_preferred_quality(user_id)
+            candidates = []
+            for track in results[:config.PREFETCH_TOP_K]:
+                yt_track = await self.resolve_youtube_track(track)
+                if not yt_track or not yt_track.get('video_id'):
+                    continue
+                source_id = f"youtube:{yt_track['video_id']}"
+                if await file_id_cache.get(source_id, quality):
+                    continue
+                candidates.append(((source_id, quality), yt_track))
+
+            # 新的搜索结果替换了旧的，旧结果的预取不再需要
+            prefetcher.retain(chat_id, [key for key, _ in candidates])
+
+            for flight_key, yt_track in candidates:
+                if not download_scheduler.idle():
+                    break
+                prefetcher.submit(
+                    chat_id, flight_key,
+                    lambda key=flight_key, url=yt_track['url']: self._prefetch_download(key, url, user_id)
+                )
+
+        except Exception as e:
+            logger.warning(f"预取搜索结果失败: {e}")
+
+    async def _prefetch_download(self, flight_key: tuple, url: str, user_id: int) -> Optional[int]:
+        """在空闲的下载槽位中下载，返回文件大小"""
+        source_id, quality = flight_key
+        async with download_flight.acquire(
+            flight_key,
+            lambda _: self._download_audio(url, f"{source_id}|{quality}", user_id, quality, background=True)
+        ) as flight:
+            return flight.result.stat().st_size if flight.result else None
+
+    async def _search_sources(self, query: str, source: str, on_partial=None,
+                              timeout: Optional[float] = None, failed: Optional[list] = None) -> list:
+        """
+        并发搜索所有启用的来源，每个来源单独超时
+
+        熔断中的来源不发出请求，只使用共享缓存中的结果；
+        只搜索Spotify而Spotify熔断中时改为搜索YouTube。
+
+        Args:
+            query: 搜索关键词
+            source: 'youtube', 'spotify', 或 'both'
+            on_partial: 还有来源未返回时的回调 (已有结果, 未返回的来源列表)
+            timeout: 所有来源统一使用的超时(秒)，默认按来源配置
+            failed: 传入列表时，追加搜索失败或不可用的来源名称
+
+        Returns:
+            按返回先后合并的搜索结果，慢或失败的来源会被跳过
+        """
+        limit = config.SEARCH_RESULTS_LIMIT
+        if source == 'spotify' and spotify_searcher.enabled and not spotify_searcher.available():
+            logger.info(f"Spotify熔断中，改为搜索YouTube: {query}")
+            source = 'both'
+
+        searches = {}
+        if source in ['youtube', 'both']:
+            searches['YouTube'] = (
+                query_cache.get_or_fetch(
+                    'youtube', query, limit,
+                    lambda: youtube_downloader.search(query, limit=limit)
+                ),
+                timeout or config.YOUTUBE_SEARCH_TIMEOUT
+            )
+        if source in ['spotify', 'both'] and spotify_searcher.enabled:
+            searches['Spotify'] = (
+                query_cache.get_or_fetch(
+                    'spotify', query, limit,
+                    lambda: spotify_searcher.search(query, limit=limit)
+                ),
+                timeout or config.SPOTIFY_SEARCH_TIMEOUT
+            )
+
+        tasks = [
+            asyncio.create_task(self._search_one(name, coro, timeout))
+            for name, (coro, timeout) in searches.items()
+        ]
+        pending = list(searches)
+        results = []
+
+        try:
+            # 按完成顺序追加，已展示的结果序号不会因后到的来源而改变
+            for next_done in asyncio.as_completed(tasks):
+                name, items, ok = await next_done
+                pending.remove(name)
+                results.extend(items)
+                if not ok and failed is not None:
+                    failed.append(name)
+
+                if on_partial and results and pending:
+                    try:
+                        await on_partial(list(results), list(pending))
+                    except Exception as e:
+                        logger.warning(f"更新部分搜索结果失败: {e}")
+        finally:
+            # 自身被取消时不留下仍在等待的来源
+            for task in tasks:
+                task.cancel()
+
+        return results
+
+    async def _search_one(self, name: str, coro, timeout: float):
+        """执行单个来源的搜索，返回 (来源, 结果, 是否成功)，超时或出错时结果为空"""
+        source = name.lower()
+        start = time.perf_counter()
+        outcome = 'error'
+        try:
+            items = await asyncio.wait_for(coro, timeout=timeout)
+            outcome = 'ok'
+            SEARCH_RESULTS.inc(len(items), source=source)
+            return name, items, True
+        except asyncio.TimeoutError:
+            outcome = 'timeout'
+            logger.warning(f"{name}搜索超时 ({timeout}s)")
+        except BackendUnavailable as e:
+            outcome = 'unavailable'
+            logger.warning(f"{name}搜索跳过: {e}")
+        except asyncio.CancelledError:
+            outcome = 'cancelled'
+            raise
+        except Exception as e:
+            logger.error(f"{name}搜索失败: {e}")
+        finally:
+            SEARCH_DURATION.observe(time.perf_counter() - start, source=source, outcome=outcome)
+        return name, [], False
+
+    async def send_search_results(self, update: Update, results: list, msg, pending: list = None, page: int = 0):
+        """
+        发送搜索结果
+
+        Args:
+            pending: 仍在搜索中的来源，非空时在结果末尾提示
+            page: 显示第几页（从0开始）
+        """
         result_text = "🎵 搜索结果：\n\n"
 
+        page_size = config.SEARCH_PAGE_SIZE
+        start = page * page_size
+
         keyboard = []
-        for idx, track in enumerate(results[:10]):  # 最多显示10个结果
+        for idx, track in enumerate(results[start:start + page_size], start):
             # 格式化时长
             duration = track.get('duration', 0)
             duration_str = f"{duration // 60}:{duration % 60:02d}"
@@ -208,11 +573,16 @@ class MusicBot:
             )])
 
         # 添加翻页按钮（如果结果很多）
-        if len(results) > 10:
-            keyboard.append([
-                InlineKeyboardButton("◀️ 上一页", callback_data="page_prev"),
-                InlineKeyboardButton("下一页 ▶️", callback_data="page_next")
-            ])
+        navigation = []
+        if page > 0:
+            navigation.append(InlineKeyboardButton("◀️ 上一页", callback_data=f"page_{page - 1}"))
+        if start + page_size < len(results):
+            navigation.append(InlineKeyboardButton("下一页 ▶️", callback_data=f"page_{page + 1}"))
+        if navigation:
+            keyboard.append(navigation)
+
+        if pending:
+            result_text += f"⏳ 正在等待 {'、'.join(pending)} 的结果...\n"
 
         reply_markup = InlineKeyboardMarkup(keyboard)
         await msg.edit_text(result_text, reply_markup=reply_markup)
@@ -220,7 +590,6 @@ class MusicBot:
     async def button_callback(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """处理按钮回调"""
         query = update.callback_query
-        await query.answer()
 
         chat_id = query.message.chat.id
         user = query.from_user
@@ -229,69 +598,217 @@ class MusicBot:
         # 处理下载按钮
         if data.startswith('download_'):
             idx = int(data.split('_')[1])
-            results = self.search_cache.get(chat_id, [])
+            results = await self.search_cache.get(str(chat_id))
 
             if not results or idx >= len(results):
                 await query.answer("❌ 搜索结果已过期，请重新搜索", show_alert=True)
                 return
 
+            await query.answer()
             track = results[idx]
 
             # 显示下载提示
-            await query.edit_message_text(
+            status = await query.edit_message_text(
                 f"⏬ 正在下载: {track['title']}\n"
                 f"👤 {track['artist']}\n\n"
                 f"⏳ 请稍候..."
             )
+            await self._download_for_callback(status, track, user.id)
 
-            try:
-                # 下载音乐
-                file_path = await self.download_music(track, user.id)
+        # 处理搜索结果翻页
+        elif data.startswith('page_'):
+            page = int(data.split('_')[1])
+            results = await self.search_cache.get(str(chat_id))
 
-                if file_path:
-                    # 发送音频文件
-                    await self.send_audio_file(query, track, file_path, user.id)
+            if not results:
+                await query.answer("❌ 搜索结果已过期，请重新搜索", show_alert=True)
+                return
 
-                    # 保存下载历史
-                    await self.save_download_history(user.id, track, file_path)
+            await query.answer()
+            await self.send_search_results(update, results, query.message, page=page)
 
-                    await query.message.reply_text("✅ 下载完成！")
-                else:
-                    await query.message.reply_text("❌ 下载失败，请稍后重试")
+        # 处理历史记录翻页和重新下载
+        elif data.startswith('hist_'):
+            await self._history_callback(query, user.id)
 
-            except Exception as e:
-                logger.error(f"下载失败: {e}")
-                await query.message.reply_text(f"❌ 下载失败: {str(e)}")
+    async def _download_for_callback(self, status, track: dict, user_id: int):
+        """
+        按钮触发的下载，进度显示在 status 消息中
+
+        Args:
+            status: 显示下载状态的消息，音频和结果回复到这条消息
+            track: 歌曲信息
+            user_id: 用户ID
+        """
+        header = f"⏬ 正在下载: {track['title']}\n👤 {track['artist']}"
 
-    async def download_music(self, track: dict, user_id: int) -> Path:
+        try:
+            # 离开 with 时取消还没发出的进度编辑，不会覆盖之后的结果
+            with ProgressMessage(status, header, edit_throttle) as progress:
+                delivered = await self.deliver_track(
+                    status, track, user_id, on_queued=progress.queued, on_progress=progress.update
+                )
+
+            if delivered:
+                await status.reply_text("✅ 下载完成！")
+            else:
+                await status.reply_text("❌ 下载失败，请稍后重试")
+
+        except UserDownloadLimit:
+            await status.reply_text(
+                f"⚠️ 你同时进行的下载已达上限（{config.DOWNLOADS_PER_USER}个），请等待完成后再试"
+            )
+
+        except DownloadQueueFull:
+            await status.reply_text("⚠️ 当前下载人数过多，请稍后再试")
+
+        except BackendUnavailable as e:
+            await status.reply_text(f"⚠️ {e}")
+
+        except RetryAfter as e:
+            # 出站调度器重试后仍被限流，音频可能已经发出，不能当作下载失败；继续回复只会加重限流
+            logger.warning(f"发送下载结果被限流: {e}")
+
+        except Exception as e:
+            logger.error(f"下载失败: {e}")
+            await status.reply_text(f"❌ 下载失败: {str(e)}")
+
+    async def deliver_track(self, message, track: dict, user_id: int, on_queued=None, on_progress=None) -> bool:
         """
-        下载音乐
+        把歌曲发送到聊天，已上传过的音频直接用file_id发送，否则下载后上传
 
         Args:
+            message: 用于回复音频的消息
             track: 歌曲信息
             user_id: 用户ID
+            on_queued: 下载需要排队时的回调，参数为排队位置
+            on_progress: 进度回调 (阶段, 数据)，阶段为 'downloading'、'converting' 或 'uploading'
+
+        Returns:
+            是否发送成功
+        """
+        yt_track = await self.resolve_youtube_track(track)
+        if not yt_track:
+            return False
+
+        source_id = f"youtube:{yt_track['video_id']}" if yt_track.get('video_id') else None
+        quality = await self.get_preferred_quality(user_id)
+
+        # 提前预取过的歌曲记为命中，进行中的预取由 download_flight 合并
+        flight_key = (source_id or yt_track['url'], quality)
+        prefetcher.claim(flight_key)
+
+        # 命中file_id缓存时无需下载、转码和重新上传
+        if source_id:
+            file_id = await file_id_cache.get(source_id, quality)
+            if file_id:
+                try:
+                    await self.send_audio_file(message, track, file_id)
+                    await self.save_download_history(user_id, track, None)
+                    return True
+                except BadRequest as e:
+                    logger.warning(f"缓存的file_id已失效: {e}")
+                    await file_id_cache.delete(source_id, quality)
+
+        # 同一首歌的并发请求共享一次下载，最后一个请求发送完后才释放文件；
+        # 排队位置和下载进度转发给所有合并的请求
+        async with download_flight.acquire(
+            flight_key,
+            lambda flight: self._download_audio(
+                yt_track['url'], f"{flight_key[0]}|{quality}", user_id, quality, flight.queued, flight.progress
+            ),
+            on_queued=on_queued,
+            on_progress=on_progress
+        ) as flight:
+            file_path = flight.result
+            if not file_path:
+                return False
+
+            file_size = file_path.stat().st_size
+
+            # 只让第一个请求上传，其余请求等它拿到file_id后直接转发
+            async with flight.lock:
+                file_id = await file_id_cache.get(source_id, quality) if source_id else None
+                if file_id:
+                    await self.send_audio_file(message, track, file_id)
+                else:
+                    if on_progress:
+                        on_progress('uploading', {})
+                    audio_message = await self.send_audio_file(message, track, file_path)
+                    if source_id and audio_message.audio:
+                        await file_id_cache.set(source_id, quality, audio_message.audio)
+
+        await self.save_download_history(user_id, track, file_size)
+        return True
+
+    async def _download_audio(self, url: str, store_key: str, user_id: int, quality: str,
+                              on_queued=None, on_progress=None, background: bool = False):
+        """
+        获取歌曲的本地音频文件，最近发送过的文件直接从磁盘缓存读取
+
+        background 为True时（预取）只使用空闲的下载槽位
 
         Returns:
-            下载的文件路径
+            被锁定的文件路径（由 download_flight 释放），失败返回None
+        """
+        file_path = download_store.get(store_key)
+        if file_path:
+            return file_path
+
+        if background:
+            file_path = await download_scheduler.run_background(
+                lambda: youtube_downloader.download(url, user_id, quality)
+            )
+        else:
+            file_path = await download_scheduler.run(
+                user_id,
+                lambda: youtube_downloader.download(url, user_id, quality, on_progress),
+                on_queued=on_queued
+            )
+        return download_store.commit(store_key, file_path) if file_path else None
+
+    async def resolve_youtube_track(self, track: dict) -> Optional[dict]:
+        """
+        获取歌曲对应的YouTube视频
+
+        Args:
+            track: 歌曲信息
+
+        Returns:
+            YouTube搜索结果，找不到返回None
         """
         if track['source'] == 'youtube':
-            # YouTube直接下载
-            return await youtube_downloader.download(track['url'], user_id)
+            return track
         elif track['source'] == 'spotify':
-            # Spotify需要先在YouTube搜索
-            youtube_query = track.get('youtube_query', f"{track['artist']} {track['title']}")
-            yt_results = await youtube_downloader.search(youtube_query, limit=1)
-
-            if yt_results:
-                return await youtube_downloader.download(yt_results[0]['url'], user_id)
+            # Spotify需要先匹配YouTube视频
+            return await track_resolver.resolve(track)
 
         return None
 
-    async def send_audio_file(self, query, track: dict, file_path: Path, user_id: int):
-        """发送音频文件"""
+    async def send_audio_file(self, message, track: dict, audio: Union[Path, str]):
+        """
+        发送音频文件
+
+        Args:
+            message: 用于回复音频的消息
+            track: 歌曲信息
+            audio: 本地文件路径，或已上传音频的file_id
+
+        Returns:
+            发送出的音频消息
+        """
         try:
-            with open(file_path, 'rb') as audio_file:
-                await query.message.reply_audio(
+            if isinstance(audio, str):
+                with UPLOAD_DURATION.time(kind='file_id'):
+                    return await message.reply_audio(
+                        audio=audio,
+                        title=track['title'],
+                        performer=track['artist'],
+                        duration=track.get('duration')
+                    )
+
+            with UPLOAD_DURATION.time(kind='file'), open(audio, 'rb') as audio_file:
+                return await message.reply_audio(
                     audio=audio_file,
                     title=track['title'],
                     performer=track['artist'],
@@ -299,13 +816,118 @@ class MusicBot:
                     thumbnail=None  # 可以添加缩略图
                 )
 
-            # 删除临时文件
-            file_path.unlink(missing_ok=True)
-
         except Exception as e:
             logger.error(f"发送音频文件失败: {e}")
             raise
 
+    async def inline_query_handler(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """处理内联查询 - 在任意聊天中输入 @机器人 歌曲名"""
+        inline_query = update.inline_query
+        user_id = inline_query.from_user.id
+
+        # 用户每输入一个字都会产生新的查询，新查询到达时取消旧查询的回答；
+        # 已经发出的上游搜索继续完成并写入缓存，不会被取消
+        previous = self.inline_jobs.pop(user_id, None)
+        if previous:
+            previous.cancel()
+
+        task = context.application.create_task(self._answer_inline_query(inline_query))
+        self.inline_jobs[user_id] = task
+        task.add_done_callback(
+            lambda done: self.inline_jobs.pop(user_id, None) if self.inline_jobs.get(user_id) is done else None
+        )
+
+    async def _answer_inline_query(self, inline_query):
+        """
+        回答内联查询
+
+        共享搜索缓存命中时立即回答；未命中时等输入停顿 INLINE_DEBOUNCE_MS 后再搜索，
+        搜索使用较短的超时，保证在Telegram放弃等待之前回答。
+        """
+        start = time.perf_counter()
+        query = inline_query.query.strip()
+        path = 'empty'
+
+        try:
+            results = []
+            if len(query) >= config.INLINE_MIN_QUERY_LENGTH:
+                results = await self._cached_search(query)
+                path = 'cached'
+                if results is None:
+                    path = 'search'
+                    await asyncio.sleep(config.INLINE_DEBOUNCE_MS / 1000)
+                    results = await self._search_sources(
+                        query, 'both', timeout=config.INLINE_SEARCH_TIMEOUT
+                    )
+
+            quality = await self.get_preferred_quality(inline_query.from_user.id)
+            answers = await self._build_inline_results(results[:config.INLINE_RESULTS_LIMIT], quality)
+
+            await inline_query.answer(
+                answers,
+                cache_time=config.INLINE_CACHE_TIME,
+                is_personal=True,  # 音质是个人设置，不同用户的file_id不同
+                button=InlineQueryResultsButton(text="🎵 在机器人中搜索下载", start_parameter='inline')
+            )
+            INLINE_ANSWER_DURATION.observe(time.perf_counter() - start, path=path)
+
+        except asyncio.CancelledError:
+            INLINE_ANSWER_DURATION.observe(time.perf_counter() - start, path='cancelled')
+            raise
+        except BadRequest as e:
+            # 查询已过期（用户继续输入或等待过久）
+            logger.debug(f"回答内联查询失败: {e}")
+        except Exception as e:
+            logger.error(f"内联查询失败: {e}")
+
+    async def _cached_search(self, query: str) -> Optional[list]:
+        """从共享搜索缓存读取所有来源的结果，任一来源未缓存时返回None"""
+        limit = config.SEARCH_RESULTS_LIMIT
+        sources = ['youtube'] + (['spotify'] if spotify_searcher.enabled else [])
+        cached = await asyncio.gather(*(query_cache.peek(source, query, limit) for source in sources))
+        if any(items is None for items in cached):
+            return None
+        return [track for items in cached for track in items]
+
+    async def _build_inline_results(self, results: list, quality: str) -> list:
+        """
+        生成内联查询结果
+
+        已上传过的歌曲返回缓存的音频，选择后立即发送；
+        其他歌曲返回文字结果（歌曲信息和链接），不会为内联查询下载。
+        """
+        async def cached_file_id(track: dict) -> Optional[str]:
+            # 只使用已保存的Spotify匹配，不为内联查询搜索YouTube
+            yt_track = track if track['source'] == 'youtube' else await track_resolver.lookup(track)
+            if not yt_track or not yt_track.get('video_id'):
+                return None
+            return await file_id_cache.get(f"youtube:{yt_track['video_id']}", quality)
+
+        file_ids = await asyncio.gather(*(cached_file_id(track) for track in results))
+
+        audio_results = []
+        article_results = []
+        for idx, (track, file_id) in enumerate(zip(results, file_ids)):
+            if file_id:
+                audio_results.append(InlineQueryResultCachedAudio(id=f"audio_{idx}", audio_file_id=file_id))
+                continue
+
+            duration = int(track.get('duration') or 0)
+            link = track.get('url') or track.get('spotify_url') or ''
+            source_icon = '🎬' if track['source'] == 'youtube' else '🎧'
+            article_results.append(InlineQueryResultArticle(
+                id=f"track_{idx}",
+                title=f"{source_icon} {track['title']}",
+                description=f"👤 {track['artist']} · ⏱ {duration // 60}:{duration % 60:02d}",
+                thumbnail_url=track.get('thumbnail'),
+                input_message_content=InputTextMessageContent(
+                    f"🎵 {track['title']}\n👤 {track['artist']}\n{link}".rstrip()
+                )
+            ))
+
+        # 可以直接发送音频的结果排在前面
+        return audio_results + article_results
+
     async def text_message_handler(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """处理普通文本消息 - 直接作为搜索"""
         query_text = update.message.text
@@ -315,126 +937,605 @@ class MusicBot:
         await self._handle_search(update, context, source='both')
 
     async def settings_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """处理/settings命令"""
+        """处理/settings命令 - /settings quality <high|medium|low> 修改音频质量"""
         user = update.effective_user
 
-        settings_text = """
+        if context.args:
+            if len(context.args) == 2 and context.args[0] == 'quality' and context.args[1] in QUALITY_PROFILES:
+                quality = context.args[1]
+                await self.save_preferred_quality(user.id, quality)
+                await update.message.reply_text(f"✅ 音频质量已设置为: {QUALITY_PROFILES[quality]['label']}")
+            else:
+                await update.message.reply_text(
+                    "❌ 用法: /settings quality <high|medium|low>"
+                )
+            return
+
+        quality = await self.get_preferred_quality(user.id)
+
+        settings_text = f"""
 ⚙️ 个人设置
 
 当前设置：
 • 默认搜索源: YouTube + Spotify
-• 音频质量: 高质量 (192kbps)
+• 音频质量: {QUALITY_PROFILES[quality]['label']}
 • 自动下载: 关闭
 
-🔧 可用设置（开发中）：
-- 修改默认搜索源
-- 调整音频质量
-- 启用自动下载第一个结果
+🔧 修改音频质量：
+/settings quality high - 原始音质，不转码，最快
+/settings quality medium - MP3 128kbps
+/settings quality low - MP3 64kbps，文件最小
         """
 
         await update.message.reply_text(settings_text)
 
-    async def history_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """处理/history命令 - 显示下载历史"""
-        user_id = update.effective_user.id
+    async def get_preferred_quality(self, user_id: int) -> str:
+        """获取用户设置的音频质量"""
+        quality = None
+        try:
+            with DB_DURATION.time(operation='get_preference'):
+                async with database.AsyncSessionLocal() as session:
+                    result = await session.execute(
+                        select(UserPreference.preferred_quality)
+                        .where(UserPreference.user_id == user_id)
+                    )
+                    quality = result.scalar_one_or_none()
+
+        except Exception as e:
+            logger.error(f"获取用户设置失败: {e}")
+
+        return quality if quality in QUALITY_PROFILES else DEFAULT_QUALITY
 
+    async def save_preferred_quality(self, user_id: int, quality: str):
+        """保存用户设置的音频质量"""
         try:
-            async with AsyncSessionLocal() as session:
-                result = await session.execute(
-                    select(DownloadHistory)
-                    .where(DownloadHistory.user_id == user_id)
-                    .order_by(DownloadHistory.downloaded_at.desc())
-                    .limit(10)
-                )
-                history = result.scalars().all()
+            with DB_DURATION.time(operation='save_preference'):
+                async with database.AsyncSessionLocal() as session:
+                    result = await session.execute(
+                        select(UserPreference).where(UserPreference.user_id == user_id)
+                    )
+                    preference = result.scalar_one_or_none()
+
+                    if preference:
+                        preference.preferred_quality = quality
+                    else:
+                        session.add(UserPreference(user_id=user_id, preferred_quality=quality))
 
-                if not history:
-                    await update.message.reply_text("📭 你还没有下载过任何歌曲")
-                    return
+                    await session.commit()
+
+        except Exception as e:
+            logger.error(f"保存用户设置失败: {e}")
 
-                history_text = "📜 最近下载的歌曲：\n\n"
-                for idx, record in enumerate(history, 1):
-                    history_text += f"{idx}. {record.song_title}\n"
-                    history_text += f"   👤 {record.artist}\n"
-                    history_text += f"   📅 {record.downloaded_at.strftime('%Y-%m-%d %H:%M')}\n\n"
+    async def history_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """处理/history命令 - 分页显示下载历史，/history <关键词> 搜索历史"""
+        user_id = update.effective_user.id
+        keyword = ' '.join(context.args).strip() if context.args else None
 
-                await update.message.reply_text(history_text)
+        # 刚下载的歌曲可能还在写入队列中
+        if db_writer.has_pending_history(user_id):
+            await db_writer.flush()
 
+        try:
+            page = await self._load_history_page(user_id, keyword)
         except Exception as e:
             logger.error(f"获取历史记录失败: {e}")
             await update.message.reply_text("❌ 获取历史记录失败")
+            return
 
-    async def save_user(self, user):
-        """保存用户信息到数据库"""
-        try:
-            async with AsyncSessionLocal() as session:
-                result = await session.execute(
-                    select(User).where(User.user_id == user.id)
-                )
-                db_user = result.scalar_one_or_none()
+        if not page['records']:
+            if keyword:
+                await update.message.reply_text(f"📭 历史记录中没有找到: {keyword}")
+            else:
+                await update.message.reply_text("📭 你还没有下载过任何歌曲")
+            return
 
-                if db_user:
-                    # 更新最后活跃时间
-                    db_user.last_active = datetime.utcnow()
-                else:
-                    # 创建新用户
-                    db_user = User(
-                        user_id=user.id,
-                        username=user.username,
-                        first_name=user.first_name,
-                        last_name=user.last_name,
-                        language_code=user.language_code
-                    )
-                    session.add(db_user)
+        text, reply_markup = self._render_history_page(page, keyword)
+        msg = await update.message.reply_text(text, reply_markup=reply_markup)
+
+        # 翻页按钮放不下关键词，按消息保存
+        if keyword:
+            await self.history_cache.set(f"{msg.chat_id}:{msg.message_id}", keyword)
+
+    async def _load_history_page(
+        self,
+        user_id: int,
+        keyword: Optional[str] = None,
+        cursor: Optional[tuple] = None,
+        newer: bool = False
+    ) -> dict:
+        """
+        按 (downloaded_at, id) 游标读取一页下载历史
+
+        Args:
+            user_id: 用户ID
+            keyword: 按歌名或歌手筛选
+            cursor: 翻页起点 (downloaded_at, id)，None表示最新一页
+            newer: True表示读取游标之前（更新）的一页，否则读取之后（更早）的一页
+
+        Returns:
+            {'records': 按时间倒序的记录, 'has_newer': bool, 'has_older': bool}
+        """
+        page_size = config.HISTORY_PAGE_SIZE
+        position = tuple_(DownloadHistory.downloaded_at, DownloadHistory.id)
+
+        stmt = select(DownloadHistory).where(DownloadHistory.user_id == user_id)
+        if keyword:
+            # 用户输入的 % 和 _ 按普通字符匹配
+            escaped = keyword.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+            pattern = f"%{escaped}%"
+            stmt = stmt.where(or_(
+                DownloadHistory.song_title.ilike(pattern, escape='\\'),
+                DownloadHistory.artist.ilike(pattern, escape='\\')
+            ))
+
+        # 多取一条用来判断这个方向上是否还有下一页
+        if newer:
+            stmt = stmt.where(position > tuple_(*cursor)).order_by(
+                DownloadHistory.downloaded_at.asc(), DownloadHistory.id.asc()
+            )
+        else:
+            if cursor:
+                stmt = stmt.where(position < tuple_(*cursor))
+            stmt = stmt.order_by(DownloadHistory.downloaded_at.desc(), DownloadHistory.id.desc())
+
+        with DB_DURATION.time(operation='history_page'):
+            async with database.AsyncSessionLocal() as session:
+                result = await session.execute(stmt.limit(page_size + 1))
+                records = list(result.scalars())
+
+        more = len(records) > page_size
+        records = records[:page_size]
+
+        if newer:
+            records.reverse()
+            return {'records': records, 'has_newer': more, 'has_older': True}
+
+        return {'records': records, 'has_newer': cursor is not None, 'has_older': more}
+
+    def _render_history_page(self, page: dict, keyword: Optional[str] = None):
+        """生成历史记录页面的文本和按钮"""
+        records = page['records']
+
+        if keyword:
+            history_text = f"🔎 历史记录中包含「{keyword}」的歌曲：\n\n"
+        else:
+            history_text = "📜 下载历史：\n\n"
+
+        keyboard = []
+        for idx, record in enumerate(records, 1):
+            history_text += f"{idx}. {record.song_title}\n"
+            history_text += f"   👤 {record.artist}\n"
+            history_text += f"   📅 {record.downloaded_at.strftime('%Y-%m-%d %H:%M')}\n\n"
+
+            keyboard.append([InlineKeyboardButton(
+                f"🔁 {idx}. {record.song_title[:25]}",
+                callback_data=f"hist_get_{record.id}"
+            )])
 
-                await session.commit()
+        # 翻页按钮带上当前页首尾记录的位置，搜索结果的翻页加上 _q 标记
+        suffix = '_q' if keyword else ''
+        navigation = []
+        if page['has_newer']:
+            navigation.append(InlineKeyboardButton(
+                "◀️ 较新",
+                callback_data=f"hist_newer_{self._encode_history_cursor(records[0])}{suffix}"
+            ))
+        if page['has_older']:
+            navigation.append(InlineKeyboardButton(
+                "较早 ▶️",
+                callback_data=f"hist_older_{self._encode_history_cursor(records[-1])}{suffix}"
+            ))
+        if navigation:
+            keyboard.append(navigation)
+
+        history_text += "💡 点击按钮重新获取歌曲"
+        return history_text, InlineKeyboardMarkup(keyboard)
+
+    @staticmethod
+    def _encode_history_cursor(record) -> str:
+        micros = (record.downloaded_at - HISTORY_CURSOR_EPOCH) // timedelta(microseconds=1)
+        return f"{micros}_{record.id}"
+
+    @staticmethod
+    def _decode_history_cursor(micros: str, record_id: str) -> tuple:
+        return HISTORY_CURSOR_EPOCH + timedelta(microseconds=int(micros)), int(record_id)
+
+    async def _history_callback(self, query, user_id: int):
+        """处理历史记录的翻页和重新下载按钮"""
+        data = query.data
+
+        if data.startswith('hist_get_'):
+            record_id = int(data[len('hist_get_'):])
+            track = await self._load_history_track(user_id, record_id)
+            if not track:
+                await query.answer("❌ 找不到这条历史记录", show_alert=True)
+                return
+
+            await query.answer()
+            status = await query.message.reply_text(
+                f"⏬ 正在下载: {track['title']}\n"
+                f"👤 {track['artist']}\n\n"
+                f"⏳ 请稍候..."
+            )
+            await self._download_for_callback(status, track, user_id)
+            return
 
+        # hist_<newer|older>_<微秒时间戳>_<id>[_q]
+        parts = data.split('_')
+        newer = parts[1] == 'newer'
+        cursor = self._decode_history_cursor(parts[2], parts[3])
+
+        keyword = None
+        cache_key = f"{query.message.chat.id}:{query.message.message_id}"
+        if len(parts) > 4:
+            keyword = await self.history_cache.get(cache_key)
+            if keyword is None:
+                await query.answer("❌ 搜索已过期，请重新使用 /history <关键词>", show_alert=True)
+                return
+
+        try:
+            page = await self._load_history_page(user_id, keyword, cursor=cursor, newer=newer)
         except Exception as e:
-            logger.error(f"保存用户失败: {e}")
+            logger.error(f"获取历史记录失败: {e}")
+            await query.answer("❌ 获取历史记录失败", show_alert=True)
+            return
+
+        await query.answer()
+        if not page['records']:
+            return
+
+        if keyword:
+            # 翻页后继续保留关键词
+            await self.history_cache.set(cache_key, keyword)
+
+        text, reply_markup = self._render_history_page(page, keyword)
+        await query.edit_message_text(text, reply_markup=reply_markup)
 
-    async def save_download_history(self, user_id: int, track: dict, file_path: Path):
-        """保存下载历史"""
+    async def _load_history_track(self, user_id: int, record_id: int) -> Optional[dict]:
+        """把用户自己的一条历史记录还原为歌曲信息"""
         try:
-            async with AsyncSessionLocal() as session:
-                history = DownloadHistory(
-                    user_id=user_id,
-                    song_title=track['title'],
-                    artist=track['artist'],
-                    source=track['source'],
-                    source_url=track.get('url') or track.get('spotify_url'),
-                    duration=track.get('duration'),
-                    file_size=file_path.stat().st_size if file_path.exists() else None
-                )
-                session.add(history)
-                await session.commit()
+            with DB_DURATION.time(operation='history_record'):
+                async with database.AsyncSessionLocal() as session:
+                    result = await session.execute(
+                        select(DownloadHistory).where(
+                            DownloadHistory.id == record_id,
+                            DownloadHistory.user_id == user_id
+                        )
+                    )
+                    record = result.scalar_one_or_none()
 
         except Exception as e:
-            logger.error(f"保存下载历史失败: {e}")
+            logger.error(f"获取历史记录失败: {e}")
+            return None
+
+        if not record or not record.source_url:
+            return None
+
+        track = {
+            'title': record.song_title,
+            'artist': record.artist or '',
+            'duration': record.duration,
+            'source': record.source,
+        }
+        if record.source == 'spotify':
+            track['spotify_url'] = record.source_url
+        else:
+            track['url'] = record.source_url
+            video_id = parse_qs(urlparse(record.source_url).query).get('v')
+            if video_id:
+                track['video_id'] = video_id[0]
+
+        return track
+
+    async def stats_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """处理/stats命令 - 查看缓存统计（仅管理员）"""
+        if update.effective_user.id not in config.ADMIN_USER_IDS:
+            await update.message.reply_text("❌ 该命令仅限管理员使用")
+            return
+
+        stats = self.search_cache.stats()
+        query_stats = query_cache.stats()
+        file_stats = file_id_cache.stats()
+        resolver_stats = track_resolver.stats()
+        flight_stats = download_flight.stats()
+        scheduler_stats = download_scheduler.stats()
+        pool_stats = youtube_downloader.ydl_pool.stats()
+        writer_stats = db_writer.stats()
+        store_stats = download_store.stats()
+        prefetch_stats = prefetcher.stats()
+        outbound_stats = outbound_scheduler.stats()
+        lane_lines = '\n'.join(
+            f"• {name}: 运行 {lane['running']}/{lane['concurrency']} | 排队 {lane['queued']} | "
+            f"完成 {lane['completed']} | 拒绝 {lane['rejected']}"
+            for name, lane in ((name, lane.stats()) for name, lane in lanes.items())
+        )
+        stats_text = f"""
+📊 运行统计
+
+🗂️ 搜索缓存：
+• 条目数: {stats['size']}/{stats['max_size']}
+• 命中: {stats['hits']} | 未命中: {stats['misses']}
+• 命中率: {stats['hit_rate']:.1%}
+• 容量淘汰: {stats['evictions']} | 过期清理: {stats['expirations']}
+
+🔎 共享搜索缓存：
+• 命中: {query_stats['hits']} | 合并: {query_stats['coalesced']} | 未命中: {query_stats['misses']}
+• 命中率: {query_stats['hit_rate']:.1%}
+• 上游请求: {query_stats['upstream_calls']} | 节省: {query_stats['upstream_saved']}
+
+🎯 Spotify匹配：
+• 已保存匹配: {resolver_stats['hits']} | 重新搜索: {resolver_stats['misses']} | 得分过低: {resolver_stats['rejected']}
+
+📦 音频file_id缓存：
+• 命中: {file_stats['hits']} | 未命中: {file_stats['misses']}
+• 命中率: {file_stats['hit_rate']:.1%}
+
+⏬ 下载合并：
+• 进行中: {flight_stats['in_flight']}
+• 实际下载: {flight_stats['started']} | 合并请求: {flight_stats['coalesced']} | 重新发起: {flight_stats['retried']}
+
+🧵 下载调度：
+• 运行中: {scheduler_stats['running']}/{scheduler_stats['workers']}
+• 排队中: {scheduler_stats['queued']}/{scheduler_stats['max_queue']}
+• 已完成: {scheduler_stats['completed']} | 已拒绝: {scheduler_stats['rejected']}
+• YoutubeDL实例: 新建 {pool_stats['created']} | 复用 {pool_stats['reused']} | 回收 {pool_stats['recycled']}
+
+🗄️ 下载目录：
+• 已用: {store_stats['used_bytes'] / 1024 / 1024:.1f}MB / {store_stats['max_bytes'] / 1024 / 1024:.0f}MB ({store_stats['files']} 个文件)
+• 磁盘缓存命中: {store_stats['hits']} | 未命中: {store_stats['misses']}
+• 容量淘汰: {store_stats['evictions']} | 残留清理: {store_stats['orphans_removed']}
+
+🔮 推测预取{'' if config.PREFETCH_ENABLED else '（未启用）'}：
+• 进行中: {prefetch_stats['active']}/{prefetch_stats['max_active']} | 已启动: {prefetch_stats['started']} | 跳过: {prefetch_stats['skipped']}
+• 命中: {prefetch_stats['hits']} | 取消: {prefetch_stats['cancelled']} | 未使用: {prefetch_stats['wasted']}
+• 命中率: {prefetch_stats['hit_rate']:.1%} | 浪费: {prefetch_stats['wasted_bytes'] / 1024 / 1024:.1f}MB
+
+🚦 处理通道{'' if config.UPDATE_LANES else '（更新按顺序处理）'}：
+{lane_lines}
+
+📨 出站消息{'' if config.OUTBOUND_RATE_LIMIT else '（未启用限速）'}：
+• 已发送: {outbound_stats['sent']} | 合并编辑: {outbound_stats['coalesced']}
+• 排队中: {outbound_stats['waiting']} | 限流重试: {outbound_stats['retry_after']} | 放弃: {outbound_stats['failed']}
+• 暂停中的聊天: {outbound_stats['paused_chats']}/{outbound_stats['chats']}
+
+💾 数据库批量写入：
+• 事务数: {writer_stats['flushes']} | 失败: {writer_stats['failures']}
+• 用户: {writer_stats['users_written']} (合并 {writer_stats['users_coalesced']}) | 历史: {writer_stats['history_written']}
+• 待写入: 用户 {writer_stats['pending_users']} | 历史 {writer_stats['pending_history']}
+        """
+
+        await update.message.reply_text(stats_text)
+
+    async def backends_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """
+        处理/backends命令 - 查看和控制后端熔断器（仅管理员）
+
+        /backends                 查看所有熔断器
+        /backends reset <名称>    关闭熔断器，立即恢复调用
+        /backends open <名称> [秒] 打开熔断器，暂停调用
+        """
+        if update.effective_user.id not in config.ADMIN_USER_IDS:
+            await update.message.reply_text("❌ 该命令仅限管理员使用")
+            return
+
+        args = context.args or []
+        if args:
+            action, name = args[0], args[1] if len(args) > 1 else ''
+            breaker = breakers.get(name)
+            if action not in ('reset', 'open') or breaker is None:
+                await update.message.reply_text(
+                    "用法: /backends [reset|open] <名称> [秒]\n"
+                    f"可用名称: {', '.join(breakers)}"
+                )
+                return
+
+            if action == 'reset':
+                breaker.reset()
+            else:
+                seconds = float(args[2]) if len(args) > 2 and args[2].replace('.', '', 1).isdigit() else None
+                breaker.trip(seconds)
+
+        state_icons = {'closed': '🟢 正常', 'half_open': '🟡 试探中', 'open': '🔴 熔断'}
+        lines = ["🛡️ 后端状态\n"]
+        for name, breaker in breakers.items():
+            stats = breaker.stats()
+            line = (
+                f"{breaker.label} ({name}): {state_icons[stats['state']]}\n"
+                f"• 最近失败率: {stats['failure_rate']:.0%} ({stats['window_calls']} 次调用)\n"
+                f"• 成功: {stats['successes']} | 失败: {stats['failures']} | "
+                f"重试: {stats['retried']} | 拒绝: {stats['rejected']} | 熔断次数: {stats['opened']}"
+            )
+            if stats['state'] == 'open':
+                line += f"\n• {stats['open_for']:.0f} 秒后试探恢复"
+            lines.append(line)
+
+        await update.message.reply_text('\n\n'.join(lines))
+
+    async def sweep_cache_job(self, context: ContextTypes.DEFAULT_TYPE):
+        """定时任务 - 清理过期的搜索结果"""
+        removed = (
+            await self.search_cache.sweep()
+            + await self.history_cache.sweep()
+            + await file_id_cache.sweep()
+        )
+        if removed:
+            logger.debug(f"清理过期搜索缓存: {removed} 条")
+
+        removed = await query_cache.sweep()
+        if removed:
+            logger.debug(f"清理共享搜索缓存: {removed} 条")
+
+        # 搜索结果过期后对应的预取也不再需要
+        removed = prefetcher.expire()
+        if removed:
+            logger.debug(f"清理过期预取: {removed} 个")
+
+    async def sweep_downloads_job(self, context: ContextTypes.DEFAULT_TYPE):
+        """定时任务 - 清理下载目录中的残留文件"""
+        removed = download_store.sweep()
+        if removed:
+            logger.info(f"清理下载目录残留文件: {removed} 个")
+
+    async def refresh_spotify_token_job(self, context: ContextTypes.DEFAULT_TYPE):
+        """定时任务 - 在后台线程中提前刷新Spotify令牌"""
+        await spotify_searcher.refresh_token()
+
+    def _collect_metrics(self):
+        """抓取指标时读取各模块的统计"""
+        caches = {
+            'search': self.search_cache.stats(),
+            'query': query_cache.stats(),
+            'file_id': file_id_cache.stats(),
+            'spotify_mapping': track_resolver.stats(),
+            'download_dir': download_store.stats(),
+        }
+        for name, stats in caches.items():
+            CACHE_HITS.set(stats['hits'], cache=name)
+            CACHE_MISSES.set(stats['misses'], cache=name)
+            size = stats.get('size', stats.get('memory_size', stats.get('files')))
+            if size is not None:
+                CACHE_ENTRIES.set(size, cache=name)
+
+        components = {
+            'download_flight': download_flight.stats(),
+            'download_scheduler': download_scheduler.stats(),
+            'download_dir': download_store.stats(),
+            'ydl_pool': youtube_downloader.ydl_pool.stats(),
+            'db_writer': db_writer.stats(),
+            'progress_edits': edit_throttle.stats(),
+            'prefetch': prefetcher.stats(),
+            'outbound': outbound_scheduler.stats(),
+        }
+        components.update({f"lane_{name}": lane.stats() for name, lane in lanes.items()})
+        for component, stats in components.items():
+            for stat, value in stats.items():
+                if isinstance(value, (int, float)):
+                    COMPONENT_STATS.set(value, component=component, stat=stat)
+
+    async def save_user(self, user):
+        """保存用户信息到数据库（合并后批量写入）"""
+        db_writer.save_user(user)
+
+    async def save_download_history(self, user_id: int, track: dict, file_size: Optional[int]):
+        """保存下载历史（批量写入）"""
+        db_writer.save_history(
+            user_id=user_id,
+            song_title=track['title'],
+            artist=track['artist'],
+            source=track['source'],
+            source_url=track.get('url') or track.get('spotify_url'),
+            duration=track.get('duration'),
+            file_size=file_size
+        )
+
+    def classify_update(self, update: object) -> str:
+        """按处理器的工作量把更新分到处理通道"""
+        if not isinstance(update, Update):
+            return INTERACTIVE
+
+        if update.inline_query:
+            return SEARCH
+
+        if update.callback_query:
+            data = update.callback_query.data or ''
+            return DOWNLOAD if data.startswith(('download_', 'hist_get_')) else INTERACTIVE
+
+        text = update.message.text if update.message else None
+        if not text:
+            return INTERACTIVE
+        if text.startswith('/'):
+            command = text.split()[0][1:].split('@')[0].lower()
+            return SEARCH if command in SEARCH_COMMANDS else INTERACTIVE
+        return SEARCH
+
+    async def reject_update(self, update: object, lane: str):
+        """通道排队已满时告诉用户稍后再试"""
+        if not isinstance(update, Update):
+            return
+
+        if update.callback_query:
+            await update.callback_query.answer("⚠️ 当前请求过多，请稍后再试", show_alert=True)
+        elif update.inline_query:
+            await update.inline_query.answer([], cache_time=0)
+        elif update.message:
+            await update.message.reply_text("⚠️ 当前请求过多，请稍后再试")
 
     async def post_init(self, application: Application):
         """应用初始化后的钩子"""
         logger.info("初始化数据库...")
-        await init_db(config.DATABASE_URL)
+        # 多进程时前端进程已经完成迁移，worker不再重复执行
+        await init_db(config.DATABASE_URL, migrate=config.WORKER_PROCESSES <= 1)
+        db_writer.start()
         logger.info("数据库初始化完成")
 
+        # 清理上次运行中断时留下的下载文件
+        removed = download_store.sweep()
+        if removed:
+            logger.info(f"清理下载目录残留文件: {removed} 个")
+
+        # 预先获取Spotify令牌，避免第一次搜索时等待
+        await spotify_searcher.refresh_token()
+
+        loop_lag_monitor.start()
+        if config.METRICS_PORT:
+            # 多进程时每个worker使用各自的端口
+            self.metrics_server = MetricsServer(
+                listen=config.METRICS_LISTEN,
+                port=config.METRICS_PORT + self.worker_index,
+                path=config.METRICS_PATH
+            )
+            try:
+                await self.metrics_server.start()
+            except OSError as e:
+                logger.error(f"指标服务器启动失败: {e}")
+                self.metrics_server = None
+
     async def post_shutdown(self, application: Application):
         """应用关闭前的钩子"""
+        if self.metrics_server:
+            await self.metrics_server.stop()
+        await loop_lag_monitor.stop()
+        prefetcher.cancel_all()
+
         logger.info("关闭数据库连接...")
+        await db_writer.stop()
         await close_db()
         logger.info("数据库连接已关闭")
 
-    def run(self):
-        """启动机器人"""
-        logger.info("🎵 音乐机器人启动中...")
+        spotify_searcher.close()
+        youtube_downloader.close()
+        await SQLiteBackend.close_all()
+
+    def build_application(self, with_updater: bool = True) -> Application:
+        """
+        创建应用并注册处理器和定时任务
 
-        # 创建应用
-        self.app = (
+        Args:
+            with_updater: 是否创建用于长轮询的Updater，webhook模式不需要
+        """
+        builder = (
             Application.builder()
             .token(config.TELEGRAM_BOT_TOKEN)
             .post_init(self.post_init)
             .post_shutdown(self.post_shutdown)
-            .build()
         )
+        if not with_updater:
+            builder = builder.updater(None)
+        if config.OUTBOUND_RATE_LIMIT:
+            builder = builder.rate_limiter(outbound_scheduler)
+        if config.UPDATE_LANES:
+            # 更新按通道并发处理，长时间的下载不会挡住其他聊天的命令
+            builder = builder.concurrent_updates(
+                LaneUpdateProcessor(lanes, self.classify_update, self.reject_update)
+            )
+        if config.TELEGRAM_API_BASE_URL:
+            builder = (
+                builder
+                .base_url(f"{config.TELEGRAM_API_BASE_URL}/bot")
+                .base_file_url(f"{config.TELEGRAM_API_BASE_URL}/file/bot")
+            )
+
+        self.app = builder.build()
 
         # 添加命令处理器
         self.app.add_handler(CommandHandler("start", self.start_command))
@@ -442,21 +1543,141 @@ class MusicBot:
         self.app.add_handler(CommandHandler("search", self.search_command))
         self.app.add_handler(CommandHandler("youtube", self.youtube_command))
         self.app.add_handler(CommandHandler("spotify", self.spotify_command))
+        self.app.add_handler(CommandHandler(["playlist", "album"], self.playlist_command))
         self.app.add_handler(CommandHandler("settings", self.settings_command))
         self.app.add_handler(CommandHandler("history", self.history_command))
+        self.app.add_handler(CommandHandler("stats", self.stats_command))
+        self.app.add_handler(CommandHandler("backends", self.backends_command))
 
         # 添加回调查询处理器
         self.app.add_handler(CallbackQueryHandler(self.button_callback))
 
+        # 添加内联查询处理器
+        self.app.add_handler(InlineQueryHandler(self.inline_query_handler))
+
         # 添加文本消息处理器（普通消息直接搜索）
         self.app.add_handler(MessageHandler(
             filters.TEXT & ~filters.COMMAND,
             self.text_message_handler
         ))
 
+        # 定时清理过期缓存
+        self.app.job_queue.run_repeating(
+            self.sweep_cache_job,
+            interval=config.CACHE_SWEEP_INTERVAL,
+            first=config.CACHE_SWEEP_INTERVAL
+        )
+
+        # 定时清理下载目录
+        self.app.job_queue.run_repeating(
+            self.sweep_downloads_job,
+            interval=config.DOWNLOAD_SWEEP_INTERVAL,
+            first=config.DOWNLOAD_SWEEP_INTERVAL
+        )
+
+        # 定时刷新Spotify令牌
+        if spotify_searcher.enabled:
+            self.app.job_queue.run_repeating(
+                self.refresh_spotify_token_job,
+                interval=config.SPOTIFY_TOKEN_REFRESH_INTERVAL,
+                first=config.SPOTIFY_TOKEN_REFRESH_INTERVAL
+            )
+
+        return self.app
+
+    def run(self):
+        """启动机器人"""
+        logger.info("🎵 音乐机器人启动中...")
+
+        # 多进程模式：本进程只接收更新，由worker进程处理
+        if config.WORKER_PROCESSES > 1:
+            ShardedFrontend(config.WORKER_PROCESSES, ALLOWED_UPDATES).run()
+            return
+
+        if config.BOT_MODE == 'webhook':
+            self.build_application(with_updater=False)
+            asyncio.run(self._run_webhook())
+            return
+
+        self.build_application()
+
         # 启动机器人
         logger.info("✅ 机器人已启动，正在监听消息...")
-        self.app.run_polling(allowed_updates=Update.ALL_TYPES)
+        self.app.run_polling(allowed_updates=ALLOWED_UPDATES)
+
+    async def _run_webhook(self):
+        """webhook模式：由内置HTTP服务器接收Telegram推送的更新"""
+        stop_event = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, stop_event.set)
+            except NotImplementedError:
+                pass
+
+        server = WebhookServer(
+            self.app,
+            listen=config.WEBHOOK_LISTEN,
+            port=config.WEBHOOK_PORT,
+            path=config.WEBHOOK_PATH,
+            secret_token=config.WEBHOOK_SECRET_TOKEN,
+            health_path=config.WEBHOOK_HEALTH_PATH
+        )
+
+        await self.app.initialize()
+        await self.post_init(self.app)
+        try:
+            await server.start()
+
+            # 未配置公网地址时只启动本地服务器，可以直接POST更新JSON进行测试
+            if config.WEBHOOK_URL:
+                await self.app.bot.set_webhook(
+                    url=config.WEBHOOK_URL.rstrip('/') + config.WEBHOOK_PATH,
+                    secret_token=config.WEBHOOK_SECRET_TOKEN,
+                    allowed_updates=ALLOWED_UPDATES
+                )
+                logger.info(f"已设置Webhook: {config.WEBHOOK_URL}")
+
+            await self.app.start()
+            logger.info("✅ 机器人已启动（webhook模式），正在监听消息...")
+            await stop_event.wait()
+
+        finally:
+            await server.stop()
+            if self.app.running:
+                await self.app.stop()
+            await self.app.shutdown()
+            await self.post_shutdown(self.app)
+
+    async def run_worker(self, index: int, update_queue):
+        """
+        多进程模式下的worker：处理前端进程转发的更新
+
+        Args:
+            index: worker编号
+            update_queue: 前端进程写入更新JSON的进程间队列，收到None时退出
+        """
+        loop = asyncio.get_running_loop()
+        self.worker_index = index
+
+        await self.app.initialize()
+        await self.post_init(self.app)
+        try:
+            await self.app.start()
+            logger.info(f"✅ worker {index} 已启动，正在处理消息...")
+
+            while True:
+                payload = await loop.run_in_executor(None, update_queue.get)
+                if payload is None:
+                    break
+                update = Update.de_json(json.loads(payload), self.app.bot)
+                await self.app.update_queue.put(update)
+
+        finally:
+            if self.app.running:
+                await self.app.stop()
+            await self.app.shutdown()
+            await self.post_shutdown(self.app)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,622 @@
+"""
+缓存模块 - 搜索结果缓存和Telegram file_id缓存
+
+每个聊天的搜索结果和file_id存放在可替换的后端中：单进程时默认使用进程内存，
+多进程模式下默认使用SQLite文件，所有worker进程读写同一份数据。
+"""
+import asyncio
+import json
+import time
+import unicodedata
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional
+import aiosqlite
+from sqlalchemy import select, delete, func
+from loguru import logger
+import config
+import database
+from database import AudioFileCache, SearchResultCache
+
+
+class SearchCache:
+    """搜索结果缓存类
+
+    按最近使用顺序保存条目，超出容量时淘汰最久未使用的条目，
+    每个条目在写入 ttl_seconds 秒后过期。
+    """
+
+    def __init__(self, max_size: int, ttl_seconds: float):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self._entries: "OrderedDict[Hashable, tuple]" = OrderedDict()  # {key: (expires_at, value)}
+
+        # 统计计数
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """
+        读取缓存条目
+
+        Args:
+            key: 缓存键
+
+        Returns:
+            缓存的值，不存在或已过期返回None
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        expires_at, value = entry
+        if expires_at <= time.monotonic():
+            del self._entries[key]
+            self.expirations += 1
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: Hashable, value: Any):
+        """
+        写入缓存条目，超出容量时淘汰最久未使用的条目
+
+        Args:
+            key: 缓存键
+            value: 缓存的值
+        """
+        self._entries[key] = (time.monotonic() + self.ttl_seconds, value)
+        self._entries.move_to_end(key)
+
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def pop(self, key: Hashable) -> Optional[Any]:
+        """删除并返回缓存条目"""
+        entry = self._entries.pop(key, None)
+        return entry[1] if entry else None
+
+    def sweep(self) -> int:
+        """
+        清理所有已过期的条目
+
+        Returns:
+            清理的条目数量
+        """
+        now = time.monotonic()
+        expired = [key for key, (expires_at, _) in self._entries.items() if expires_at <= now]
+        for key in expired:
+            del self._entries[key]
+
+        self.expirations += len(expired)
+        return len(expired)
+
+    def stats(self) -> Dict:
+        """获取缓存统计信息"""
+        total = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+        }
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: Hashable) -> bool:
+        entry = self._entries.get(key)
+        return entry is not None and entry[0] > time.monotonic()
+
+
+class MemoryBackend:
+    """进程内后端 - 带容量上限和TTL的内存缓存"""
+
+    def __init__(self, namespace: str, max_size: int, ttl_seconds: float):
+        self.namespace = namespace
+        self._cache = SearchCache(max_size=max_size, ttl_seconds=ttl_seconds)
+
+    async def get(self, key: str) -> Optional[Any]:
+        return self._cache.get(key)
+
+    async def set(self, key: str, value: Any):
+        self._cache.set(key, value)
+
+    async def delete(self, key: str):
+        self._cache.pop(key)
+
+    async def sweep(self) -> int:
+        return self._cache.sweep()
+
+    def stats(self) -> Dict:
+        return self._cache.stats()
+
+
+class SQLiteBackend:
+    """SQLite后端 - 多个进程共享的缓存
+
+    值以JSON保存；读取时刷新访问时间，清理时删除过期条目，
+    超出容量时按访问时间淘汰最久未使用的条目。
+    """
+
+    _connections: Dict[str, aiosqlite.Connection] = {}  # 同一进程内的后端共用连接 {path: connection}
+
+    def __init__(self, namespace: str, max_size: int, ttl_seconds: float, path: str):
+        self.namespace = namespace
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.path = path
+        self._size = 0
+
+        # 统计计数（当前进程）
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    async def _connect(self) -> aiosqlite.Connection:
+        conn = self._connections.get(self.path)
+        if conn is None:
+            conn = await aiosqlite.connect(self.path, timeout=30)
+            await conn.execute("PRAGMA journal_mode=WAL")
+            await conn.execute("PRAGMA synchronous=NORMAL")
+            await conn.execute(
+                "CREATE TABLE IF NOT EXISTS state_cache ("
+                " namespace TEXT NOT NULL,"
+                " key TEXT NOT NULL,"
+                " value TEXT NOT NULL,"
+                " expires_at REAL NOT NULL,"
+                " accessed_at REAL NOT NULL,"
+                " PRIMARY KEY (namespace, key))"
+            )
+            await conn.commit()
+            self._connections[self.path] = conn
+        return conn
+
+    async def get(self, key: str) -> Optional[Any]:
+        try:
+            return await self._get(key)
+        except Exception as e:
+            logger.error(f"读取状态缓存失败: {e}")
+            self.misses += 1
+            return None
+
+    async def set(self, key: str, value: Any):
+        try:
+            await self._set(key, value)
+        except Exception as e:
+            logger.error(f"写入状态缓存失败: {e}")
+
+    async def delete(self, key: str):
+        try:
+            await self._delete(key)
+        except Exception as e:
+            logger.error(f"删除状态缓存失败: {e}")
+
+    async def sweep(self) -> int:
+        try:
+            return await self._sweep()
+        except Exception as e:
+            logger.error(f"清理状态缓存失败: {e}")
+            return 0
+
+    async def _get(self, key: str) -> Optional[Any]:
+        conn = await self._connect()
+        now = time.time()
+        async with conn.execute(
+            "SELECT value FROM state_cache WHERE namespace = ? AND key = ? AND expires_at > ?",
+            (self.namespace, key, now)
+        ) as cursor:
+            row = await cursor.fetchone()
+
+        if row is None:
+            self.misses += 1
+            return None
+
+        await conn.execute(
+            "UPDATE state_cache SET accessed_at = ? WHERE namespace = ? AND key = ?",
+            (now, self.namespace, key)
+        )
+        await conn.commit()
+        self.hits += 1
+        return json.loads(row[0])
+
+    async def _set(self, key: str, value: Any):
+        conn = await self._connect()
+        now = time.time()
+        await conn.execute(
+            "INSERT OR REPLACE INTO state_cache (namespace, key, value, expires_at, accessed_at)"
+            " VALUES (?, ?, ?, ?, ?)",
+            (self.namespace, key, json.dumps(value, ensure_ascii=False), now + self.ttl_seconds, now)
+        )
+        await conn.commit()
+
+    async def _delete(self, key: str):
+        conn = await self._connect()
+        await conn.execute(
+            "DELETE FROM state_cache WHERE namespace = ? AND key = ?",
+            (self.namespace, key)
+        )
+        await conn.commit()
+
+    async def _sweep(self) -> int:
+        conn = await self._connect()
+        cursor = await conn.execute(
+            "DELETE FROM state_cache WHERE namespace = ? AND expires_at <= ?",
+            (self.namespace, time.time())
+        )
+        expired = cursor.rowcount
+
+        cursor = await conn.execute(
+            "DELETE FROM state_cache WHERE namespace = ? AND key IN ("
+            " SELECT key FROM state_cache WHERE namespace = ?"
+            " ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+            (self.namespace, self.namespace, self.max_size)
+        )
+        evicted = cursor.rowcount
+        await conn.commit()
+
+        async with conn.execute(
+            "SELECT COUNT(*) FROM state_cache WHERE namespace = ?", (self.namespace,)
+        ) as cursor:
+            self._size = (await cursor.fetchone())[0]
+
+        self.expirations += expired
+        self.evictions += evicted
+        return expired + evicted
+
+    def stats(self) -> Dict:
+        total = self.hits + self.misses
+        return {
+            'size': self._size,
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+        }
+
+    @classmethod
+    async def close_all(cls):
+        """关闭当前进程的所有连接"""
+        for conn in cls._connections.values():
+            try:
+                await conn.close()
+            except Exception as e:
+                logger.warning(f"关闭状态数据库失败: {e}")
+        cls._connections.clear()
+
+
+def create_backend(namespace: str, max_size: int, ttl_seconds: float):
+    """
+    按 STATE_BACKEND 配置创建后端
+
+    Args:
+        namespace: 命名空间，不同缓存互不影响
+        max_size: 最多条目数
+        ttl_seconds: 过期时间(秒)
+    """
+    if config.STATE_BACKEND == 'sqlite':
+        return SQLiteBackend(namespace, max_size, ttl_seconds, path=config.STATE_DB_PATH)
+    return MemoryBackend(namespace, max_size, ttl_seconds)
+
+
+class FileIdCache:
+    """Telegram file_id缓存类
+
+    记录已上传音频的file_id，相同来源和音质的歌曲再次请求时可以直接转发，
+    无需重新下载和上传。数据持久化在数据库中，最近使用的条目保存在状态后端中。
+    """
+
+    def __init__(self, memory_size: int, memory_ttl_seconds: float):
+        self._memory = create_backend('file_id', max_size=memory_size, ttl_seconds=memory_ttl_seconds)
+
+        # 统计计数
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, source_id: str, quality: str) -> Optional[str]:
+        """
+        查询已缓存的file_id
+
+        Args:
+            source_id: 来源ID，例如 'youtube:<video_id>'
+            quality: 音质
+
+        Returns:
+            file_id，未缓存返回None
+        """
+        key = f"{source_id}|{quality}"
+        file_id = await self._memory.get(key)
+
+        if file_id is None:
+            try:
+                async with database.AsyncSessionLocal() as session:
+                    result = await session.execute(
+                        select(AudioFileCache.file_id)
+                        .where(AudioFileCache.source_id == source_id)
+                        .where(AudioFileCache.quality == quality)
+                    )
+                    file_id = result.scalar_one_or_none()
+
+            except Exception as e:
+                logger.error(f"查询file_id缓存失败: {e}")
+
+            if file_id:
+                await self._memory.set(key, file_id)
+
+        if file_id:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return file_id
+
+    async def set(self, source_id: str, quality: str, audio):
+        """
+        保存上传后得到的file_id
+
+        Args:
+            source_id: 来源ID
+            quality: 音质
+            audio: Telegram返回的Audio对象
+        """
+        await self._memory.set(f"{source_id}|{quality}", audio.file_id)
+
+        try:
+            async with database.AsyncSessionLocal() as session:
+                result = await session.execute(
+                    select(AudioFileCache)
+                    .where(AudioFileCache.source_id == source_id)
+                    .where(AudioFileCache.quality == quality)
+                )
+                entry = result.scalar_one_or_none()
+
+                if entry:
+                    entry.file_id = audio.file_id
+                    entry.file_unique_id = audio.file_unique_id
+                    entry.file_size = audio.file_size
+                else:
+                    session.add(AudioFileCache(
+                        source_id=source_id,
+                        quality=quality,
+                        file_id=audio.file_id,
+                        file_unique_id=audio.file_unique_id,
+                        file_size=audio.file_size
+                    ))
+
+                await session.commit()
+
+        except Exception as e:
+            logger.error(f"保存file_id缓存失败: {e}")
+
+    async def delete(self, source_id: str, quality: str):
+        """删除失效的file_id"""
+        await self._memory.delete(f"{source_id}|{quality}")
+
+        try:
+            async with database.AsyncSessionLocal() as session:
+                await session.execute(
+                    delete(AudioFileCache)
+                    .where(AudioFileCache.source_id == source_id)
+                    .where(AudioFileCache.quality == quality)
+                )
+                await session.commit()
+
+        except Exception as e:
+            logger.error(f"删除file_id缓存失败: {e}")
+
+    async def sweep(self) -> int:
+        """清理状态后端中过期的条目"""
+        return await self._memory.sweep()
+
+    def stats(self) -> Dict:
+        """获取缓存统计信息"""
+        total = self.hits + self.misses
+        return {
+            'memory_size': self._memory.stats()['size'],
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+        }
+
+
+def normalize_query(query: str) -> str:
+    """
+    规范化搜索关键词：全角转半角、忽略大小写、合并空白
+
+    例如 "周杰伦　 晴天" 和 "周杰伦 晴天" 得到相同的结果
+    """
+    query = unicodedata.normalize('NFKC', query)
+    return ' '.join(query.casefold().split())
+
+
+class QueryCache:
+    """搜索关键词缓存类
+
+    位于每个聊天的搜索结果缓存之下，按规范化关键词和来源保存上游搜索结果，
+    所有用户共享并持久化在数据库中，重启后仍然有效。
+    同一关键词正在搜索时，后来的请求等待同一次搜索的结果。
+    """
+
+    def __init__(self, ttl_seconds: float, max_entries: int):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._in_flight: Dict[tuple, asyncio.Task] = {}
+
+        # 统计计数
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.upstream_calls = 0
+
+    async def get_or_fetch(
+        self,
+        source: str,
+        query: str,
+        limit: int,
+        fetch: Callable[[], Awaitable[List[Dict]]]
+    ) -> List[Dict]:
+        """
+        读取缓存的搜索结果，未命中时调用上游搜索并写入缓存
+
+        Args:
+            source: 搜索来源
+            query: 搜索关键词
+            limit: 结果数量
+            fetch: 调用上游搜索的协程函数
+
+        Returns:
+            搜索结果列表
+        """
+        key = (normalize_query(query), source, limit)
+
+        results = await self._load(key)
+        if results is not None:
+            self.hits += 1
+            return results
+
+        task = self._in_flight.get(key)
+        if task is None:
+            self.misses += 1
+            task = asyncio.ensure_future(self._fetch(key, fetch))
+            self._in_flight[key] = task
+            task.add_done_callback(lambda _: self._finished(key))
+        else:
+            self.coalesced += 1
+
+        # shield: 等待者超时或被取消时，上游搜索继续完成并写入缓存；
+        # 搜索在线程池中执行，线程无法中断，取消只会丢掉已经付出代价的结果
+        return await asyncio.shield(task)
+
+    async def peek(self, source: str, query: str, limit: int) -> Optional[List[Dict]]:
+        """只读取缓存的搜索结果，未命中返回None，不调用上游搜索"""
+        results = await self._load((normalize_query(query), source, limit))
+        if results is not None:
+            self.hits += 1
+        return results
+
+    def _finished(self, key: tuple):
+        self._in_flight.pop(key, None)
+
+    async def _fetch(self, key: tuple, fetch: Callable[[], Awaitable[List[Dict]]]) -> List[Dict]:
+        self.upstream_calls += 1
+        results = await fetch()
+
+        # 空结果可能是上游临时出错，不缓存
+        if results:
+            await self._store(key, results)
+        return results
+
+    async def _load(self, key: tuple) -> Optional[List[Dict]]:
+        query_key, source, limit = key
+        try:
+            async with database.AsyncSessionLocal() as session:
+                result = await session.execute(
+                    select(SearchResultCache.results)
+                    .where(SearchResultCache.query_key == query_key)
+                    .where(SearchResultCache.source == source)
+                    .where(SearchResultCache.result_limit == limit)
+                    .where(SearchResultCache.expires_at > datetime.utcnow())
+                )
+                results = result.scalar_one_or_none()
+
+            return json.loads(results) if results else None
+
+        except Exception as e:
+            logger.error(f"读取搜索缓存失败: {e}")
+            return None
+
+    async def _store(self, key: tuple, results: List[Dict]):
+        query_key, source, limit = key
+        now = datetime.utcnow()
+        try:
+            async with database.AsyncSessionLocal() as session:
+                result = await session.execute(
+                    select(SearchResultCache)
+                    .where(SearchResultCache.query_key == query_key)
+                    .where(SearchResultCache.source == source)
+                    .where(SearchResultCache.result_limit == limit)
+                )
+                entry = result.scalar_one_or_none()
+
+                if entry is None:
+                    entry = SearchResultCache(query_key=query_key, source=source, result_limit=limit)
+                    session.add(entry)
+
+                entry.results = json.dumps(results, ensure_ascii=False)
+                entry.created_at = now
+                entry.expires_at = now + timedelta(seconds=self.ttl_seconds)
+                await session.commit()
+
+        except Exception as e:
+            logger.error(f"保存搜索缓存失败: {e}")
+
+    async def sweep(self) -> int:
+        """
+        删除过期条目，条目数超过上限时删除最早写入的条目
+
+        Returns:
+            删除的条目数量
+        """
+        try:
+            async with database.AsyncSessionLocal() as session:
+                result = await session.execute(
+                    delete(SearchResultCache)
+                    .where(SearchResultCache.expires_at <= datetime.utcnow())
+                )
+                removed = result.rowcount
+
+                count = await session.scalar(select(func.count()).select_from(SearchResultCache))
+                if count > self.max_entries:
+                    oldest = (
+                        select(SearchResultCache.id)
+                        .order_by(SearchResultCache.created_at)
+                        .limit(count - self.max_entries)
+                    )
+                    result = await session.execute(
+                        delete(SearchResultCache).where(SearchResultCache.id.in_(oldest))
+                    )
+                    removed += result.rowcount
+
+                await session.commit()
+                return removed
+
+        except Exception as e:
+            logger.error(f"清理搜索缓存失败: {e}")
+            return 0
+
+    def stats(self) -> Dict:
+        """获取缓存统计信息"""
+        total = self.hits + self.misses + self.coalesced
+        saved = self.hits + self.coalesced
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'coalesced': self.coalesced,
+            'hit_rate': saved / total if total else 0.0,
+            'upstream_calls': self.upstream_calls,
+            'upstream_saved': saved,
+        }
+
+
+# 全局实例
+file_id_cache = FileIdCache(
+    memory_size=config.FILE_ID_CACHE_MEMORY_SIZE,
+    memory_ttl_seconds=config.FILE_ID_CACHE_MEMORY_TTL
+)
+
+query_cache = QueryCache(
+    ttl_seconds=config.QUERY_CACHE_TTL_MINUTES * 60,
+    max_entries=config.QUERY_CACHE_MAX_ENTRIES
+)
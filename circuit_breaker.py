@@ -0,0 +1,239 @@
+"""
+熔断和重试 - 后端（YouTube、Spotify）持续出错时暂停调用，等待后用单个请求试探恢复
+"""
+import asyncio
+import random
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+from loguru import logger
+import config
+from metrics import registry, BACKEND_CALLS, CIRCUIT_STATE
+
+
+class BackendUnavailable(Exception):
+    """后端处于熔断状态，请求没有发出"""
+
+    def __init__(self, backend: str, label: str, retry_in: float):
+        super().__init__(f"{label}暂时不可用，约 {max(retry_in, 1):.0f} 秒后恢复")
+        self.backend = backend
+        self.label = label
+        self.retry_in = retry_in
+
+
+def parse_retry_after(value) -> Optional[float]:
+    """解析 Retry-After 响应头（秒数），无法解析返回None"""
+    try:
+        return max(float(value), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+class CircuitBreaker:
+    """熔断器类
+
+    - closed: 正常调用，记录最近 window 次调用的结果，失败率达到 failure_rate 时打开
+    - open: 直接拒绝调用，open_seconds 秒后进入半开状态
+    - half_open: 只放行一个试探请求，成功则关闭，失败则重新打开且等待时间加倍（不超过 max_open_seconds）
+
+    classify 判断异常是否算作后端故障，并取出服务器要求的等待时间（Retry-After）：
+    例如视频不存在、参数错误等说明后端工作正常，不计入失败，也不重试。
+    后端故障时按带随机抖动的指数退避重试；服务器要求等待的时间过长时不再重试，直接打开熔断器。
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(
+        self,
+        name: str,
+        classify: Callable[[BaseException], Tuple[bool, Optional[float]]],
+        label: Optional[str] = None,
+        retries: int = config.BACKEND_RETRIES,
+        window: int = config.BREAKER_WINDOW,
+        min_calls: int = config.BREAKER_MIN_CALLS,
+        failure_rate: float = config.BREAKER_FAILURE_RATE,
+        open_seconds: float = config.BREAKER_OPEN_SECONDS,
+        max_open_seconds: float = config.BREAKER_MAX_OPEN_SECONDS,
+        base_delay: float = config.RETRY_BASE_DELAY,
+        max_delay: float = config.RETRY_MAX_DELAY
+    ):
+        self.name = name
+        self.label = label or name
+        self.classify = classify
+        self.retries = retries
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.open_seconds = open_seconds
+        self.max_open_seconds = max_open_seconds
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+        self._results = deque(maxlen=window)  # 最近的调用结果，True为成功
+        self._state = self.CLOSED
+        self._open_until = 0.0
+        self._next_open_seconds = open_seconds
+        self._probing = False
+
+        # 统计计数
+        self.successes = 0
+        self.failures = 0
+        self.rejected = 0
+        self.retried = 0
+        self.opened = 0
+
+        breakers[name] = self
+
+    @property
+    def state(self) -> str:
+        if self._state == self.OPEN and time.monotonic() >= self._open_until:
+            return self.HALF_OPEN
+        return self._state
+
+    def available(self) -> bool:
+        """现在发出的请求是否会被放行"""
+        state = self.state
+        return state == self.CLOSED or (state == self.HALF_OPEN and not self._probing)
+
+    async def call(self, func: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        通过熔断器调用后端
+
+        Args:
+            func: 发出请求的协程函数，每次重试都会重新调用
+
+        Raises:
+            BackendUnavailable: 熔断器打开
+            其他异常: 重试后仍然失败，或不属于后端故障的异常
+        """
+        attempt = 0
+        while True:
+            probe = self._acquire()
+            try:
+                result = await func()
+            except asyncio.CancelledError:
+                if probe:
+                    self._probing = False
+                raise
+            except Exception as e:
+                failure, retry_after = self.classify(e)
+                if not failure:
+                    self._record(True, probe)
+                    raise
+
+                self._record(False, probe, retry_after)
+                if attempt >= self.retries or self.state != self.CLOSED:
+                    raise
+                if retry_after is not None and retry_after > self.max_delay:
+                    raise
+
+                # 全抖动退避：避免所有请求在同一时刻重试
+                delay = retry_after if retry_after is not None else random.uniform(
+                    0, min(self.max_delay, self.base_delay * 2 ** attempt)
+                )
+                attempt += 1
+                self.retried += 1
+                BACKEND_CALLS.inc(backend=self.name, outcome='retry')
+                logger.warning(f"{self.name} 调用失败，{delay:.1f}秒后重试 ({attempt}/{self.retries}): {e}")
+                await asyncio.sleep(delay)
+            else:
+                self._record(True, probe)
+                return result
+
+    def reset(self):
+        """手动关闭熔断器"""
+        self._close()
+        logger.info(f"{self.name} 熔断器已手动关闭")
+
+    def trip(self, seconds: Optional[float] = None):
+        """手动打开熔断器"""
+        self._open(seconds or self.open_seconds)
+
+    def _acquire(self) -> bool:
+        """检查是否放行，返回这次调用是否为半开状态下的试探请求"""
+        state = self.state
+        if state == self.CLOSED:
+            return False
+
+        if state == self.HALF_OPEN and not self._probing:
+            self._probing = True
+            return True
+
+        self.rejected += 1
+        BACKEND_CALLS.inc(backend=self.name, outcome='rejected')
+        raise BackendUnavailable(self.name, self.label, self._open_until - time.monotonic())
+
+    def _record(self, ok: bool, probe: bool, retry_after: Optional[float] = None):
+        if ok:
+            self.successes += 1
+        else:
+            self.failures += 1
+        BACKEND_CALLS.inc(backend=self.name, outcome='ok' if ok else 'failure')
+
+        if probe:
+            self._probing = False
+            if ok:
+                logger.info(f"{self.name} 试探请求成功，熔断器关闭")
+                self._close()
+            else:
+                self._next_open_seconds = min(self._next_open_seconds * 2, self.max_open_seconds)
+                self._open(max(self._next_open_seconds, retry_after or 0))
+            return
+
+        if self._state != self.CLOSED:
+            return
+
+        self._results.append(ok)
+        if not ok and retry_after is not None and retry_after > self.max_delay:
+            # 服务器明确要求等待较长时间
+            self._open(min(retry_after, self.max_open_seconds))
+        elif len(self._results) >= self.min_calls and self._failure_rate() >= self.failure_rate:
+            self._open(self._next_open_seconds)
+
+    def _close(self):
+        self._state = self.CLOSED
+        self._results.clear()
+        self._next_open_seconds = self.open_seconds
+        self._probing = False
+
+    def _open(self, seconds: float):
+        self._state = self.OPEN
+        self._open_until = time.monotonic() + seconds
+        self._results.clear()
+        self.opened += 1
+        logger.warning(f"{self.name} 熔断器打开，{seconds:.0f}秒后试探恢复")
+
+    def _failure_rate(self) -> float:
+        if not self._results:
+            return 0.0
+        return self._results.count(False) / len(self._results)
+
+    def stats(self) -> Dict[str, Any]:
+        """获取统计信息"""
+        state = self.state
+        return {
+            'state': state,
+            'failure_rate': self._failure_rate(),
+            'window_calls': len(self._results),
+            'open_for': max(self._open_until - time.monotonic(), 0.0) if state == self.OPEN else 0.0,
+            'successes': self.successes,
+            'failures': self.failures,
+            'rejected': self.rejected,
+            'retried': self.retried,
+            'opened': self.opened,
+        }
+
+
+# 所有熔断器 {名称: 熔断器}，由管理命令和指标读取
+breakers: Dict[str, CircuitBreaker] = {}
+
+STATE_VALUES = {CircuitBreaker.CLOSED: 0, CircuitBreaker.HALF_OPEN: 1, CircuitBreaker.OPEN: 2}
+
+
+def _collect_metrics():
+    for name, breaker in breakers.items():
+        CIRCUIT_STATE.set(STATE_VALUES[breaker.state], backend=name)
+
+
+registry.add_collector(_collect_metrics)
@@ -2,6 +2,7 @@
 配置文件 - 加载环境变量和系统配置
 """
 import os
+import re
 from pathlib import Path
 from dotenv import load_dotenv
 
@@ -21,18 +22,119 @@ LOG_PATH.mkdir(exist_ok=True)
 TELEGRAM_BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
 if not TELEGRAM_BOT_TOKEN:
     raise ValueError("请在.env文件中设置TELEGRAM_BOT_TOKEN")
+# Bot API地址，默认使用官方服务器；可指向自建的telegram-bot-api服务器或本地测试服务器
+TELEGRAM_API_BASE_URL = os.getenv('TELEGRAM_API_BASE_URL', '').rstrip('/')
+
+# 运行模式: 'polling'（长轮询）或 'webhook'（内置HTTP服务器接收推送）
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')  # 公网地址，例如 https://bot.example.com；为空时不向Telegram注册
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8080'))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/telegram')
+WEBHOOK_SECRET_TOKEN = os.getenv('WEBHOOK_SECRET_TOKEN') or None
+WEBHOOK_HEALTH_PATH = os.getenv('WEBHOOK_HEALTH_PATH', '/healthz')
+# webhook地址对外公开，没有密钥（或沿用示例中的占位值）时任何人都能伪造更新
+if BOT_MODE == 'webhook' and (
+    not WEBHOOK_SECRET_TOKEN
+    or WEBHOOK_SECRET_TOKEN == 'change_me'
+    or not re.fullmatch(r'[A-Za-z0-9_-]{16,256}', WEBHOOK_SECRET_TOKEN)
+):
+    raise ValueError(
+        "webhook模式必须设置 WEBHOOK_SECRET_TOKEN（16-256个字母、数字、_ 或 -），可以这样生成: "
+        "python -c \"import secrets; print(secrets.token_urlsafe(32))\""
+    )
+
+# 多进程配置：WORKER_PROCESSES大于1时由前端进程接收更新，按chat_id分发给多个worker进程
+WORKER_PROCESSES = int(os.getenv('WORKER_PROCESSES', '1'))
+WORKER_QUEUE_SIZE = 1000  # 每个worker最多积压的更新数
+WORKER_SHUTDOWN_TIMEOUT = 30  # 等待worker退出的时间(秒)
+
+# 共享状态后端（搜索结果缓存、file_id缓存）: 'memory' 或 'sqlite'，多进程时默认sqlite
+STATE_BACKEND = os.getenv('STATE_BACKEND') or ('sqlite' if WORKER_PROCESSES > 1 else 'memory')
+STATE_DB_PATH = os.getenv('STATE_DB_PATH', './bot_state.db')
 
 # Spotify配置
 SPOTIFY_CLIENT_ID = os.getenv('SPOTIFY_CLIENT_ID')
 SPOTIFY_CLIENT_SECRET = os.getenv('SPOTIFY_CLIENT_SECRET')
 SPOTIFY_ENABLED = bool(SPOTIFY_CLIENT_ID and SPOTIFY_CLIENT_SECRET)
+SPOTIFY_WORKERS = int(os.getenv('SPOTIFY_WORKERS', '4'))  # Spotify请求线程数
+SPOTIFY_REQUEST_TIMEOUT = int(os.getenv('SPOTIFY_REQUEST_TIMEOUT', '5'))  # 单次HTTP请求超时(秒)
+SPOTIFY_TOKEN_REFRESH_INTERVAL = 300  # 令牌检查间隔(秒)
+SPOTIFY_API_BASE_URL = os.getenv('SPOTIFY_API_BASE_URL', '')  # 为空时使用官方API，用于本地测试
+SPOTIFY_TOKEN_URL = os.getenv('SPOTIFY_TOKEN_URL', '')
 
 # 下载限制
 MAX_FILE_SIZE_MB = int(os.getenv('MAX_FILE_SIZE_MB', '50'))
 MAX_SONG_DURATION = int(os.getenv('MAX_SONG_DURATION', '600'))
 
+# 下载调度
+DOWNLOAD_WORKERS = int(os.getenv('DOWNLOAD_WORKERS', '2'))  # 同时进行的下载/转码数
+DOWNLOADS_PER_USER = int(os.getenv('DOWNLOADS_PER_USER', '2'))  # 每个用户同时进行的下载数
+DOWNLOAD_QUEUE_SIZE = int(os.getenv('DOWNLOAD_QUEUE_SIZE', '20'))  # 最多排队的下载数
+DOWNLOAD_DIR_MAX_MB = int(os.getenv('DOWNLOAD_DIR_MAX_MB', '2048'))  # 下载目录保留已发送文件的磁盘预算(MB)
+DOWNLOAD_SWEEP_INTERVAL = int(os.getenv('DOWNLOAD_SWEEP_INTERVAL', '600'))  # 下载目录残留文件清理间隔(秒)
+SEARCH_WORKERS = int(os.getenv('SEARCH_WORKERS', '4'))  # YouTube搜索线程数
+PLAYLIST_CONCURRENCY = int(os.getenv('PLAYLIST_CONCURRENCY', '2'))  # 播放列表同时下载数（不超过每用户上限）
+PLAYLIST_MAX_TRACKS = int(os.getenv('PLAYLIST_MAX_TRACKS', '500'))  # 播放列表最多下载歌曲数
+PLAYLIST_PROGRESS_INTERVAL = 3  # 进度消息更新间隔(秒)
+PLAYLIST_RETRIES = 3  # 下载队列繁忙时的重试次数
+PLAYLIST_RETRY_DELAY = 10  # 重试间隔(秒)
+YTDL_INSTANCE_MAX_USES = int(os.getenv('YTDL_INSTANCE_MAX_USES', '200'))  # YoutubeDL实例使用多少次后重建
+PREFETCH_ENABLED = os.getenv('PREFETCH_ENABLED', 'false').lower() == 'true'  # 展示搜索结果后提前下载排名靠前的歌曲
+PREFETCH_TOP_K = int(os.getenv('PREFETCH_TOP_K', '1'))  # 每次搜索预取前几个结果
+PREFETCH_MAX_ACTIVE = int(os.getenv('PREFETCH_MAX_ACTIVE', '1'))  # 同时进行的预取数，应小于DOWNLOAD_WORKERS
+PROGRESS_EDIT_INTERVAL = float(os.getenv('PROGRESS_EDIT_INTERVAL', '3'))  # 同一聊天下载进度消息的最短编辑间隔(秒)
+PROGRESS_EDITS_PER_SECOND = float(os.getenv('PROGRESS_EDITS_PER_SECOND', '20'))  # 所有聊天合计每秒最多编辑进度消息的次数
+PROGRESS_HOOK_INTERVAL = 0.5  # 下载线程向事件循环转发进度的最短间隔(秒)
+
+# 熔断和重试（每个后端单独计算：YouTube搜索、YouTube下载、Spotify）
+BACKEND_RETRIES = int(os.getenv('BACKEND_RETRIES', '2'))  # 后端故障时的重试次数
+RETRY_BASE_DELAY = float(os.getenv('RETRY_BASE_DELAY', '0.5'))  # 第一次重试的最长等待(秒)，之后按指数增加并随机抖动
+RETRY_MAX_DELAY = float(os.getenv('RETRY_MAX_DELAY', '5'))  # 单次重试最长等待(秒)，Retry-After超过时不再重试
+BREAKER_WINDOW = int(os.getenv('BREAKER_WINDOW', '20'))  # 计算失败率的最近调用数
+BREAKER_MIN_CALLS = int(os.getenv('BREAKER_MIN_CALLS', '10'))  # 至少有多少次调用才判断失败率
+BREAKER_FAILURE_RATE = float(os.getenv('BREAKER_FAILURE_RATE', '0.5'))  # 失败率达到多少时熔断
+BREAKER_OPEN_SECONDS = float(os.getenv('BREAKER_OPEN_SECONDS', '30'))  # 熔断后多久放行试探请求(秒)
+BREAKER_MAX_OPEN_SECONDS = float(os.getenv('BREAKER_MAX_OPEN_SECONDS', '600'))  # 试探连续失败时的最长熔断时间(秒)
+
+# 出站消息限速（Telegram限制：同一聊天约每秒1条，群组每分钟20条，所有聊天合计每秒30条）
+OUTBOUND_RATE_LIMIT = os.getenv('OUTBOUND_RATE_LIMIT', 'true').lower() == 'true'  # 是否由出站调度器统一限速
+OUTBOUND_GLOBAL_RATE = float(os.getenv('OUTBOUND_GLOBAL_RATE', '30'))  # 所有聊天合计每秒请求数，多进程时平分
+OUTBOUND_CHAT_RATE = float(os.getenv('OUTBOUND_CHAT_RATE', '1'))  # 私聊每秒请求数
+OUTBOUND_GROUP_PER_MINUTE = float(os.getenv('OUTBOUND_GROUP_PER_MINUTE', '20'))  # 群组和频道每分钟请求数
+OUTBOUND_CHAT_BURST = int(os.getenv('OUTBOUND_CHAT_BURST', '3'))  # 同一聊天允许的突发请求数
+OUTBOUND_MAX_RETRIES = int(os.getenv('OUTBOUND_MAX_RETRIES', '3'))  # 遇到RetryAfter时的最大重试次数
+
+# 处理通道（更新按类型并发处理，每个通道单独限制并发数和排队数，UPDATE_LANES=false 时按顺序逐个处理）
+UPDATE_LANES = os.getenv('UPDATE_LANES', 'true').lower() == 'true'
+LANE_INTERACTIVE_CONCURRENCY = int(os.getenv('LANE_INTERACTIVE_CONCURRENCY', '16'))  # /start、/help、/history、翻页等轻量命令
+LANE_INTERACTIVE_QUEUE = int(os.getenv('LANE_INTERACTIVE_QUEUE', '500'))
+LANE_SEARCH_CONCURRENCY = int(os.getenv('LANE_SEARCH_CONCURRENCY', '32'))  # 搜索和内联查询
+LANE_SEARCH_QUEUE = int(os.getenv('LANE_SEARCH_QUEUE', '500'))
+# 点击下载，处理器等到音频发出才结束；默认能容纳所有运行和排队中的下载
+LANE_DOWNLOAD_CONCURRENCY = int(os.getenv('LANE_DOWNLOAD_CONCURRENCY', str(DOWNLOAD_WORKERS + DOWNLOAD_QUEUE_SIZE)))
+LANE_DOWNLOAD_QUEUE = int(os.getenv('LANE_DOWNLOAD_QUEUE', '200'))
+LANE_BACKGROUND_CONCURRENCY = int(os.getenv('LANE_BACKGROUND_CONCURRENCY', '4'))  # 播放列表
+LANE_BACKGROUND_QUEUE = int(os.getenv('LANE_BACKGROUND_QUEUE', '100'))
+# 推测预取匹配YouTube视频，不与可能运行数小时的播放列表共用通道；下载本身由预取器启动，不占通道
+LANE_PREFETCH_CONCURRENCY = int(os.getenv('LANE_PREFETCH_CONCURRENCY', '2'))
+LANE_PREFETCH_QUEUE = int(os.getenv('LANE_PREFETCH_QUEUE', '20'))
+
 # 数据库配置
 DATABASE_URL = os.getenv('DATABASE_URL', 'sqlite+aiosqlite:///./music_bot.db')
+DB_FLUSH_INTERVAL_MS = int(os.getenv('DB_FLUSH_INTERVAL_MS', '1000'))  # 批量写入间隔(毫秒)
+DB_FLUSH_MAX_ROWS = int(os.getenv('DB_FLUSH_MAX_ROWS', '200'))  # 积累多少条记录时立即写入
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '5'))  # 连接池保持的连接数
+DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', '10'))  # 连接池允许临时超出的连接数
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv('SQLITE_BUSY_TIMEOUT_MS', '5000'))  # 数据库被锁时的等待时间(毫秒)
+SQLITE_MMAP_SIZE_MB = int(os.getenv('SQLITE_MMAP_SIZE_MB', '256'))  # 内存映射读取的大小(MB)，0为关闭
+SQLITE_CACHE_SIZE_MB = int(os.getenv('SQLITE_CACHE_SIZE_MB', '32'))  # 每个连接的页缓存大小(MB)
+
+# 指标配置：Prometheus文本格式，METRICS_PORT为0时关闭；多进程时worker i 使用 METRICS_PORT + i
+METRICS_LISTEN = os.getenv('METRICS_LISTEN', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', '9108'))
+METRICS_PATH = os.getenv('METRICS_PATH', '/metrics')
+LOOP_LAG_INTERVAL = float(os.getenv('LOOP_LAG_INTERVAL', '0.5'))  # 事件循环延迟采样间隔(秒)
 
 # 管理员配置
 ADMIN_USER_IDS = [
@@ -47,7 +149,27 @@ LOG_FILE = os.getenv('LOG_FILE', str(LOG_PATH / 'bot.log'))
 
 # 搜索配置
 SEARCH_RESULTS_LIMIT = 5
-CACHE_EXPIRE_MINUTES = 30
+SEARCH_PAGE_SIZE = 10  # 每页显示的搜索结果数
+HISTORY_PAGE_SIZE = int(os.getenv('HISTORY_PAGE_SIZE', '10'))  # 下载历史每页显示的记录数
+RESOLVER_CANDIDATES = int(os.getenv('RESOLVER_CANDIDATES', '5'))  # Spotify歌曲匹配YouTube时的候选数
+# 匹配得分低于此值时认为YouTube上没有这首歌，不发送也不保存（满分约为1）
+RESOLVER_MIN_SCORE = float(os.getenv('RESOLVER_MIN_SCORE', '0.35'))
+YOUTUBE_SEARCH_TIMEOUT = float(os.getenv('YOUTUBE_SEARCH_TIMEOUT', '15'))  # 秒
+SPOTIFY_SEARCH_TIMEOUT = float(os.getenv('SPOTIFY_SEARCH_TIMEOUT', '10'))  # 秒
+CACHE_EXPIRE_MINUTES = int(os.getenv('CACHE_EXPIRE_MINUTES', '30'))
+SEARCH_CACHE_MAX_SIZE = int(os.getenv('SEARCH_CACHE_MAX_SIZE', '1000'))  # 最多缓存多少个聊天的搜索结果
+CACHE_SWEEP_INTERVAL = int(os.getenv('CACHE_SWEEP_INTERVAL', '60'))  # 过期清理间隔(秒)
+FILE_ID_CACHE_MEMORY_SIZE = int(os.getenv('FILE_ID_CACHE_MEMORY_SIZE', '5000'))  # 内存中保留的file_id数量
+FILE_ID_CACHE_MEMORY_TTL = 3600  # 内存中file_id的保留时间(秒)，数据库中永久保存
+QUERY_CACHE_TTL_MINUTES = int(os.getenv('QUERY_CACHE_TTL_MINUTES', '360'))  # 共享搜索缓存过期时间
+QUERY_CACHE_MAX_ENTRIES = int(os.getenv('QUERY_CACHE_MAX_ENTRIES', '10000'))  # 共享搜索缓存最多条目数
+
+# 内联查询配置（@机器人 歌曲名）
+INLINE_MIN_QUERY_LENGTH = 2  # 关键词少于几个字时不搜索
+INLINE_DEBOUNCE_MS = int(os.getenv('INLINE_DEBOUNCE_MS', '250'))  # 缓存未命中时等待输入停顿的时间(毫秒)
+INLINE_SEARCH_TIMEOUT = float(os.getenv('INLINE_SEARCH_TIMEOUT', '4'))  # 内联查询中每个来源的搜索超时(秒)
+INLINE_RESULTS_LIMIT = 10  # 最多返回的结果数
+INLINE_CACHE_TIME = int(os.getenv('INLINE_CACHE_TIME', '300'))  # Telegram缓存内联结果的时间(秒)
 
 # 按钮配置
 BUTTON_COLUMNS = 1  # 每行显示几个按钮
@@ -2,10 +2,17 @@
 数据库模型 - 存储用户信息和下载历史
 """
 from datetime import datetime
-from sqlalchemy import Column, Integer, String, DateTime, Boolean, create_engine
+from sqlalchemy import (
+    Column, Integer, String, Text, Float, DateTime, Boolean, UniqueConstraint, Index,
+    create_engine, event, inspect
+)
+from sqlalchemy.engine import make_url
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession, async_sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from loguru import logger
+import config
 
 Base = declarative_base()
 
@@ -33,7 +40,7 @@ class DownloadHistory(Base):
     __tablename__ = 'download_history'
 
     id = Column(Integer, primary_key=True)
-    user_id = Column(Integer, nullable=False, index=True)
+    user_id = Column(Integer, nullable=False)
     song_title = Column(String, nullable=False)
     artist = Column(String, nullable=True)
     source = Column(String, nullable=False)  # 'youtube' 或 'spotify'
@@ -46,6 +53,15 @@ class DownloadHistory(Base):
         return f"<DownloadHistory(user_id={self.user_id}, song={self.song_title})>"
 
 
+# 历史记录按用户筛选、按 (时间, id) 倒序翻页，复合索引同时覆盖过滤、排序和游标比较
+Index(
+    'ix_download_history_user_time_id',
+    DownloadHistory.user_id,
+    DownloadHistory.downloaded_at.desc(),
+    DownloadHistory.id.desc()
+)
+
+
 class UserPreference(Base):
     """用户偏好设置表"""
     __tablename__ = 'user_preferences'
@@ -62,29 +78,156 @@ class UserPreference(Base):
         return f"<UserPreference(user_id={self.user_id}, source={self.preferred_source})>"
 
 
+class AudioFileCache(Base):
+    """音频文件缓存表 - 记录已上传到Telegram的音频file_id"""
+    __tablename__ = 'audio_file_cache'
+    __table_args__ = (UniqueConstraint('source_id', 'quality'),)
+
+    id = Column(Integer, primary_key=True)
+    source_id = Column(String, nullable=False)  # 例如 'youtube:<video_id>'
+    quality = Column(String, nullable=False)
+    file_id = Column(String, nullable=False)
+    file_unique_id = Column(String, nullable=True)
+    file_size = Column(Integer, nullable=True)  # 字节
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    def __repr__(self):
+        return f"<AudioFileCache(source_id={self.source_id}, quality={self.quality})>"
+
+
+class SearchResultCache(Base):
+    """搜索结果缓存表 - 按规范化关键词和来源保存搜索结果，所有用户共享"""
+    __tablename__ = 'search_result_cache'
+    __table_args__ = (UniqueConstraint('query_key', 'source', 'result_limit'),)
+
+    id = Column(Integer, primary_key=True)
+    query_key = Column(String, nullable=False)  # 规范化后的搜索关键词
+    source = Column(String, nullable=False)  # 'youtube' 或 'spotify'
+    result_limit = Column(Integer, nullable=False)
+    results = Column(Text, nullable=False)  # JSON格式的结果列表
+    created_at = Column(DateTime, default=datetime.utcnow, index=True)
+    expires_at = Column(DateTime, nullable=False, index=True)
+
+    def __repr__(self):
+        return f"<SearchResultCache(query={self.query_key}, source={self.source})>"
+
+
+class SpotifyYouTubeMapping(Base):
+    """Spotify匹配表 - 记录Spotify歌曲对应的YouTube视频"""
+    __tablename__ = 'spotify_youtube_mapping'
+
+    id = Column(Integer, primary_key=True)
+    spotify_url = Column(String, unique=True, nullable=False, index=True)
+    video_id = Column(String, nullable=False)
+    title = Column(String, nullable=True)  # YouTube视频标题
+    artist = Column(String, nullable=True)  # YouTube上传者
+    duration = Column(Integer, nullable=True)  # 秒
+    score = Column(Float, nullable=True)  # 匹配得分
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    def __repr__(self):
+        return f"<SpotifyYouTubeMapping(spotify_url={self.spotify_url}, video_id={self.video_id})>"
+
+
+# 已被其他索引取代的旧索引 {表名: [索引名]}
+OBSOLETE_INDEXES = {
+    'download_history': [
+        'ix_download_history_user_id',  # 被 ix_download_history_user_time_id 覆盖
+        'ix_download_history_user_time',  # 不含id，游标翻页时需要额外排序
+    ],
+}
+
 # 异步数据库引擎
 async_engine = None
 AsyncSessionLocal = None
 
 
-async def init_db(database_url: str):
-    """初始化数据库"""
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    """每个新连接建立时设置SQLite参数"""
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")  # 读写互不阻塞
+    cursor.execute("PRAGMA synchronous=NORMAL")  # WAL模式下只在检查点时fsync
+    cursor.execute(f"PRAGMA busy_timeout={config.SQLITE_BUSY_TIMEOUT_MS}")
+    cursor.execute(f"PRAGMA mmap_size={config.SQLITE_MMAP_SIZE_MB * 1024 * 1024}")
+    cursor.execute(f"PRAGMA cache_size=-{config.SQLITE_CACHE_SIZE_MB * 1024}")  # 负数表示KB
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.close()
+
+
+def _migrate(sync_conn):
+    """
+    升级已有数据库的索引
+
+    create_all 只会为新建的表创建索引，已有的表在这里补上缺少的索引并删除过时的索引。
+    """
+    inspector = inspect(sync_conn)
+    existing_tables = set(inspector.get_table_names())
+
+    for table in Base.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            continue
+
+        existing = {index['name'] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing:
+                logger.info(f"数据库迁移: 创建索引 {index.name}")
+                index.create(sync_conn)
+
+        for name in OBSOLETE_INDEXES.get(table.name, []):
+            if name in existing:
+                logger.info(f"数据库迁移: 删除索引 {name}")
+                quoted = sync_conn.dialect.identifier_preparer.quote(name)
+                sync_conn.exec_driver_sql(f"DROP INDEX {quoted}")
+
+
+async def init_db(database_url: str, migrate: bool = True):
+    """
+    初始化数据库
+
+    Args:
+        database_url: 数据库地址
+        migrate: 是否建表并升级索引；多进程时由前端进程在启动worker之前执行一次，worker跳过
+    """
     global async_engine, AsyncSessionLocal
 
+    url = make_url(database_url)
+    is_sqlite = url.get_backend_name() == 'sqlite'
+    is_memory = is_sqlite and url.database in (None, '', ':memory:')
+
+    engine_options = {}
+    if not is_memory:
+        # aiosqlite默认每个会话新建连接，改用连接池复用连接和页缓存
+        engine_options = {
+            'poolclass': AsyncAdaptedQueuePool,
+            'pool_size': config.DB_POOL_SIZE,
+            'max_overflow': config.DB_MAX_OVERFLOW,
+            'pool_pre_ping': not is_sqlite,
+        }
+
     async_engine = create_async_engine(
         database_url,
         echo=False,
-        future=True
+        future=True,
+        **engine_options
     )
 
+    if is_sqlite:
+        event.listen(async_engine.sync_engine, 'connect', _set_sqlite_pragmas)
+
     AsyncSessionLocal = async_sessionmaker(
         async_engine,
         class_=AsyncSession,
         expire_on_commit=False
     )
 
-    # 创建所有表
+    if not migrate:
+        return
+
+    # 创建所有表，升级已有数据库的索引
     async with async_engine.begin() as conn:
+        await conn.run_sync(_migrate)
         await conn.run_sync(Base.metadata.create_all)
 
 
@@ -0,0 +1,147 @@
+"""
+下载调度器 - 限制全局和单个用户的并发下载数量
+"""
+import asyncio
+import time
+from collections import defaultdict
+from typing import Any, Awaitable, Callable, Dict, Optional
+from loguru import logger
+import config
+from metrics import DOWNLOAD_QUEUE_WAIT
+
+
+class DownloadQueueFull(Exception):
+    """下载队列已满"""
+
+
+class UserDownloadLimit(Exception):
+    """用户同时进行的下载数量超过上限"""
+
+
+class DownloadScheduler:
+    """下载调度器类
+
+    同时最多运行 workers 个下载任务，其余任务排队等待；
+    排队数量超过 max_queue 或用户的进行中任务超过 per_user_limit 时直接拒绝。
+    """
+
+    def __init__(self, workers: int, per_user_limit: int, max_queue: int):
+        self.workers = workers
+        self.per_user_limit = per_user_limit
+        self.max_queue = max_queue
+
+        self._slots = asyncio.Semaphore(workers)
+        self._waiting = []  # 排队中的任务，按进入顺序
+        self._user_jobs: Dict[int, int] = defaultdict(int)  # {user_id: 进行中和排队中的任务数}
+        self._running = 0
+        self._background = 0  # 正在运行的低优先级任务数
+
+        # 统计计数
+        self.completed = 0
+        self.rejected = 0
+        self.rejected_background = 0
+
+    async def run(
+        self,
+        user_id: int,
+        factory: Callable[[], Awaitable[Any]],
+        on_queued: Optional[Callable[[int], Awaitable[None]]] = None
+    ) -> Any:
+        """
+        在下载槽位中执行任务
+
+        Args:
+            user_id: 用户ID
+            factory: 执行下载的协程函数
+            on_queued: 需要排队时的回调，参数为排队位置（从1开始）
+
+        Returns:
+            任务结果
+
+        Raises:
+            UserDownloadLimit: 用户进行中的任务过多
+            DownloadQueueFull: 排队任务过多
+        """
+        if self._user_jobs[user_id] >= self.per_user_limit:
+            self.rejected += 1
+            raise UserDownloadLimit()
+
+        if self._slots.locked() and len(self._waiting) >= self.max_queue:
+            self.rejected += 1
+            raise DownloadQueueFull()
+
+        ticket = object()
+        enqueued_at = time.perf_counter()
+        self._waiting.append(ticket)
+        self._user_jobs[user_id] += 1
+
+        try:
+            if self._slots.locked() and on_queued:
+                try:
+                    await on_queued(self._waiting.index(ticket) + 1)
+                except Exception as e:
+                    logger.warning(f"通知排队位置失败: {e}")
+
+            async with self._slots:
+                DOWNLOAD_QUEUE_WAIT.observe(time.perf_counter() - enqueued_at)
+                self._waiting.remove(ticket)
+                self._running += 1
+                try:
+                    return await factory()
+                finally:
+                    self._running -= 1
+                    self.completed += 1
+
+        finally:
+            if ticket in self._waiting:
+                self._waiting.remove(ticket)
+
+            self._user_jobs[user_id] -= 1
+            if not self._user_jobs[user_id]:
+                del self._user_jobs[user_id]
+
+    def idle(self) -> bool:
+        """是否有空闲的下载槽位且没有排队的任务"""
+        return not self._slots.locked() and not self._waiting
+
+    async def run_background(self, factory: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        以低优先级执行任务（例如预取）：只使用空闲的槽位，不排队，不计入用户的任务数
+
+        Raises:
+            DownloadQueueFull: 没有空闲的槽位
+        """
+        if not self.idle():
+            self.rejected_background += 1
+            raise DownloadQueueFull()
+
+        async with self._slots:
+            self._running += 1
+            self._background += 1
+            try:
+                return await factory()
+            finally:
+                self._running -= 1
+                self._background -= 1
+                self.completed += 1
+
+    def stats(self) -> Dict:
+        """获取调度统计信息"""
+        return {
+            'workers': self.workers,
+            'running': self._running,
+            'background': self._background,
+            'queued': len(self._waiting),
+            'max_queue': self.max_queue,
+            'completed': self.completed,
+            'rejected': self.rejected,
+            'rejected_background': self.rejected_background,
+        }
+
+
+# 全局实例
+download_scheduler = DownloadScheduler(
+    workers=config.DOWNLOAD_WORKERS,
+    per_user_limit=config.DOWNLOADS_PER_USER,
+    max_queue=config.DOWNLOAD_QUEUE_SIZE
+)
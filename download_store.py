@@ -0,0 +1,300 @@
+"""
+下载目录管理 - 每个下载任务使用独立的临时目录，发送过的文件按磁盘预算保留
+"""
+import hashlib
+import os
+import re
+import shutil
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Optional
+from loguru import logger
+import config
+
+# 旧版本直接保存在下载目录中的文件：{user_id}_标题.扩展名，以及yt-dlp下载中途留下的文件
+LEGACY_AUDIO_RE = re.compile(r'^\d+_.+\.(mp3|m4a|aac|opus|ogg|webm|wav|flac)$', re.IGNORECASE)
+LEGACY_PARTIAL_SUFFIXES = ('.part', '.ytdl')
+
+
+class DownloadStore:
+    """下载目录管理类
+
+    目录结构：
+        jobs/<pid>-<随机串>/      下载中的任务，失败或进程退出后整个目录被删除
+        hot-<pid>/<键的哈希>/     下载完成的文件，按最近使用顺序保留，总大小超过 max_bytes 时淘汰最久未用的
+
+    正在发送的文件会被引用计数锁定，不会被淘汰。
+    多进程时每个进程只管理自己pid下的目录，已退出进程留下的目录在清理时删除。
+    """
+
+    def __init__(self, root: Path, max_bytes: int):
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+        self.jobs_dir = self.root / 'jobs'
+        self.hot_dir = self.root / f'hot-{os.getpid()}'
+
+        self._files: OrderedDict = OrderedDict()  # {键的哈希: (文件路径, 字节数)}，按最近使用排序
+        self._pins: Dict[Path, int] = {}  # {文件路径: 正在使用的请求数}
+        self._active_jobs = set()
+        self._used = 0
+
+        # 统计计数
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.orphans_removed = 0
+
+    @contextmanager
+    def job(self):
+        """
+        创建一个下载任务的临时目录
+
+        出错时立即删除目录；正常结束后目录保留到 commit 或 discard，期间不会被清理。
+
+        Yields:
+            临时目录路径
+        """
+        job_dir = self.jobs_dir / f"{os.getpid()}-{uuid.uuid4().hex}"
+        job_dir.mkdir(parents=True)
+        self._active_jobs.add(job_dir)
+        try:
+            yield job_dir
+        except BaseException:
+            self.discard(job_dir)
+            raise
+
+    def discard(self, job_dir: Path):
+        """删除没有产生有效文件的任务目录"""
+        self._active_jobs.discard(job_dir)
+        self._remove(job_dir)
+
+    def get(self, key: str) -> Optional[Path]:
+        """
+        获取热缓存中的文件，返回的文件被锁定直到调用 release
+
+        Args:
+            key: 缓存键，例如 'youtube:<video_id>|high'
+
+        Returns:
+            文件路径，不存在返回None
+        """
+        digest = self._digest(key)
+        entry = self._files.get(digest)
+        if entry is None or not entry[0].exists():
+            if entry is not None:
+                self._forget(digest)
+            self.misses += 1
+            return None
+
+        self._files.move_to_end(digest)
+        self.hits += 1
+        return self._pin(entry[0])
+
+    def commit(self, key: str, file_path: Path) -> Path:
+        """
+        把下载完成的文件移入热缓存并删除任务目录，返回的文件被锁定直到调用 release
+
+        Args:
+            key: 缓存键
+            file_path: 任务目录中的文件
+
+        Returns:
+            热缓存中的文件路径
+        """
+        digest = self._digest(key)
+        target_dir = self.hot_dir / digest
+        target_dir.mkdir(parents=True, exist_ok=True)
+        target = target_dir / file_path.name
+
+        old = self._files.get(digest)
+        self._forget(digest)
+        if old and old[0] != target and old[0] not in self._pins:
+            old[0].unlink(missing_ok=True)
+
+        os.replace(file_path, target)
+        self.discard(file_path.parent)
+
+        size = target.stat().st_size
+        self._files[digest] = (target, size)
+        self._used += size
+        self._pin(target)
+        self._enforce_budget()
+        return target
+
+    def release(self, file_path: Optional[Path]):
+        """发送完成后解除锁定，不在热缓存中的文件直接删除"""
+        if not file_path:
+            return
+
+        count = self._pins.get(file_path, 0) - 1
+        if count > 0:
+            self._pins[file_path] = count
+            return
+        self._pins.pop(file_path, None)
+
+        if not self._is_hot(file_path):
+            # 已被淘汰或替换的文件，目录中可能已有同一个键的新文件
+            file_path.unlink(missing_ok=True)
+            self._remove_if_empty(file_path.parent)
+        self._enforce_budget()
+
+    def sweep(self) -> int:
+        """
+        清理残留文件并按预算淘汰
+
+        删除已退出进程和本进程不再使用的任务目录、已退出进程的热缓存目录，
+        以及旧版本直接保存在下载目录中的音频和未完成文件，其他文件不会被删除。
+        下载目录是当前工作目录或它的上级目录时（配置错误）不做任何清理。
+
+        Returns:
+            删除的文件和目录数
+        """
+        if self._unsafe_root():
+            logger.error(f"下载目录 {self.root} 是工作目录或它的上级目录，拒绝清理，请检查 DOWNLOAD_PATH")
+            return 0
+
+        removed = 0
+        my_pid = os.getpid()
+
+        if self.jobs_dir.exists():
+            for job_dir in self.jobs_dir.iterdir():
+                pid = self._owner_pid(job_dir.name.split('-', 1)[0])
+                if pid == my_pid and job_dir in self._active_jobs:
+                    continue
+                if pid != my_pid and self._pid_alive(pid):
+                    continue
+                self._remove(job_dir)
+                removed += 1
+
+        if self.root.exists():
+            for path in self.root.iterdir():
+                if path in (self.jobs_dir, self.hot_dir):
+                    continue
+                if path.is_dir():
+                    if not path.name.startswith('hot-') or self._pid_alive(self._owner_pid(path.name[len('hot-'):])):
+                        continue
+                elif not self._is_legacy_file(path.name):
+                    continue
+                self._remove(path)
+                removed += 1
+
+        # 热缓存中没有登记的文件（例如移动到一半时出错）
+        if self.hot_dir.exists():
+            for entry_dir in self.hot_dir.iterdir():
+                if not entry_dir.is_dir():
+                    self._remove(entry_dir)
+                    removed += 1
+                    continue
+
+                for path in entry_dir.iterdir():
+                    if not self._is_hot(path) and path not in self._pins:
+                        self._remove(path)
+                        removed += 1
+                self._remove_if_empty(entry_dir)
+
+        self.orphans_removed += removed
+        self._enforce_budget()
+        return removed
+
+    def _enforce_budget(self):
+        """总大小超过预算时淘汰最久未用且没有被锁定的文件"""
+        if self._used <= self.max_bytes:
+            return
+
+        for digest in list(self._files):
+            if self._used <= self.max_bytes:
+                break
+
+            file_path = self._files[digest][0]
+            if file_path in self._pins:
+                continue
+
+            self._forget(digest)
+            file_path.unlink(missing_ok=True)
+            self._remove_if_empty(file_path.parent)
+            self.evictions += 1
+
+    def _pin(self, file_path: Path) -> Path:
+        self._pins[file_path] = self._pins.get(file_path, 0) + 1
+        return file_path
+
+    def _forget(self, digest: str):
+        entry = self._files.pop(digest, None)
+        if entry:
+            self._used -= entry[1]
+
+    def _is_hot(self, file_path: Path) -> bool:
+        entry = self._files.get(file_path.parent.name)
+        return entry is not None and entry[0] == file_path
+
+    def _unsafe_root(self) -> bool:
+        """下载目录是否为工作目录或它的上级目录"""
+        root = self.root.resolve()
+        cwd = Path.cwd().resolve()
+        return root == cwd or root in cwd.parents
+
+    @staticmethod
+    def _is_legacy_file(name: str) -> bool:
+        return bool(LEGACY_AUDIO_RE.match(name)) or name.endswith(LEGACY_PARTIAL_SUFFIXES)
+
+    @staticmethod
+    def _digest(key: str) -> str:
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()[:20]
+
+    @staticmethod
+    def _owner_pid(value: str) -> Optional[int]:
+        return int(value) if value.isdigit() else None
+
+    @staticmethod
+    def _pid_alive(pid: Optional[int]) -> bool:
+        if not pid:
+            return False
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            return True
+        return True
+
+    @staticmethod
+    def _remove_if_empty(path: Path):
+        try:
+            path.rmdir()
+        except OSError:
+            pass
+
+    @staticmethod
+    def _remove(path: Path):
+        try:
+            if path.is_dir():
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                path.unlink(missing_ok=True)
+        except OSError as e:
+            logger.warning(f"删除下载文件失败 {path}: {e}")
+
+    def stats(self) -> Dict:
+        """获取磁盘使用统计信息"""
+        total = self.hits + self.misses
+        return {
+            'files': len(self._files),
+            'used_bytes': self._used,
+            'max_bytes': self.max_bytes,
+            'pinned': len(self._pins),
+            'active_jobs': len(self._active_jobs),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+            'evictions': self.evictions,
+            'orphans_removed': self.orphans_removed,
+        }
+
+
+# 全局实例，多进程时各进程平分磁盘预算
+download_store = DownloadStore(
+    root=config.DOWNLOAD_PATH,
+    max_bytes=config.DOWNLOAD_DIR_MAX_MB * 1024 * 1024 // max(1, config.WORKER_PROCESSES)
+)
@@ -0,0 +1,145 @@
+"""
+处理通道 - 按工作类型把更新和后台任务分到不同通道，每个通道有自己的并发数和排队上限
+"""
+import asyncio
+import contextvars
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional
+from telegram.ext import BaseUpdateProcessor
+from loguru import logger
+import config
+from metrics import LANE_WAIT
+
+# 通道名称
+INTERACTIVE = 'interactive'  # 只读数据库或内存的轻量命令：/start、/help、/history、翻页等
+SEARCH = 'search'  # 搜索和内联查询
+DOWNLOAD = 'download'  # 点击下载，处理器一直等到音频发出
+BACKGROUND = 'background'  # 播放列表等长时间运行的后台任务
+PREFETCH = 'prefetch'  # 推测预取时匹配YouTube视频，下载由预取器启动，不占通道
+
+# 当前代码所在的通道，出站调度器据此让交互命令的回复优先发送
+current_lane: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar('current_lane', default=None)
+
+
+class LaneFull(Exception):
+    """通道排队已满"""
+
+    def __init__(self, lane: str):
+        super().__init__(f"{lane} 通道排队已满")
+        self.lane = lane
+
+
+class Lane:
+    """处理通道类
+
+    同时最多运行 concurrency 个任务，其余排队；排队数量达到 max_queue 时直接拒绝。
+    """
+
+    def __init__(self, name: str, concurrency: int, max_queue: int):
+        self.name = name
+        self.concurrency = concurrency
+        self.max_queue = max_queue
+        self._slots = asyncio.Semaphore(concurrency)
+        self._queued = 0
+        self._running = 0
+
+        # 统计计数
+        self.completed = 0
+        self.rejected = 0
+
+    def busy(self) -> bool:
+        """新任务是否需要排队"""
+        return self._slots.locked()
+
+    def full(self) -> bool:
+        """新任务是否会被拒绝"""
+        return self._slots.locked() and self._queued >= self.max_queue
+
+    async def run(self, coroutine: Awaitable[Any]) -> Any:
+        """
+        在通道中执行协程
+
+        Raises:
+            LaneFull: 排队已满，协程不会执行
+        """
+        if self.full():
+            coroutine.close()
+            self.rejected += 1
+            raise LaneFull(self.name)
+
+        enqueued_at = time.perf_counter()
+        self._queued += 1
+        try:
+            await self._slots.acquire()
+        except BaseException:
+            coroutine.close()
+            raise
+        finally:
+            self._queued -= 1
+
+        LANE_WAIT.observe(time.perf_counter() - enqueued_at, lane=self.name)
+        self._running += 1
+        token = current_lane.set(self.name)
+        try:
+            return await coroutine
+        finally:
+            current_lane.reset(token)
+            self._running -= 1
+            self.completed += 1
+            self._slots.release()
+
+    def stats(self) -> Dict[str, Any]:
+        """获取统计信息"""
+        return {
+            'running': self._running,
+            'queued': self._queued,
+            'concurrency': self.concurrency,
+            'max_queue': self.max_queue,
+            'completed': self.completed,
+            'rejected': self.rejected,
+        }
+
+
+class LaneUpdateProcessor(BaseUpdateProcessor):
+    """按通道并发处理更新
+
+    作为 python-telegram-bot 的 update processor：每个更新由 classify 分到一个通道，
+    在该通道的并发数内运行，所以大量下载不会让 /help 之类的命令排在后面。
+    通道排队已满时调用 on_rejected 告诉用户稍后再试。
+    """
+
+    def __init__(self, lanes: Dict[str, Lane], classify: Callable[[object], str],
+                 on_rejected: Callable[[object, str], Awaitable[None]]):
+        # 基类在进入通道之前先取全局信号量，上限必须包括各通道排队中的更新，
+        # 否则排队等下载的更新会占满全局名额，挡住其他通道
+        super().__init__(sum(lane.concurrency + lane.max_queue for lane in lanes.values()))
+        self.lanes = lanes
+        self.classify = classify
+        self.on_rejected = on_rejected
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        lane = self.lanes[self.classify(update)]
+        try:
+            await lane.run(coroutine)
+        except LaneFull:
+            logger.warning(f"{lane.name} 通道排队已满，拒绝更新")
+            try:
+                await self.on_rejected(update, lane.name)
+            except Exception as e:
+                logger.debug(f"通知用户失败: {e}")
+
+
+# 全局实例
+lanes = {
+    INTERACTIVE: Lane(INTERACTIVE, config.LANE_INTERACTIVE_CONCURRENCY, config.LANE_INTERACTIVE_QUEUE),
+    SEARCH: Lane(SEARCH, config.LANE_SEARCH_CONCURRENCY, config.LANE_SEARCH_QUEUE),
+    DOWNLOAD: Lane(DOWNLOAD, config.LANE_DOWNLOAD_CONCURRENCY, config.LANE_DOWNLOAD_QUEUE),
+    BACKGROUND: Lane(BACKGROUND, config.LANE_BACKGROUND_CONCURRENCY, config.LANE_BACKGROUND_QUEUE),
+    PREFETCH: Lane(PREFETCH, config.LANE_PREFETCH_CONCURRENCY, config.LANE_PREFETCH_QUEUE),
+}
@@ -0,0 +1,329 @@
+"""
+运行指标 - 计数器、直方图和仪表盘，以Prometheus文本格式通过HTTP提供
+"""
+import asyncio
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Tuple
+from aiohttp import web
+from loguru import logger
+import config
+
+
+# 默认的耗时分桶（秒）
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple, extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """指标基类，按标签值分别记录"""
+
+    kind = 'untyped'
+
+    def __init__(self, name: str, help_text: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(labels)
+
+    def _key(self, labels: Dict) -> Tuple:
+        return tuple(labels.get(name, '') for name in self.label_names)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self._samples())
+        return lines
+
+    def _samples(self) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    """只增不减的计数器"""
+
+    kind = 'counter'
+
+    def __init__(self, name: str, help_text: str, labels: Tuple[str, ...] = ()):
+        super().__init__(name, help_text, labels)
+        self._values: Dict[Tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def set(self, value: float, **labels):
+        """同步其他模块自己维护的累计值（在采集时调用）"""
+        self._values[self._key(labels)] = value
+
+    def _samples(self) -> List[str]:
+        return [
+            f"{self.name}{_format_labels(self.label_names, key)} {_format_value(value)}"
+            for key, value in self._values.items()
+        ]
+
+
+class Gauge(Counter):
+    """可增可减的当前值"""
+
+    kind = 'gauge'
+
+
+class Histogram(Metric):
+    """分桶统计的分布，例如耗时"""
+
+    kind = 'histogram'
+
+    def __init__(self, name: str, help_text: str, labels: Tuple[str, ...] = (), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(sorted(buckets))
+        self._values: Dict[Tuple, list] = {}  # {标签值: [各桶计数..., 总和, 次数]}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        entry = self._values.get(key)
+        if entry is None:
+            entry = self._values[key] = [0] * (len(self.buckets) + 2)
+
+        index = bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            entry[index] += 1
+        entry[-2] += value
+        entry[-1] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """记录 with 代码块的耗时"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _samples(self) -> List[str]:
+        lines = []
+        for key, entry in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, entry):
+                cumulative += count
+                le = f'le="{_format_value(float(bound))}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.label_names, key, le)} {cumulative}")
+            inf = 'le="+Inf"'
+            lines.append(f"{self.name}_bucket{_format_labels(self.label_names, key, inf)} {entry[-1]}")
+            lines.append(f"{self.name}_sum{_format_labels(self.label_names, key)} {_format_value(float(entry[-2]))}")
+            lines.append(f"{self.name}_count{_format_labels(self.label_names, key)} {entry[-1]}")
+        return lines
+
+
+class Registry:
+    """指标注册表
+
+    指标只在事件循环中更新，不加锁。其他模块已有的统计（缓存命中等）通过采集函数
+    在每次抓取时读取，平时没有额外开销。
+    """
+
+    def __init__(self):
+        self._metrics: List[Metric] = []
+        self._collectors: List[Callable[[], None]] = []
+
+    def counter(self, name: str, help_text: str, labels: Tuple[str, ...] = ()) -> Counter:
+        return self._register(Counter(name, help_text, labels))
+
+    def gauge(self, name: str, help_text: str, labels: Tuple[str, ...] = ()) -> Gauge:
+        return self._register(Gauge(name, help_text, labels))
+
+    def histogram(self, name: str, help_text: str, labels: Tuple[str, ...] = (), buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, help_text, labels, buckets))
+
+    def add_collector(self, collector: Callable[[], None]):
+        """注册采集函数，每次抓取前调用，用于把其他模块的统计写入指标"""
+        self._collectors.append(collector)
+
+    def _register(self, metric: Metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        """生成Prometheus文本格式"""
+        for collector in self._collectors:
+            try:
+                collector()
+            except Exception as e:
+                logger.warning(f"采集指标失败: {e}")
+
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+class LoopLagMonitor:
+    """事件循环延迟监控
+
+    每隔 interval 秒休眠一次，实际醒来时间比预期晚的部分就是事件循环被阻塞的时间。
+    """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, loop.time() - expected)
+            LOOP_LAG.observe(lag)
+            LOOP_LAG_LAST.set(lag)
+
+
+class MetricsServer:
+    """指标HTTP服务器类
+
+    GET {path} 返回Prometheus文本格式的指标。
+    """
+
+    def __init__(self, listen: str, port: int, path: str = '/metrics'):
+        self.listen = listen
+        self.port = port
+        self.path = path
+        self._runner = None
+
+    async def start(self):
+        """启动HTTP服务器"""
+        web_app = web.Application()
+        web_app.router.add_get(self.path, self._handle_metrics)
+
+        self._runner = web.AppRunner(web_app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.listen, self.port).start()
+        logger.info(f"指标服务器已启动: http://{self.listen}:{self.port}{self.path}")
+
+    async def stop(self):
+        """停止HTTP服务器"""
+        if self._runner:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def _handle_metrics(self, request: web.Request) -> web.Response:
+        return web.Response(
+            text=registry.render(),
+            headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+        )
+
+
+# 全局注册表
+registry = Registry()
+
+# 搜索
+SEARCH_DURATION = registry.histogram(
+    'bot_search_duration_seconds', '各来源搜索耗时（含共享缓存命中）', ('source', 'outcome')
+)
+SEARCH_RESULTS = registry.counter(
+    'bot_search_results_total', '各来源返回的搜索结果数', ('source',)
+)
+
+# 下载
+DOWNLOAD_QUEUE_WAIT = registry.histogram(
+    'bot_download_queue_wait_seconds', '下载任务等待调度槽位的时间'
+)
+DOWNLOAD_DURATION = registry.histogram(
+    'bot_download_duration_seconds', 'yt-dlp下载耗时（不含转码）', ('quality',)
+)
+TRANSCODE_DURATION = registry.histogram(
+    'bot_transcode_duration_seconds', 'FFmpeg转码/封装耗时', ('quality',)
+)
+DOWNLOADS = registry.counter(
+    'bot_downloads_total', '下载任务数', ('quality', 'outcome')
+)
+DOWNLOAD_BYTES = registry.counter(
+    'bot_download_bytes_total', '下载得到的音频文件总字节数', ('quality',)
+)
+
+# 后端调用（熔断器）
+BACKEND_CALLS = registry.counter(
+    'bot_backend_calls_total', '经过熔断器的后端调用（ok/failure/retry/rejected）', ('backend', 'outcome')
+)
+CIRCUIT_STATE = registry.gauge(
+    'bot_circuit_breaker_state', '熔断器状态（0关闭 1半开 2打开）', ('backend',)
+)
+
+# 推测预取
+PREFETCHES = registry.counter(
+    'bot_prefetch_total', '推测预取任务数（started/hit/wasted/cancelled/skipped/failed）', ('outcome',)
+)
+PREFETCH_WASTED_BYTES = registry.counter(
+    'bot_prefetch_wasted_bytes_total', '预取下载后没有被点击的字节数'
+)
+
+# 内联查询
+INLINE_ANSWER_DURATION = registry.histogram(
+    'bot_inline_answer_duration_seconds', '内联查询从收到到回答的耗时', ('path',),
+    buckets=(0.01, 0.025, 0.05, 0.1, 0.2, 0.3, 0.5, 1, 2.5, 5, 10)
+)
+
+# 出站消息
+OUTBOUND_WAIT = registry.histogram(
+    'bot_outbound_wait_seconds', '发往聊天的请求等待限速令牌的时间', ('priority',)
+)
+OUTBOUND_REQUESTS = registry.counter(
+    'bot_outbound_requests_total', '出站调度器处理的请求（sent/coalesced/retry_after）', ('outcome',)
+)
+
+# 处理通道
+LANE_WAIT = registry.histogram(
+    'bot_lane_wait_seconds', '更新和后台任务在处理通道中排队的时间', ('lane',)
+)
+
+# 上传
+UPLOAD_DURATION = registry.histogram(
+    'bot_upload_duration_seconds', '发送音频到Telegram的耗时', ('kind',)
+)
+
+# 数据库
+DB_DURATION = registry.histogram(
+    'bot_db_operation_duration_seconds', '数据库操作耗时', ('operation',)
+)
+
+# 缓存和其他模块的统计，抓取时由采集函数写入
+CACHE_HITS = registry.counter('bot_cache_hits_total', '缓存命中次数', ('cache',))
+CACHE_MISSES = registry.counter('bot_cache_misses_total', '缓存未命中次数', ('cache',))
+CACHE_ENTRIES = registry.gauge('bot_cache_entries', '缓存中的条目数', ('cache',))
+COMPONENT_STATS = registry.gauge('bot_component_stat', '各组件的内部统计值', ('component', 'stat'))
+
+# 事件循环
+LOOP_LAG = registry.histogram(
+    'bot_event_loop_lag_seconds', '事件循环的调度延迟',
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+)
+LOOP_LAG_LAST = registry.gauge('bot_event_loop_lag_last_seconds', '最近一次测得的事件循环延迟')
+
+loop_lag_monitor = LoopLagMonitor(interval=config.LOOP_LAG_INTERVAL)
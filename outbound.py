@@ -0,0 +1,295 @@
+"""
+出站消息调度 - 按Telegram的频率限制发送Bot API请求，处理RetryAfter，合并同一条消息的编辑
+"""
+import asyncio
+import heapq
+import itertools
+import time
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional, Tuple
+from telegram.error import RetryAfter, TimedOut
+from telegram.ext import BaseRateLimiter
+from loguru import logger
+import config
+from lanes import current_lane, INTERACTIVE
+from metrics import OUTBOUND_WAIT, OUTBOUND_REQUESTS
+
+# 优先级，数字越小越先获得令牌；交互通道（/help、/history等）中发出的请求最先发送
+PRIORITY_INTERACTIVE = 0
+PRIORITY_AUDIO = 1
+PRIORITY_MESSAGE = 2
+PRIORITY_EDIT = 3
+
+PRIORITY_NAMES = {
+    PRIORITY_INTERACTIVE: 'interactive', PRIORITY_AUDIO: 'audio', PRIORITY_MESSAGE: 'message', PRIORITY_EDIT: 'edit'
+}
+
+ENDPOINT_PRIORITIES = {
+    'sendAudio': PRIORITY_AUDIO,
+    'editMessageText': PRIORITY_EDIT,
+    'editMessageReplyMarkup': PRIORITY_EDIT,
+}
+
+_sequence = itertools.count()
+
+
+class TokenBucket:
+    """令牌桶，等待中的请求按优先级（同优先级按先后）获得令牌"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.paused_until = 0.0
+        self._updated = time.monotonic()
+        self._waiters: List[Tuple[int, int, asyncio.Future]] = []  # 堆 (优先级, 序号, future)
+        self._timer: Optional[asyncio.TimerHandle] = None
+
+    def waiting(self) -> int:
+        return sum(1 for _, _, future in self._waiters if not future.done())
+
+    def idle(self) -> bool:
+        """没有等待的请求，令牌已满且没有暂停，可以丢弃"""
+        now = time.monotonic()
+        self._refill(now)
+        return not self._waiters and self.tokens >= self.capacity and self.paused_until <= now
+
+    def pause(self, seconds: float):
+        """Telegram要求等待时暂停发放令牌，恢复后按速率重新积累，不再立即突发"""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0.0
+        self._updated = self.paused_until
+
+    async def acquire(self, priority: int):
+        now = time.monotonic()
+        self._refill(now)
+        if not self._waiters and now >= self.paused_until and self.tokens >= 1:
+            self.tokens -= 1
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(_sequence), future))
+        self._wake()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # 令牌已经分配但请求被取消，归还给下一个请求
+                self.tokens += 1
+                self._wake()
+            raise
+
+    def _refill(self, now: float):
+        if now > self._updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+            self._updated = now
+
+    def _wake(self):
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+
+        now = time.monotonic()
+        self._refill(now)
+        while self._waiters:
+            future = self._waiters[0][2]
+            if future.done():
+                # 等待的请求已取消
+                heapq.heappop(self._waiters)
+                continue
+            if now < self.paused_until or self.tokens < 1:
+                break
+            heapq.heappop(self._waiters)
+            self.tokens -= 1
+            future.set_result(None)
+
+        if self._waiters:
+            delay = max(self.paused_until - now, 0.0) + max((1 - self.tokens) / self.rate, 0.0)
+            self._timer = asyncio.get_running_loop().call_later(delay, self._wake)
+
+
+class PendingEdit:
+    """还没发出的消息编辑，之后的编辑直接替换内容"""
+
+    def __init__(self, args, kwargs):
+        self.args = args
+        self.kwargs = kwargs
+        self.result = asyncio.get_running_loop().create_future()
+        self.merged = 0  # 合并进来、等待结果的调用数
+
+
+class OutboundScheduler(BaseRateLimiter):
+    """出站请求调度器
+
+    作为 python-telegram-bot 的 rate_limiter，所有Bot API请求都经过这里：
+
+    - 发往聊天的请求先取该聊天的令牌，再取全局令牌：私聊每秒 chat_rate 条，
+      群组和频道每分钟 group_per_minute 条，所有聊天合计每秒 global_rate 条
+    - 等待令牌时交互命令的回复最先发送，其次是音频、普通消息，编辑最后
+    - 同一条消息还没发出的多次 editMessageText 只发送最新的一次，被合并的调用返回同一个结果
+    - 遇到RetryAfter时暂停该聊天（不属于聊天的请求只等待自己）指定的时间后重试，最多 max_retries 次
+    - 回调查询和内联查询的回答等不发往聊天的请求不排队
+    """
+
+    def __init__(self, global_rate: float, chat_rate: float, group_per_minute: float,
+                 burst: int, max_retries: int):
+        self.chat_rate = chat_rate
+        self.group_rate = group_per_minute / 60
+        self.burst = max(burst, 1)
+        self.max_retries = max_retries
+        self._global = TokenBucket(global_rate, max(global_rate, 1))
+        self._chats: Dict[Hashable, TokenBucket] = {}
+        self._edits: Dict[Tuple[Hashable, Any], PendingEdit] = {}
+
+        # 统计计数
+        self.sent = 0
+        self.coalesced = 0
+        self.retry_after = 0
+        self.failed = 0
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    async def process_request(self, callback: Callable[..., Awaitable[Any]], args: Any, kwargs: Dict[str, Any],
+                              endpoint: str, data: Dict[str, Any], rate_limit_args: Optional[Any]) -> Any:
+        chat_id = data.get('chat_id')
+        if current_lane.get() == INTERACTIVE:
+            priority = PRIORITY_INTERACTIVE
+        else:
+            priority = ENDPOINT_PRIORITIES.get(endpoint, PRIORITY_MESSAGE)
+
+        if chat_id is not None and endpoint == 'editMessageText' and data.get('message_id') is not None:
+            return await self._edit(callback, args, kwargs, chat_id, data['message_id'], priority)
+        return await self._send(chat_id, priority, lambda: callback(*args, **kwargs))
+
+    async def _send(self, chat_id: Optional[Hashable], priority: int,
+                    request: Callable[[], Awaitable[Any]]) -> Any:
+        """取得令牌后发送，遇到RetryAfter时等待并重试"""
+        attempt = 0
+        while True:
+            if chat_id is not None:
+                started = time.monotonic()
+                await self._bucket(chat_id).acquire(priority)
+                await self._global.acquire(priority)
+                OUTBOUND_WAIT.observe(time.monotonic() - started, priority=PRIORITY_NAMES[priority])
+
+            try:
+                result = await request()
+            except RetryAfter as e:
+                self.retry_after += 1
+                OUTBOUND_REQUESTS.inc(outcome='retry_after')
+                if attempt >= self.max_retries:
+                    self.failed += 1
+                    raise
+
+                attempt += 1
+                logger.warning(
+                    f"Telegram限流，{'聊天 ' + str(chat_id) if chat_id is not None else '请求'} "
+                    f"等待 {e.retry_after} 秒后重试 ({attempt}/{self.max_retries})"
+                )
+                if chat_id is None:
+                    await asyncio.sleep(e.retry_after)
+                else:
+                    self._bucket(chat_id).pause(e.retry_after)
+            else:
+                self.sent += 1
+                OUTBOUND_REQUESTS.inc(outcome='sent')
+                return result
+
+    async def _edit(self, callback, args, kwargs, chat_id: Hashable, message_id, priority: int) -> Any:
+        """编辑消息，同一条消息还在排队的编辑合并为最新的一次"""
+        key = (chat_id, message_id)
+        pending = self._edits.get(key)
+        if pending is not None:
+            pending.args, pending.kwargs = args, kwargs
+            pending.merged += 1
+            self.coalesced += 1
+            OUTBOUND_REQUESTS.inc(outcome='coalesced')
+            return await asyncio.shield(pending.result)
+
+        pending = PendingEdit(args, kwargs)
+        self._edits[key] = pending
+        return await self._deliver_edit(key, pending, callback, priority)
+
+    async def _deliver_edit(self, key: Tuple[Hashable, Any], pending: PendingEdit, callback, priority: int) -> Any:
+        try:
+            result = await self._send(key[0], priority, lambda: self._take_edit(key, pending, callback))
+        except asyncio.CancelledError:
+            if self._edits.get(key) is pending and pending.merged:
+                # 发起的调用被取消，还有其他调用在等待这次编辑，交给后台任务继续发送
+                asyncio.ensure_future(self._deliver_edit(key, pending, callback, priority))
+            else:
+                self._forget(key, pending)
+                if not pending.result.done():
+                    pending.result.set_exception(TimedOut("编辑请求已取消"))
+                    pending.result.exception()  # 没有其他调用等待时避免未读取异常的警告
+            raise
+        except Exception as e:
+            self._forget(key, pending)
+            if not pending.result.done():
+                pending.result.set_exception(e)
+                pending.result.exception()
+            raise
+
+        if not pending.result.done():
+            pending.result.set_result(result)
+        return result
+
+    async def _take_edit(self, key: Tuple[Hashable, Any], pending: PendingEdit, callback) -> Any:
+        """取得令牌后取出最新的编辑内容发送"""
+        current = self._edits.get(key)
+        if current is pending:
+            del self._edits[key]
+        elif current is not None:
+            # 等待重试期间同一条消息又有新的编辑排队，这次的内容已经过时
+            current.merged += pending.merged + 1
+            return await asyncio.shield(current.result)
+
+        try:
+            return await callback(*pending.args, **pending.kwargs)
+        except RetryAfter:
+            # 等待重试期间新的编辑可以继续合并进来
+            self._edits.setdefault(key, pending)
+            raise
+
+    def _forget(self, key: Tuple[Hashable, Any], pending: PendingEdit):
+        if self._edits.get(key) is pending:
+            del self._edits[key]
+
+    def _bucket(self, chat_id: Hashable) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) > 10000:
+                self._chats = {cid: b for cid, b in self._chats.items() if not b.idle()}
+
+            # 私聊的chat_id为正数，群组和频道为负数或 @用户名
+            private = isinstance(chat_id, int) and chat_id > 0 or str(chat_id).isdigit()
+            rate = self.chat_rate if private else self.group_rate
+            bucket = self._chats[chat_id] = TokenBucket(rate, self.burst)
+        return bucket
+
+    def stats(self) -> Dict[str, Any]:
+        """获取统计信息"""
+        now = time.monotonic()
+        return {
+            'sent': self.sent,
+            'coalesced': self.coalesced,
+            'retry_after': self.retry_after,
+            'failed': self.failed,
+            'waiting': self._global.waiting() + sum(bucket.waiting() for bucket in self._chats.values()),
+            'pending_edits': len(self._edits),
+            'chats': len(self._chats),
+            'paused_chats': sum(1 for bucket in self._chats.values() if bucket.paused_until > now),
+        }
+
+
+# 全局实例，多进程时每个worker平分全局限额（聊天按chat_id分片，单个聊天的限额不变）
+outbound_scheduler = OutboundScheduler(
+    global_rate=config.OUTBOUND_GLOBAL_RATE / max(1, config.WORKER_PROCESSES),
+    chat_rate=config.OUTBOUND_CHAT_RATE,
+    group_per_minute=config.OUTBOUND_GROUP_PER_MINUTE,
+    burst=config.OUTBOUND_CHAT_BURST,
+    max_retries=config.OUTBOUND_MAX_RETRIES
+)
@@ -0,0 +1,170 @@
+"""
+推测预取 - 展示搜索结果后，在用户选择之前提前下载排名靠前的歌曲
+"""
+import asyncio
+import time
+from typing import Any, Awaitable, Callable, Dict, Hashable, Iterable, Optional, Set
+from loguru import logger
+import config
+from metrics import PREFETCHES, PREFETCH_WASTED_BYTES
+
+
+class PrefetchJob:
+    """一次预取任务"""
+
+    def __init__(self, task: asyncio.Task, deadline: float):
+        self.task = task
+        self.deadline = deadline
+        self.chats: Set[int] = set()  # 结果中包含这首歌的聊天
+        self.size = 0  # 下载得到的字节数
+
+
+class Prefetcher:
+    """推测预取类
+
+    预取任务通过 download_flight 下载，用户点击时直接加入进行中的下载，
+    下载完成后文件留在下载目录的热缓存中。
+
+    - 同时进行的预取不超过 max_active 个，超出时直接跳过
+    - 聊天的搜索结果被替换或过期时取消还在进行的预取
+    - 预取的歌曲被点击记为命中；到期都没有被点击的下载量记为浪费
+    """
+
+    def __init__(self, max_active: int, ttl_seconds: int):
+        self.max_active = max_active
+        self.ttl_seconds = ttl_seconds
+        self._jobs: Dict[Hashable, PrefetchJob] = {}
+
+        # 统计计数
+        self.started = 0
+        self.hits = 0
+        self.skipped = 0
+        self.cancelled = 0
+        self.failed = 0
+        self.wasted = 0
+        self.wasted_bytes = 0
+
+    def active(self) -> int:
+        """正在进行的预取数"""
+        return sum(1 for job in self._jobs.values() if not job.task.done())
+
+    def submit(self, chat_id: int, key: Hashable, factory: Callable[[], Awaitable[Optional[int]]]) -> bool:
+        """
+        为聊天启动预取，已有相同的预取时只延长有效期
+
+        Args:
+            chat_id: 聊天ID
+            key: 预取键，与 download_flight 的合并键相同
+            factory: 执行预取的协程函数，返回下载的字节数
+
+        Returns:
+            是否有对应的预取任务
+        """
+        deadline = time.monotonic() + self.ttl_seconds
+        job = self._jobs.get(key)
+        if job is None:
+            if self.active() >= self.max_active:
+                self.skipped += 1
+                PREFETCHES.inc(outcome='skipped')
+                return False
+
+            job = PrefetchJob(asyncio.ensure_future(factory()), deadline)
+            job.task.add_done_callback(lambda task: self._finished(key, job, task))
+            self._jobs[key] = job
+            self.started += 1
+            PREFETCHES.inc(outcome='started')
+
+        job.chats.add(chat_id)
+        job.deadline = max(job.deadline, deadline)
+        return True
+
+    def claim(self, key: Hashable) -> bool:
+        """
+        真实请求用到了这首歌，预取任务（如有）记为命中
+
+        进行中的下载由 download_flight 交给真实请求继续，已完成的文件在热缓存中。
+        """
+        job = self._jobs.pop(key, None)
+        if job is None:
+            return False
+
+        self.hits += 1
+        PREFETCHES.inc(outcome='hit')
+        return True
+
+    def retain(self, chat_id: int, keys: Iterable[Hashable]):
+        """聊天的搜索结果已更新，放弃这个聊天不再需要的预取"""
+        keys = set(keys)
+        for key, job in list(self._jobs.items()):
+            if chat_id in job.chats and key not in keys:
+                job.chats.discard(chat_id)
+                if not job.chats:
+                    self._drop(key, job)
+
+    def expire(self) -> int:
+        """清理过期的预取，返回清理数量"""
+        now = time.monotonic()
+        expired = [(key, job) for key, job in self._jobs.items() if job.deadline <= now]
+        for key, job in expired:
+            self._drop(key, job)
+        return len(expired)
+
+    def cancel_all(self):
+        """关闭时取消所有预取"""
+        for key, job in list(self._jobs.items()):
+            self._drop(key, job)
+
+    def _drop(self, key: Hashable, job: PrefetchJob):
+        """放弃没有被点击的预取：进行中的取消，已完成的计入浪费"""
+        if self._jobs.get(key) is job:
+            del self._jobs[key]
+
+        if not job.task.done():
+            job.task.cancel()
+            self.cancelled += 1
+            PREFETCHES.inc(outcome='cancelled')
+        elif job.size:
+            self.wasted += 1
+            self.wasted_bytes += job.size
+            PREFETCHES.inc(outcome='wasted')
+            PREFETCH_WASTED_BYTES.inc(job.size)
+
+    def _finished(self, key: Hashable, job: PrefetchJob, task: asyncio.Task):
+        if task.cancelled():
+            return
+
+        error = task.exception()
+        if error is not None or not task.result():
+            if error is not None:
+                logger.debug(f"预取失败: {key}: {error}")
+            self.failed += 1
+            PREFETCHES.inc(outcome='failed')
+            if self._jobs.get(key) is job:
+                del self._jobs[key]
+            return
+
+        job.size = task.result()
+
+    def stats(self) -> Dict[str, Any]:
+        """获取统计信息"""
+        decided = self.hits + self.wasted + self.cancelled
+        return {
+            'tracked': len(self._jobs),
+            'active': self.active(),
+            'max_active': self.max_active,
+            'started': self.started,
+            'hits': self.hits,
+            'skipped': self.skipped,
+            'cancelled': self.cancelled,
+            'failed': self.failed,
+            'wasted': self.wasted,
+            'wasted_bytes': self.wasted_bytes,
+            'hit_rate': self.hits / decided if decided else 0.0,
+        }
+
+
+# 全局实例，预取结果和搜索结果的有效期相同
+prefetcher = Prefetcher(
+    max_active=config.PREFETCH_MAX_ACTIVE,
+    ttl_seconds=config.CACHE_EXPIRE_MINUTES * 60
+)
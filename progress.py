@@ -0,0 +1,208 @@
+"""
+下载进度 - 把yt-dlp下载线程中的进度转发到事件循环，限速编辑状态消息
+"""
+import asyncio
+import time
+from typing import Callable, Dict, Optional
+from telegram.error import BadRequest
+from loguru import logger
+import config
+
+
+def format_size(num_bytes: float) -> str:
+    """字节数转为易读的大小"""
+    for unit in ('B', 'KB', 'MB'):
+        if num_bytes < 1024:
+            return f"{num_bytes:.0f}{unit}" if unit == 'B' else f"{num_bytes:.1f}{unit}"
+        num_bytes /= 1024
+    return f"{num_bytes:.1f}GB"
+
+
+def format_progress(stage: str, info: Dict) -> str:
+    """
+    生成进度文字
+
+    Args:
+        stage: 'queued', 'downloading', 'converting' 或 'uploading'
+        info: 阶段附带的数据，例如 position、percent、speed
+    """
+    if stage == 'queued':
+        return f"🕒 排队中，当前排在第 {info['position']} 位"
+
+    if stage == 'downloading':
+        parts = []
+        percent = info.get('percent')
+        if percent is not None:
+            filled = int(percent // 10)
+            parts.append(f"{'▓' * filled}{'░' * (10 - filled)} {percent:.0f}%")
+        if info.get('speed'):
+            parts.append(f"{format_size(info['speed'])}/s")
+        return "📥 下载中 " + ' · '.join(parts) if parts else "📥 下载中..."
+
+    if stage == 'converting':
+        return "🔄 转码中..."
+
+    if stage == 'uploading':
+        return "📤 上传中..."
+
+    return "⏳ 请稍候..."
+
+
+class ProgressForwarder:
+    """在下载线程中调用，把进度转发到事件循环
+
+    yt-dlp每收到一块数据就会调用一次进度回调，这里在线程内先做节流：
+    同一阶段至少间隔 min_interval 秒才转发一次，阶段变化时立即转发。
+    转发使用 call_soon_threadsafe，不阻塞下载线程。
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, callback: Callable[[str, Dict], None],
+                 min_interval: float):
+        self.loop = loop
+        self.callback = callback
+        self.min_interval = min_interval
+        self._stage = None
+        self._last = 0.0
+
+    def __call__(self, stage: str, info: Optional[Dict] = None):
+        now = time.monotonic()
+        if stage == self._stage and now - self._last < self.min_interval:
+            return
+
+        self._stage = stage
+        self._last = now
+        try:
+            self.loop.call_soon_threadsafe(self.callback, stage, info or {})
+        except RuntimeError:
+            # 事件循环已关闭
+            pass
+
+
+class EditThrottle:
+    """状态消息编辑的频率限制
+
+    每个聊天两次编辑至少间隔 per_chat_interval 秒，所有聊天合计每秒不超过 global_rate 次。
+    reserve() 为下一次编辑预约时间并返回需要等待的秒数，每条消息同时最多只有一个预约，
+    所以等待时间有上限，不会越积越多。
+    """
+
+    def __init__(self, per_chat_interval: float, global_rate: float):
+        self.per_chat_interval = per_chat_interval
+        self.global_interval = 1 / global_rate if global_rate > 0 else 0.0
+        self._chat_next: Dict[int, float] = {}  # {chat_id: 下次允许编辑的时间}
+        self._global_next = 0.0
+
+        # 统计计数
+        self.edits = 0
+        self.skipped = 0
+        self.failed = 0
+
+    def reserve(self, chat_id: int) -> float:
+        now = time.monotonic()
+        at = max(now, self._chat_next.get(chat_id, 0.0), self._global_next)
+        self._chat_next[chat_id] = at + self.per_chat_interval
+        self._global_next = at + self.global_interval
+
+        if len(self._chat_next) > 10000:
+            self._chat_next = {cid: t for cid, t in self._chat_next.items() if t > now}
+        return at - now
+
+    def stats(self) -> Dict:
+        return {
+            'edits': self.edits,
+            'skipped': self.skipped,
+            'failed': self.failed,
+            'chats': len(self._chat_next),
+        }
+
+
+class ProgressMessage:
+    """显示下载进度的状态消息
+
+    只保留最新的进度：等待编辑期间收到的新进度直接覆盖旧的，
+    同一条消息不会有多个编辑排队，也不会重复发送相同的内容。
+    """
+
+    def __init__(self, message, header: str, throttle: 'EditThrottle'):
+        """
+        Args:
+            message: 要编辑的状态消息
+            header: 固定显示在进度上方的文字（歌曲名等）
+            throttle: 编辑频率限制
+        """
+        self.message = message
+        self.header = header
+        self.throttle = throttle
+        self._latest: Optional[str] = None
+        self._shown: Optional[str] = None
+        self._task: Optional[asyncio.Task] = None
+        self._closed = False
+
+    def update(self, stage: str, info: Optional[Dict] = None):
+        """记录新进度，必须在事件循环中调用"""
+        if self._closed:
+            return
+
+        self._latest = format_progress(stage, info or {})
+        if self._task is None:
+            self._schedule()
+        else:
+            self.throttle.skipped += 1
+
+    async def queued(self, position: int):
+        """下载调度器的排队回调"""
+        self.update('queued', {'position': position})
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """下载结束，取消还没有发出的编辑"""
+        self._closed = True
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    def _schedule(self):
+        delay = self.throttle.reserve(self.message.chat_id)
+        self._task = asyncio.create_task(self._edit(delay))
+
+    async def _edit(self, delay: float):
+        try:
+            if delay > 0:
+                await asyncio.sleep(delay)
+        except asyncio.CancelledError:
+            return
+
+        # 失败的内容也不再重试，等下一次进度变化
+        text = self._latest
+        try:
+            if text != self._shown:
+                self._shown = text
+                await self.message.edit_text(f"{self.header}\n\n{text}")
+                self.throttle.edits += 1
+
+        except asyncio.CancelledError:
+            return
+        except BadRequest as e:
+            # 消息已被删除或内容没有变化
+            logger.debug(f"编辑进度消息失败: {e}")
+            self.throttle.failed += 1
+        except Exception as e:
+            logger.warning(f"编辑进度消息失败: {e}")
+            self.throttle.failed += 1
+
+        self._task = None
+        # 编辑期间又有新进度时再预约一次
+        if not self._closed and self._latest != self._shown:
+            self._schedule()
+
+
+# 全局实例
+edit_throttle = EditThrottle(
+    per_chat_interval=config.PROGRESS_EDIT_INTERVAL,
+    global_rate=config.PROGRESS_EDITS_PER_SECOND
+)
@@ -0,0 +1,174 @@
+"""
+多进程分片 - 前端进程接收更新，按chat_id分发给多个worker进程处理
+"""
+import asyncio
+import json
+import multiprocessing
+import signal
+from typing import List
+from loguru import logger
+from telegram import Update
+from telegram.ext import Application
+import config
+from database import init_db, close_db
+from webhook_server import WebhookServer
+
+
+def shard_for(update: Update, shards: int) -> int:
+    """
+    计算更新应交给哪个worker
+
+    同一个聊天的更新总是交给同一个worker，聊天内的消息顺序不会被打乱。
+    """
+    if update.effective_chat:
+        key = update.effective_chat.id
+    elif update.effective_user:
+        key = update.effective_user.id
+    else:
+        key = update.update_id
+    return key % shards
+
+
+def worker_main(index: int, update_queue):
+    """worker进程入口"""
+    # 退出由前端进程统一控制，worker处理完已收到的更新后再退出
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+    # 在子进程中导入，避免前端进程创建机器人的全局状态
+    from bot import MusicBot
+
+    bot = MusicBot()
+    bot.build_application(with_updater=False)
+    asyncio.run(bot.run_worker(index, update_queue))
+
+
+class ShardedFrontend:
+    """多进程前端类
+
+    前端进程只负责接收更新（长轮询或webhook），不处理任何消息，
+    按 chat_id 的哈希把更新通过进程间队列转发给 processes 个worker进程。
+    worker进程意外退出时会被重新启动。
+    """
+
+    def __init__(self, processes: int, allowed_updates: list):
+        self.processes = processes
+        self.allowed_updates = allowed_updates
+        self._context = multiprocessing.get_context('spawn')
+        self._queues = []
+        self._workers: List[multiprocessing.Process] = []
+        self.forwarded = [0] * processes
+        self.ready = False  # worker已启动且前端已初始化，开始转发更新
+
+    def run(self):
+        """启动前端进程和所有worker进程"""
+        asyncio.run(self._run())
+
+    async def _run(self):
+        stop_event = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, stop_event.set)
+            except NotImplementedError:
+                pass
+
+        # 数据库迁移在启动worker之前执行一次，避免多个进程同时建表和修改索引
+        logger.info("初始化数据库...")
+        await init_db(config.DATABASE_URL)
+        await close_db()
+
+        self._queues = [self._context.Queue(maxsize=config.WORKER_QUEUE_SIZE) for _ in range(self.processes)]
+        self._workers = [self._start_worker(index) for index in range(self.processes)]
+
+        webhook_mode = config.BOT_MODE == 'webhook'
+        builder = Application.builder().token(config.TELEGRAM_BOT_TOKEN)
+        if webhook_mode:
+            builder = builder.updater(None)
+        app = builder.build()
+        server = None
+
+        await app.initialize()
+        try:
+            if webhook_mode:
+                server = WebhookServer(
+                    app,
+                    listen=config.WEBHOOK_LISTEN,
+                    port=config.WEBHOOK_PORT,
+                    path=config.WEBHOOK_PATH,
+                    secret_token=config.WEBHOOK_SECRET_TOKEN,
+                    health_path=config.WEBHOOK_HEALTH_PATH,
+                    # 前端应用只初始化、不启动，健康状态以是否开始转发为准
+                    ready=lambda: self.ready
+                )
+                await server.start()
+                if config.WEBHOOK_URL:
+                    await app.bot.set_webhook(
+                        url=config.WEBHOOK_URL.rstrip('/') + config.WEBHOOK_PATH,
+                        secret_token=config.WEBHOOK_SECRET_TOKEN,
+                        allowed_updates=self.allowed_updates
+                    )
+            else:
+                await app.updater.start_polling(allowed_updates=self.allowed_updates)
+
+            # 前端不注册处理器，更新队列中的更新全部转发给worker
+            forwarder = asyncio.create_task(self._forward(app))
+            monitor = asyncio.create_task(self._monitor())
+            self.ready = True
+            logger.info(f"✅ 前端进程已启动，{self.processes} 个worker进程处理消息")
+
+            await stop_event.wait()
+            self.ready = False
+            forwarder.cancel()
+            monitor.cancel()
+
+        finally:
+            if server:
+                await server.stop()
+            if app.updater and app.updater.running:
+                await app.updater.stop()
+            await app.shutdown()
+            await self._stop_workers()
+
+    def _start_worker(self, index: int) -> multiprocessing.Process:
+        process = self._context.Process(
+            target=worker_main,
+            args=(index, self._queues[index]),
+            name=f"bot-worker-{index}"
+        )
+        process.start()
+        logger.info(f"worker {index} 已启动 (pid={process.pid})")
+        return process
+
+    async def _forward(self, app: Application):
+        """把收到的更新转发给对应的worker"""
+        loop = asyncio.get_running_loop()
+        while True:
+            update = await app.update_queue.get()
+            index = shard_for(update, self.processes)
+            payload = json.dumps(update.to_dict())
+
+            # 队列满时在线程中等待，不阻塞事件循环
+            await loop.run_in_executor(None, self._queues[index].put, payload)
+            self.forwarded[index] += 1
+
+    async def _monitor(self):
+        """重启意外退出的worker"""
+        while True:
+            await asyncio.sleep(5)
+            for index, process in enumerate(self._workers):
+                if not process.is_alive():
+                    logger.error(f"worker {index} 已退出 (exitcode={process.exitcode})，正在重启")
+                    self._workers[index] = self._start_worker(index)
+
+    async def _stop_workers(self):
+        """通知所有worker退出并等待"""
+        loop = asyncio.get_running_loop()
+        for queue in self._queues:
+            queue.put(None)
+
+        for index, process in enumerate(self._workers):
+            await loop.run_in_executor(None, process.join, config.WORKER_SHUTDOWN_TIMEOUT)
+            if process.is_alive():
+                logger.warning(f"worker {index} 未能按时退出，强制结束")
+                process.terminate()
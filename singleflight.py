@@ -0,0 +1,172 @@
+"""
+单飞合并 - 同一来源的并发下载请求共享一次下载和转码
+"""
+import asyncio
+from contextlib import asynccontextmanager
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional, Tuple, Type
+from loguru import logger
+from download_scheduler import DownloadQueueFull, UserDownloadLimit
+from download_store import download_store
+
+
+class Flight:
+    """一次正在进行（或刚完成）的共享任务"""
+
+    def __init__(self):
+        self.task: Optional[asyncio.Task] = None
+        self.refs = 0  # 正在使用结果的请求数
+        self.lock = asyncio.Lock()  # 供使用者串行处理共享结果（例如只上传一次）
+        self.result = None
+        self.listeners: List[Tuple[Optional[Callable], Optional[Callable]]] = []  # [(on_queued, on_progress)]
+        self._last: Optional[tuple] = None  # 最近一次排队位置或进度，转发给之后加入的等待者
+
+    async def queued(self, position: int):
+        """把排队位置转发给所有等待者"""
+        self._last = ('queued', position)
+        for on_queued, _ in list(self.listeners):
+            await self._notify_queued(on_queued, position)
+
+    def progress(self, stage: str, info: Optional[Dict] = None):
+        """把进度转发给所有等待者，必须在事件循环中调用"""
+        self._last = ('progress', stage, info)
+        for _, on_progress in list(self.listeners):
+            self._notify_progress(on_progress, stage, info)
+
+    async def replay(self, on_queued: Optional[Callable], on_progress: Optional[Callable]):
+        """新加入的等待者立即看到当前的排队位置或进度"""
+        if self._last is None:
+            return
+        if self._last[0] == 'queued':
+            await self._notify_queued(on_queued, self._last[1])
+        else:
+            self._notify_progress(on_progress, *self._last[1:])
+
+    @staticmethod
+    async def _notify_queued(on_queued: Optional[Callable], position: int):
+        if on_queued:
+            try:
+                await on_queued(position)
+            except Exception as e:
+                logger.warning(f"通知排队位置失败: {e}")
+
+    @staticmethod
+    def _notify_progress(on_progress: Optional[Callable], stage: str, info: Optional[Dict]):
+        if on_progress:
+            try:
+                on_progress(stage, info)
+            except Exception as e:
+                logger.warning(f"通知进度失败: {e}")
+
+
+class SingleFlight:
+    """单飞合并类
+
+    同一个键的并发请求只执行一次工厂函数，所有请求等待同一个结果，
+    任务的排队位置和进度通过 Flight.queued / Flight.progress 转发给每个等待者。
+    任务因 retry_on 中的异常失败时（例如发起者自己的下载数已满），加入的请求不接收这个异常，
+    而是用自己的工厂函数重新发起；发起者自己仍然收到异常。
+    最后一个请求释放后才调用 cleanup 清理结果（例如释放下载的文件）。
+    """
+
+    def __init__(self, cleanup: Optional[Callable[[Any], None]] = None,
+                 retry_on: Tuple[Type[BaseException], ...] = ()):
+        self.cleanup = cleanup
+        self.retry_on = retry_on
+        self._flights: Dict[Hashable, Flight] = {}
+
+        # 统计计数
+        self.started = 0
+        self.coalesced = 0
+        self.retried = 0
+
+    @asynccontextmanager
+    async def acquire(self, key: Hashable, factory: Callable[[Flight], Awaitable[Any]],
+                      on_queued: Optional[Callable[[int], Awaitable[None]]] = None,
+                      on_progress: Optional[Callable[[str, Optional[Dict]], None]] = None):
+        """
+        获取键对应的共享结果
+
+        Args:
+            key: 合并键，例如 (source_id, quality)
+            factory: 没有进行中的任务时用来启动任务的协程函数，参数为Flight对象，
+                排队位置和进度应通过 flight.queued / flight.progress 报告
+            on_queued: 本请求的排队位置回调
+            on_progress: 本请求的进度回调 (阶段, 数据)
+
+        Yields:
+            Flight对象，result 为任务结果
+        """
+        listener = (on_queued, on_progress)
+        while True:
+            flight = self._flights.get(key)
+            joined = flight is not None
+            if joined:
+                self.coalesced += 1
+                logger.info(f"合并重复下载请求: {key}")
+            else:
+                flight = Flight()
+                flight.task = asyncio.ensure_future(factory(flight))
+                self._flights[key] = flight
+                self.started += 1
+
+            flight.refs += 1
+            flight.listeners.append(listener)
+            try:
+                if joined:
+                    await flight.replay(on_queued, on_progress)
+                try:
+                    # shield: 单个等待者取消时不影响其他等待者
+                    flight.result = await asyncio.shield(flight.task)
+                except self.retry_on:
+                    if not joined:
+                        raise
+                    # 发起者的请求被拒绝，与本请求无关，由本请求重新发起
+                    self.retried += 1
+                    if self._flights.get(key) is flight:
+                        del self._flights[key]
+                    continue
+                yield flight
+                return
+            finally:
+                flight.listeners.remove(listener)
+                flight.refs -= 1
+                if flight.refs == 0:
+                    self._release(key, flight)
+
+    def _release(self, key: Hashable, flight: Flight):
+        """最后一个使用者离开时移除任务并清理结果"""
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+
+        if flight.task.done():
+            self._cleanup_task(flight.task)
+        else:
+            # 所有等待者都已取消，任务不再需要
+            flight.task.cancel()
+            flight.task.add_done_callback(self._cleanup_task)
+
+    def _cleanup_task(self, task: asyncio.Task):
+        if task.cancelled() or task.exception() is not None or self.cleanup is None:
+            return
+
+        try:
+            self.cleanup(task.result())
+        except Exception as e:
+            logger.error(f"清理共享结果失败: {e}")
+
+    def stats(self) -> Dict:
+        """获取统计信息"""
+        return {
+            'in_flight': len(self._flights),
+            'started': self.started,
+            'coalesced': self.coalesced,
+            'retried': self.retried,
+        }
+
+
+# 全局实例，最后一个请求发送完后解除文件锁定，文件留在热缓存中按磁盘预算淘汰；
+# 下载调度器按发起者拒绝的请求（发起者的下载数已满、预取没有空闲槽位等）由加入者自己重新发起
+download_flight = SingleFlight(
+    cleanup=download_store.release,
+    retry_on=(UserDownloadLimit, DownloadQueueFull)
+)
@@ -1,11 +1,47 @@
 """
 Spotify音乐搜索 - 获取Spotify歌曲信息，然后在YouTube下载
 """
-from typing import List, Dict, Optional
+import asyncio
+import functools
+import re
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator, List, Dict, Optional, Tuple
+import requests
 import spotipy
-from spotipy.oauth2 import SpotifyClientCredentials
+from spotipy.cache_handler import MemoryCacheHandler
+from spotipy.exceptions import SpotifyException
+from spotipy.oauth2 import SpotifyClientCredentials, SpotifyOauthError
 from loguru import logger
 import config
+from circuit_breaker import BackendUnavailable, CircuitBreaker, parse_retry_after
+
+
+# 播放列表/专辑链接，例如 https://open.spotify.com/playlist/<id> 或 spotify:album:<id>
+COLLECTION_URL_RE = re.compile(
+    r'(?:open\.spotify\.com/(?:intl-[\w-]+/)?|spotify:)(playlist|album)[/:]([A-Za-z0-9]+)'
+)
+
+
+def classify_spotify_error(error: BaseException) -> Tuple[bool, Optional[float]]:
+    """熔断器的错误分类：(是否为Spotify故障, Retry-After)"""
+    if isinstance(error, SpotifyException):
+        if error.http_status == 429:
+            return True, parse_retry_after((error.headers or {}).get('Retry-After'))
+        return error.http_status >= 500, None
+
+    # 网络错误和令牌获取失败
+    return isinstance(error, (requests.exceptions.RequestException, SpotifyOauthError)), None
+
+
+def parse_collection_url(url: str) -> Optional[Tuple[str, str]]:
+    """
+    解析Spotify播放列表或专辑链接
+
+    Returns:
+        ('playlist' 或 'album', ID)，无法识别返回None
+    """
+    match = COLLECTION_URL_RE.search(url)
+    return (match.group(1), match.group(2)) if match else None
 
 
 class SpotifySearcher:
@@ -14,14 +50,35 @@ class SpotifySearcher:
     def __init__(self):
         self.enabled = config.SPOTIFY_ENABLED
         self.client = None
+        self.auth_manager = None
+        self.breaker = CircuitBreaker('spotify', classify_spotify_error, label='Spotify')
+
+        # spotipy是同步客户端，所有请求（包括令牌刷新）都放到专用线程池执行，
+        # 避免阻塞事件循环，也不占用默认线程池
+        self.executor = ThreadPoolExecutor(
+            max_workers=config.SPOTIFY_WORKERS,
+            thread_name_prefix='spotify'
+        )
 
         if self.enabled:
             try:
-                auth_manager = SpotifyClientCredentials(
+                # 令牌缓存在内存中，不读写磁盘上的.cache文件
+                self.auth_manager = SpotifyClientCredentials(
                     client_id=config.SPOTIFY_CLIENT_ID,
-                    client_secret=config.SPOTIFY_CLIENT_SECRET
+                    client_secret=config.SPOTIFY_CLIENT_SECRET,
+                    cache_handler=MemoryCacheHandler()
+                )
+                # 不使用spotipy内置的重试：429时它会在线程中阻塞等待，且丢失Retry-After，
+                # 由熔断器统一退避重试
+                self.client = spotipy.Spotify(
+                    auth_manager=self.auth_manager,
+                    requests_session=requests.Session(),
+                    requests_timeout=config.SPOTIFY_REQUEST_TIMEOUT
                 )
-                self.client = spotipy.Spotify(auth_manager=auth_manager)
+                if config.SPOTIFY_TOKEN_URL:
+                    self.auth_manager.OAUTH_TOKEN_URL = config.SPOTIFY_TOKEN_URL
+                if config.SPOTIFY_API_BASE_URL:
+                    self.client.prefix = config.SPOTIFY_API_BASE_URL.rstrip('/') + '/'
                 logger.info("Spotify客户端初始化成功")
             except Exception as e:
                 logger.error(f"Spotify初始化失败: {e}")
@@ -29,6 +86,41 @@ class SpotifySearcher:
         else:
             logger.warning("Spotify未配置，仅使用YouTube搜索")
 
+    def available(self) -> bool:
+        """Spotify是否启用且没有熔断"""
+        return self.enabled and self.breaker.available()
+
+    async def _run(self, func, *args, **kwargs):
+        """在Spotify专用线程池中执行同步调用，经过熔断器并在故障时重试"""
+        loop = asyncio.get_running_loop()
+        return await self.breaker.call(
+            lambda: loop.run_in_executor(
+                self.executor,
+                functools.partial(func, *args, **kwargs)
+            )
+        )
+
+    async def refresh_token(self):
+        """
+        在线程池中获取访问令牌
+
+        令牌未过期时直接使用缓存，即将过期时才会请求新令牌。
+        定期调用可以让令牌在真正的搜索请求之前完成刷新。
+        """
+        if not self.enabled or not self.auth_manager:
+            return
+
+        try:
+            await self._run(self.auth_manager.get_access_token, as_dict=False)
+        except BackendUnavailable:
+            pass
+        except Exception as e:
+            logger.error(f"刷新Spotify令牌失败: {e}")
+
+    def close(self):
+        """关闭线程池"""
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
     async def search(self, query: str, limit: int = 5) -> List[Dict]:
         """
         搜索Spotify音乐
@@ -39,6 +131,10 @@ class SpotifySearcher:
 
         Returns:
             搜索结果列表
+
+        Raises:
+            BackendUnavailable: Spotify熔断中
+            其他异常: 重试后仍然失败
         """
         if not self.enabled or not self.client:
             logger.warning("Spotify未启用")
@@ -46,45 +142,41 @@ class SpotifySearcher:
 
         logger.info(f"Spotify搜索: {query}")
 
-        try:
-            results = self.client.search(q=query, limit=limit, type='track')
-
-            if not results or 'tracks' not in results:
-                return []
-
-            tracks = []
-            for item in results['tracks']['items']:
-                # 提取艺术家信息
-                artists = [artist['name'] for artist in item['artists']]
-                artist_name = ', '.join(artists)
-
-                # 提取专辑信息
-                album = item['album']
-                album_name = album['name']
-                album_image = album['images'][0]['url'] if album['images'] else None
-
-                # 构建YouTube搜索查询
-                youtube_query = f"{artist_name} - {item['name']}"
-
-                tracks.append({
-                    'title': item['name'],
-                    'artist': artist_name,
-                    'album': album_name,
-                    'duration': item['duration_ms'] // 1000,  # 转换为秒
-                    'thumbnail': album_image,
-                    'spotify_url': item['external_urls']['spotify'],
-                    'youtube_query': youtube_query,
-                    'popularity': item['popularity'],
-                    'source': 'spotify'
-                })
-
-            logger.info(f"Spotify搜索到 {len(tracks)} 首歌曲")
-            return tracks
+        # 请求失败时抛出，由调用方区分"没有结果"和"搜索失败"
+        results = await self._run(self.client.search, q=query, limit=limit, type='track')
 
-        except Exception as e:
-            logger.error(f"Spotify搜索失败: {e}")
+        if not results or 'tracks' not in results:
             return []
 
+        tracks = []
+        for item in results['tracks']['items']:
+            # 提取艺术家信息
+            artists = [artist['name'] for artist in item['artists']]
+            artist_name = ', '.join(artists)
+
+            # 提取专辑信息
+            album = item['album']
+            album_name = album['name']
+            album_image = album['images'][0]['url'] if album['images'] else None
+
+            # 构建YouTube搜索查询
+            youtube_query = f"{artist_name} - {item['name']}"
+
+            tracks.append({
+                'title': item['name'],
+                'artist': artist_name,
+                'album': album_name,
+                'duration': item['duration_ms'] // 1000,  # 转换为秒
+                'thumbnail': album_image,
+                'spotify_url': item['external_urls']['spotify'],
+                'youtube_query': youtube_query,
+                'popularity': item['popularity'],
+                'source': 'spotify'
+            })
+
+        logger.info(f"Spotify搜索到 {len(tracks)} 首歌曲")
+        return tracks
+
     async def get_track_info(self, track_id: str) -> Optional[Dict]:
         """
         获取单首歌曲的详细信息
@@ -99,7 +191,7 @@ class SpotifySearcher:
             return None
 
         try:
-            track = self.client.track(track_id)
+            track = await self._run(self.client.track, track_id)
 
             artists = [artist['name'] for artist in track['artists']]
             artist_name = ', '.join(artists)
@@ -119,48 +211,97 @@ class SpotifySearcher:
             logger.error(f"获取Spotify歌曲信息失败: {e}")
             return None
 
-    async def get_playlist_tracks(self, playlist_id: str, limit: int = 20) -> List[Dict]:
+    async def get_collection_info(self, kind: str, collection_id: str) -> Optional[Dict]:
         """
-        获取播放列表中的歌曲
+        获取播放列表或专辑的名称和歌曲数
 
         Args:
-            playlist_id: 播放列表ID
-            limit: 返回结果数量
+            kind: 'playlist' 或 'album'
+            collection_id: 播放列表或专辑ID
 
         Returns:
-            歌曲列表
+            {'name': 名称, 'total': 歌曲数}
         """
         if not self.enabled or not self.client:
-            return []
+            return None
 
         try:
-            results = self.client.playlist_tracks(playlist_id, limit=limit)
+            if kind == 'album':
+                album = await self._run(self.client.album, collection_id)
+                return {'name': album['name'], 'total': album['total_tracks']}
 
-            tracks = []
-            for item in results['items']:
-                track = item['track']
-                if not track:
-                    continue
+            playlist = await self._run(self.client.playlist, collection_id, fields='name,tracks.total')
+            return {'name': playlist['name'], 'total': playlist['tracks']['total']}
 
-                artists = [artist['name'] for artist in track['artists']]
-                artist_name = ', '.join(artists)
+        except Exception as e:
+            logger.error(f"获取{kind}信息失败: {e}")
+            return None
 
-                tracks.append({
-                    'title': track['name'],
-                    'artist': artist_name,
-                    'album': track['album']['name'],
-                    'duration': track['duration_ms'] // 1000,
-                    'thumbnail': track['album']['images'][0]['url'] if track['album']['images'] else None,
-                    'spotify_url': track['external_urls']['spotify'],
-                    'youtube_query': f"{artist_name} - {track['name']}",
-                    'source': 'spotify'
-                })
+    async def iter_collection_tracks(self, kind: str, collection_id: str) -> AsyncIterator[Dict]:
+        """
+        逐页读取播放列表或专辑中的全部歌曲
 
-            return tracks
+        每次只请求一页，调用方处理完当前页的歌曲后才会请求下一页，
+        无论列表多长内存占用都保持不变。
 
-        except Exception as e:
-            logger.error(f"获取播放列表失败: {e}")
-            return []
+        Args:
+            kind: 'playlist' 或 'album'
+            collection_id: 播放列表或专辑ID
+
+        Yields:
+            歌曲信息
+        """
+        if not self.enabled or not self.client:
+            return
+
+        album = None
+        offset = 0
+        page_size = 50 if kind == 'album' else 100
+
+        while True:
+            try:
+                if kind == 'album':
+                    if album is None:
+                        album = await self._run(self.client.album, collection_id)
+                    page = await self._run(
+                        self.client.album_tracks, collection_id, limit=page_size, offset=offset
+                    )
+                else:
+                    page = await self._run(
+                        self.client.playlist_items, collection_id,
+                        limit=page_size, offset=offset, additional_types=('track',)
+                    )
+
+            except Exception as e:
+                logger.error(f"读取{kind}歌曲失败 (offset={offset}): {e}")
+                return
+
+            for item in page['items']:
+                # 专辑返回的是歌曲本身，播放列表返回的是包含歌曲的条目
+                track = item if kind == 'album' else item.get('track')
+                if not track or track.get('type') != 'track' or track.get('is_local'):
+                    continue
+                yield self._track_to_dict(track, album or track['album'])
+
+            if not page.get('next'):
+                return
+            offset += page_size
+
+    def _track_to_dict(self, track: Dict, album: Dict) -> Dict:
+        """把Spotify API返回的歌曲转换为统一的歌曲信息"""
+        artists = [artist['name'] for artist in track['artists']]
+        artist_name = ', '.join(artists)
+
+        return {
+            'title': track['name'],
+            'artist': artist_name,
+            'album': album['name'],
+            'duration': track['duration_ms'] // 1000,
+            'thumbnail': album['images'][0]['url'] if album.get('images') else None,
+            'spotify_url': track['external_urls']['spotify'],
+            'youtube_query': f"{artist_name} - {track['name']}",
+            'source': 'spotify'
+        }
 
 
 # 全局实例
@@ -0,0 +1,98 @@
+"""
+单飞合并：加入者不接收发起者的准入拒绝，进度转发给所有等待者
+"""
+import asyncio
+import os
+
+os.environ.setdefault('TELEGRAM_BOT_TOKEN', 'test')
+
+import pytest  # noqa: E402
+
+from download_scheduler import UserDownloadLimit  # noqa: E402
+from singleflight import SingleFlight  # noqa: E402
+
+
+def test_joiner_restarts_when_starter_is_rejected():
+    async def scenario():
+        flights = SingleFlight(retry_on=(UserDownloadLimit,))
+        started = asyncio.Event()
+
+        async def rejected(flight):
+            started.set()
+            await asyncio.sleep(0.05)
+            raise UserDownloadLimit()
+
+        async def download(flight):
+            return 'file'
+
+        async def starter():
+            async with flights.acquire('song', rejected):
+                pass
+
+        async def joiner():
+            await started.wait()
+            async with flights.acquire('song', download) as flight:
+                return flight.result
+
+        return await asyncio.gather(starter(), joiner(), return_exceptions=True), flights.stats()
+
+    (starter_result, joiner_result), stats = asyncio.run(scenario())
+    assert isinstance(starter_result, UserDownloadLimit)
+    assert joiner_result == 'file'
+    assert stats['started'] == 2
+    assert stats['retried'] == 1
+
+
+def test_progress_is_forwarded_to_every_waiter():
+    async def scenario():
+        flights = SingleFlight()
+        started = asyncio.Event()
+        joined = asyncio.Event()
+        seen = {'starter': [], 'joiner': []}
+
+        async def download(flight):
+            await flight.queued(2)
+            started.set()
+            await joined.wait()
+            flight.progress('downloading', {'percent': 50})
+            return 'file'
+
+        async def wait(name, on_joined=None):
+            async def on_queued(position):
+                seen[name].append(('queued', position))
+
+            def on_progress(stage, info):
+                seen[name].append((stage, info))
+
+            if on_joined:
+                await started.wait()
+            async with flights.acquire('song', download, on_queued, on_progress) as flight:
+                return flight.result
+
+        async def joiner():
+            task = asyncio.ensure_future(wait('joiner', on_joined=True))
+            await asyncio.sleep(0.01)
+            joined.set()
+            return await task
+
+        await asyncio.gather(wait('starter'), joiner())
+        return seen
+
+    seen = asyncio.run(scenario())
+    assert seen['starter'] == [('queued', 2), ('downloading', {'percent': 50})]
+    # 加入时补发当前的排队位置，之后的进度实时转发
+    assert seen['joiner'] == [('queued', 2), ('downloading', {'percent': 50})]
+
+
+def test_starter_still_receives_rejection():
+    async def scenario():
+        flights = SingleFlight(retry_on=(UserDownloadLimit,))
+
+        async def rejected(flight):
+            raise UserDownloadLimit()
+
+        async with flights.acquire('song', rejected):
+            pass
+
+    with pytest.raises(UserDownloadLimit):
+        asyncio.run(scenario())
@@ -0,0 +1,70 @@
+"""
+Spotify搜索不阻塞事件循环：spotipy是同步客户端，请求必须在线程池中执行
+"""
+import asyncio
+import os
+import time
+
+os.environ.setdefault('TELEGRAM_BOT_TOKEN', 'test')
+
+from spotify_searcher import SpotifySearcher  # noqa: E402
+
+REQUEST_SECONDS = 0.2  # 每次Spotify请求的耗时
+SEARCHES = 16
+TICK_SECONDS = 0.01
+MAX_LAG_SECONDS = 0.05
+
+
+class BlockingSpotify:
+    """同步阻塞的假spotipy客户端"""
+
+    def __init__(self):
+        self.calls = 0
+
+    def search(self, q, limit=5, type='track'):
+        self.calls += 1
+        time.sleep(REQUEST_SECONDS)
+        return {'tracks': {'items': [{
+            'name': q,
+            'artists': [{'name': 'Artist'}],
+            'album': {'name': 'Album', 'images': []},
+            'duration_ms': 180000,
+            'external_urls': {'spotify': f'https://open.spotify.com/track/{self.calls}'},
+            'popularity': 50,
+        }]}}
+
+
+async def measure_max_lag(searcher: SpotifySearcher):
+    """并发搜索期间每 TICK_SECONDS 醒来一次，返回 (最大延迟, 搜索结果)"""
+    loop = asyncio.get_running_loop()
+    max_lag = 0.0
+    done = asyncio.Event()
+
+    async def ticker():
+        nonlocal max_lag
+        while not done.is_set():
+            expected = loop.time() + TICK_SECONDS
+            await asyncio.sleep(TICK_SECONDS)
+            max_lag = max(max_lag, loop.time() - expected)
+
+    tick_task = asyncio.create_task(ticker())
+    try:
+        results = await asyncio.gather(*(searcher.search(f'song {i}', limit=1) for i in range(SEARCHES)))
+    finally:
+        done.set()
+        await tick_task
+    return max_lag, results
+
+
+def test_concurrent_searches_do_not_block_event_loop():
+    searcher = SpotifySearcher()
+    searcher.enabled = True
+    searcher.client = BlockingSpotify()
+    try:
+        max_lag, results = asyncio.run(measure_max_lag(searcher))
+    finally:
+        searcher.close()
+
+    assert searcher.client.calls == SEARCHES
+    assert [tracks[0]['title'] for tracks in results] == [f'song {i}' for i in range(SEARCHES)]
+    assert max_lag < MAX_LAG_SECONDS, f"事件循环最大延迟 {max_lag * 1000:.1f}ms"
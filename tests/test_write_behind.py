@@ -0,0 +1,101 @@
+"""
+延迟批量写入：停止时正在进行的写入不能丢失记录
+"""
+import asyncio
+import os
+
+os.environ.setdefault('TELEGRAM_BOT_TOKEN', 'test')
+
+from sqlalchemy import func, select  # noqa: E402
+
+import database  # noqa: E402
+from database import DownloadHistory  # noqa: E402
+from write_behind import WriteBehindQueue  # noqa: E402
+
+
+class SlowWriteQueue(WriteBehindQueue):
+    """写入前先等待，让测试在写入过程中停止队列"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.writing = asyncio.Event()
+
+    async def _write(self, users, history):
+        self.writing.set()
+        await asyncio.sleep(0.2)
+        await super()._write(users, history)
+
+
+def history_row(user_id: int) -> dict:
+    return {'user_id': user_id, 'song_title': 'Song', 'artist': 'Artist', 'source': 'youtube'}
+
+
+async def count_history() -> int:
+    async with database.AsyncSessionLocal() as session:
+        return await session.scalar(select(func.count()).select_from(DownloadHistory))
+
+
+def run_with_db(tmp_path, scenario):
+    async def main():
+        await database.init_db(f"sqlite+aiosqlite:///{tmp_path / 'test.db'}")
+        try:
+            return await scenario()
+        finally:
+            await database.close_db()
+    return asyncio.run(main())
+
+
+def test_stop_during_flush_writes_the_batch(tmp_path):
+    async def scenario():
+        queue = SlowWriteQueue(flush_interval=60, max_batch=1)
+        queue.start()
+        queue.save_history(**history_row(1))
+        await asyncio.wait_for(queue.writing.wait(), timeout=5)
+
+        await queue.stop()
+        return await count_history(), queue.stats()
+
+    written, stats = run_with_db(tmp_path, scenario)
+    assert written == 1
+    assert stats['pending_history'] == 0
+    assert stats['flushes'] == 1
+
+
+def test_pending_history_includes_batch_being_written(tmp_path):
+    async def scenario():
+        queue = SlowWriteQueue(flush_interval=60, max_batch=1)
+        queue.start()
+        queue.save_history(**history_row(1))
+        await asyncio.wait_for(queue.writing.wait(), timeout=5)
+
+        pending = queue.has_pending_history(1)
+        # /history 的做法：有未写入的记录时先等写入完成
+        await queue.flush()
+        written = await count_history()
+        await queue.stop()
+        return pending, written
+
+    pending, written = run_with_db(tmp_path, scenario)
+    assert pending
+    assert written == 1
+
+
+def test_cancelled_flush_requeues_the_batch(tmp_path):
+    async def scenario():
+        queue = SlowWriteQueue(flush_interval=60, max_batch=100)
+        queue.save_history(**history_row(1))
+        flush = asyncio.create_task(queue.flush())
+        await asyncio.wait_for(queue.writing.wait(), timeout=5)
+        flush.cancel()
+        try:
+            await flush
+        except asyncio.CancelledError:
+            pass
+
+        requeued = queue.has_pending_history(1)
+        await queue.flush()
+        return requeued, await count_history()
+
+    requeued, written = run_with_db(tmp_path, scenario)
+    assert requeued
+    assert written == 1
@@ -0,0 +1,226 @@
+"""
+歌曲匹配 - 为Spotify歌曲挑选最合适的YouTube视频
+"""
+import re
+from difflib import SequenceMatcher
+from typing import Dict, Optional
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
+from loguru import logger
+import config
+import database
+from cache import normalize_query, query_cache
+from database import SpotifyYouTubeMapping
+from metrics import DB_DURATION
+from youtube_downloader import youtube_downloader
+
+
+# 标题中出现这些词通常不是原版录音（Spotify标题本身包含时不扣分）
+PENALTY_KEYWORDS = [
+    'live', 'cover', 'karaoke', 'instrumental', 'remix', 'nightcore', 'sped up',
+    'slowed', '8d', 'reaction', 'compilation', 'full album', '1 hour',
+    '现场', '翻唱', '伴奏', '合集',
+]
+
+# 官方上传渠道的标志
+OFFICIAL_KEYWORDS = ['official audio', 'official music video', 'official video', '官方']
+
+
+class TrackResolver:
+    """歌曲匹配类
+
+    在YouTube搜索多个候选视频，按时长差距、标题/歌手相似度和频道特征打分，
+    选出得分最高的视频。最高得分低于 min_score 时视为找不到，避免发送错误的歌曲。
+    匹配结果保存到数据库，同一首歌之后不再搜索YouTube。
+    """
+
+    def __init__(self, candidates: int, min_score: float):
+        self.candidates = candidates
+        self.min_score = min_score
+
+        # 统计计数
+        self.hits = 0
+        self.misses = 0
+        self.rejected = 0
+
+    async def resolve(self, track: Dict) -> Optional[Dict]:
+        """
+        获取Spotify歌曲对应的YouTube视频
+
+        Args:
+            track: Spotify歌曲信息
+
+        Returns:
+            YouTube视频信息，找不到返回None
+        """
+        spotify_url = track.get('spotify_url')
+        if spotify_url:
+            cached = await self._load(spotify_url)
+            if cached:
+                self.hits += 1
+                return cached
+
+        self.misses += 1
+
+        youtube_query = track.get('youtube_query', f"{track['artist']} {track['title']}")
+        candidates = await query_cache.get_or_fetch(
+            'youtube', youtube_query, self.candidates,
+            lambda: youtube_downloader.search(youtube_query, limit=self.candidates)
+        )
+        if not candidates:
+            return None
+
+        scored = sorted(
+            ((self.score(track, candidate), candidate) for candidate in candidates),
+            key=lambda item: item[0],
+            reverse=True
+        )
+        score, best = scored[0]
+        if score < self.min_score:
+            self.rejected += 1
+            logger.warning(f"Spotify匹配得分过低，视为找不到: {track['title']} -> {best['title']} (得分 {score:.2f})")
+            return None
+
+        logger.info(f"Spotify匹配: {track['title']} -> {best['title']} (得分 {score:.2f})")
+
+        if spotify_url and best.get('video_id'):
+            await self._save(spotify_url, best, score)
+
+        return best
+
+    async def lookup(self, track: Dict) -> Optional[Dict]:
+        """只读取已保存的匹配，没有时返回None，不搜索YouTube"""
+        spotify_url = track.get('spotify_url')
+        return await self._load(spotify_url) if spotify_url else None
+
+    def score(self, track: Dict, candidate: Dict) -> float:
+        """
+        计算候选视频的匹配得分
+
+        Args:
+            track: Spotify歌曲信息
+            candidate: YouTube搜索结果
+
+        Returns:
+            得分，越高越匹配
+        """
+        title = normalize_query(track['title'])
+        artists = [normalize_query(name) for name in track['artist'].split(',') if name.strip()]
+        candidate_title = normalize_query(candidate.get('title') or '')
+        uploader = normalize_query(candidate.get('artist') or '')
+
+        # 时长：相差超过30秒不得分
+        duration_score = 0.0
+        expected = track.get('duration') or 0
+        actual = candidate.get('duration') or 0
+        if expected and actual:
+            duration_score = max(0.0, 1 - abs(actual - expected) / 30)
+
+        # 标题相似度：候选标题包含歌名时满分
+        if title and title in candidate_title:
+            title_score = 1.0
+        else:
+            title_score = SequenceMatcher(None, title, candidate_title).ratio()
+
+        # 歌手：出现在标题或上传者名称中
+        artist_score = 0.0
+        if artists:
+            matched = sum(1 for name in artists if name in candidate_title or name in uploader)
+            artist_score = matched / len(artists)
+
+        # 频道特征：YouTube自动生成的"歌手 - Topic"频道和官方频道最可靠
+        channel_score = 0.0
+        if uploader.endswith(' - topic') or 'vevo' in uploader:
+            channel_score = 1.0
+        elif any(keyword in candidate_title for keyword in OFFICIAL_KEYWORDS):
+            channel_score = 0.5
+
+        penalty = sum(
+            0.3 for keyword in PENALTY_KEYWORDS
+            if self._contains_word(candidate_title, keyword) and not self._contains_word(title, keyword)
+        )
+
+        return (
+            0.4 * duration_score
+            + 0.3 * title_score
+            + 0.2 * artist_score
+            + 0.1 * channel_score
+            - penalty
+        )
+
+    @staticmethod
+    def _contains_word(text: str, keyword: str) -> bool:
+        if keyword.isascii():
+            return re.search(rf'\b{re.escape(keyword)}\b', text) is not None
+        return keyword in text
+
+    async def _load(self, spotify_url: str) -> Optional[Dict]:
+        try:
+            with DB_DURATION.time(operation='load_mapping'):
+                async with database.AsyncSessionLocal() as session:
+                    result = await session.execute(
+                        select(SpotifyYouTubeMapping)
+                        .where(SpotifyYouTubeMapping.spotify_url == spotify_url)
+                    )
+                    mapping = result.scalar_one_or_none()
+
+        except Exception as e:
+            logger.error(f"读取Spotify匹配记录失败: {e}")
+            return None
+
+        if not mapping:
+            return None
+
+        if mapping.score is not None and mapping.score < self.min_score:
+            # 调高下限之前保存的匹配，重新匹配
+            return None
+
+        return {
+            'title': mapping.title,
+            'artist': mapping.artist,
+            'url': f"https://www.youtube.com/watch?v={mapping.video_id}",
+            'duration': mapping.duration,
+            'video_id': mapping.video_id,
+            'source': 'youtube'
+        }
+
+    async def _save(self, spotify_url: str, candidate: Dict, score: float):
+        try:
+            with DB_DURATION.time(operation='save_mapping'):
+                async with database.AsyncSessionLocal() as session:
+                    result = await session.execute(
+                        select(SpotifyYouTubeMapping)
+                        .where(SpotifyYouTubeMapping.spotify_url == spotify_url)
+                    )
+                    mapping = result.scalar_one_or_none()
+
+                    if mapping is None:
+                        mapping = SpotifyYouTubeMapping(spotify_url=spotify_url)
+                        session.add(mapping)
+
+                    mapping.video_id = candidate['video_id']
+                    mapping.title = candidate.get('title')
+                    mapping.artist = candidate.get('artist')
+                    mapping.duration = candidate.get('duration')
+                    mapping.score = score
+                    await session.commit()
+
+        except IntegrityError:
+            # 同一首歌的并发匹配请求已经先保存了记录，两次匹配结果相同，保留先保存的
+            logger.debug(f"Spotify匹配记录已由其他请求保存: {spotify_url}")
+        except Exception as e:
+            logger.error(f"保存Spotify匹配记录失败: {e}")
+
+    def stats(self) -> Dict:
+        """获取匹配统计信息"""
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'rejected': self.rejected,
+            'hit_rate': self.hits / total if total else 0.0,
+        }
+
+
+# 全局实例
+track_resolver = TrackResolver(candidates=config.RESOLVER_CANDIDATES, min_score=config.RESOLVER_MIN_SCORE)
@@ -0,0 +1,98 @@
+"""
+Webhook服务器 - 内置异步HTTP服务器接收Telegram推送的更新
+"""
+import hmac
+import json
+from typing import Callable, Optional
+from aiohttp import web
+from loguru import logger
+from telegram import Update
+from telegram.ext import Application
+
+
+class WebhookServer:
+    """Webhook服务器类
+
+    POST {path} 接收Telegram推送的更新（校验 X-Telegram-Bot-Api-Secret-Token），
+    GET {health_path} 返回健康状态，默认以应用是否已启动为准，也可以传入 ready 自行判断。
+    """
+
+    def __init__(
+        self,
+        application: Application,
+        listen: str,
+        port: int,
+        path: str,
+        secret_token: str = None,
+        health_path: str = '/healthz',
+        ready: Optional[Callable[[], bool]] = None
+    ):
+        self.application = application
+        self.listen = listen
+        self.port = port
+        self.path = path
+        self.secret_token = secret_token
+        self.health_path = health_path
+        self.ready = ready or (lambda: application.running)
+        self._runner = None
+
+        # 统计计数
+        self.received = 0
+        self.rejected = 0
+
+    async def start(self):
+        """启动HTTP服务器"""
+        web_app = web.Application()
+        web_app.router.add_post(self.path, self._handle_update)
+        web_app.router.add_get(self.health_path, self._handle_health)
+
+        self._runner = web.AppRunner(web_app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.listen, self.port).start()
+        logger.info(f"Webhook服务器已启动: http://{self.listen}:{self.port}{self.path}")
+
+    async def stop(self):
+        """停止HTTP服务器"""
+        if self._runner:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def _handle_update(self, request: web.Request) -> web.Response:
+        """接收一条更新并放入应用的更新队列"""
+        if self.secret_token:
+            token = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+            if not hmac.compare_digest(token, self.secret_token):
+                self.rejected += 1
+                logger.warning(f"Webhook密钥校验失败: {request.remote}")
+                return web.Response(status=403)
+
+        try:
+            data = await request.json()
+            update = Update.de_json(data, self.application.bot)
+        except (ValueError, TypeError, KeyError) as e:
+            self.rejected += 1
+            logger.warning(f"无法解析Webhook更新: {e}")
+            return web.Response(status=400)
+
+        if update is None:
+            self.rejected += 1
+            return web.Response(status=400)
+
+        self.received += 1
+        await self.application.update_queue.put(update)
+        return web.Response()
+
+    async def _handle_health(self, request: web.Request) -> web.Response:
+        """健康检查"""
+        running = self.ready()
+        body = {
+            'status': 'ok' if running else 'starting',
+            'pending_updates': self.application.update_queue.qsize(),
+            'received': self.received,
+            'rejected': self.rejected,
+        }
+        return web.Response(
+            text=json.dumps(body),
+            content_type='application/json',
+            status=200 if running else 503
+        )
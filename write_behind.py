@@ -0,0 +1,176 @@
+"""
+延迟批量写入 - 合并用户更新和下载历史，定期在一个事务中写入数据库
+"""
+import asyncio
+from datetime import datetime
+from typing import Dict, List
+from sqlalchemy import select
+from loguru import logger
+import config
+import database
+from database import User, DownloadHistory
+from metrics import DB_DURATION
+
+
+class WriteBehindQueue:
+    """延迟批量写入类
+
+    用户信息按 user_id 合并，只保留最新的活跃时间；下载历史累积后批量插入。
+    每隔 flush_interval 秒或积累 max_batch 条记录时在一个事务中写入。
+    """
+
+    def __init__(self, flush_interval: float, max_batch: int):
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+
+        self._users: Dict[int, Dict] = {}  # {user_id: 用户信息}
+        self._history: List[Dict] = []
+        self._writing_history: List[Dict] = []  # 正在写入的下载历史
+        self._wakeup = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._stopping = False
+        self._task = None
+
+        # 统计计数
+        self.flushes = 0
+        self.users_written = 0
+        self.users_coalesced = 0
+        self.history_written = 0
+        self.failures = 0
+
+    def start(self):
+        """启动后台写入任务"""
+        if self._task is None:
+            self._stopping = False
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """停止后台任务并写入所有剩余记录"""
+        if self._task:
+            # 不取消任务：正在进行的写入取消后这批记录会丢失，让它写完最后一次后自行退出
+            self._stopping = True
+            self._wakeup.set()
+            await self._task
+            self._task = None
+
+        await self.flush()
+
+    def save_user(self, user):
+        """
+        记录用户活跃
+
+        Args:
+            user: Telegram用户对象
+        """
+        if user.id in self._users:
+            self.users_coalesced += 1
+
+        self._users[user.id] = {
+            'user_id': user.id,
+            'username': user.username,
+            'first_name': user.first_name,
+            'last_name': user.last_name,
+            'language_code': user.language_code,
+            'last_active': datetime.utcnow(),
+        }
+        self._maybe_wakeup()
+
+    def save_history(self, **fields):
+        """
+        记录一条下载历史
+
+        Args:
+            fields: DownloadHistory的字段
+        """
+        fields.setdefault('downloaded_at', datetime.utcnow())
+        self._history.append(fields)
+        self._maybe_wakeup()
+
+    def has_pending_history(self, user_id: int) -> bool:
+        """用户是否有尚未写入（包括正在写入）的下载历史"""
+        return any(item['user_id'] == user_id for item in self._history + self._writing_history)
+
+    def _maybe_wakeup(self):
+        if len(self._users) + len(self._history) >= self.max_batch:
+            self._wakeup.set()
+
+    async def _run(self):
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    async def flush(self):
+        """把积累的记录在一个事务中写入数据库"""
+        async with self._flush_lock:
+            if not self._users and not self._history:
+                return
+
+            users, self._users = self._users, {}
+            history, self._history = self._history, []
+            self._writing_history = history
+
+            try:
+                with DB_DURATION.time(operation='flush'):
+                    await self._write(users, history)
+
+                self.flushes += 1
+                self.users_written += len(users)
+                self.history_written += len(history)
+
+            except Exception as e:
+                self.failures += 1
+                logger.error(f"批量写入数据库失败: {e}")
+                self._requeue(users, history)
+
+            except BaseException:
+                # 调用方被取消时这批记录没有写入，放回队列由之后的写入完成
+                self._requeue(users, history)
+                raise
+
+            finally:
+                self._writing_history = []
+
+    def _requeue(self, users: Dict[int, Dict], history: List[Dict]):
+        """放回队列等待下次写入，较新的记录优先保留"""
+        for user_id, fields in users.items():
+            self._users.setdefault(user_id, fields)
+        self._history = (history + self._history)[-self.max_batch * 10:]
+
+    async def _write(self, users: Dict[int, Dict], history: List[Dict]):
+        async with database.AsyncSessionLocal() as session:
+            if users:
+                new_users = dict(users)
+                result = await session.execute(
+                    select(User).where(User.user_id.in_(list(users)))
+                )
+                for db_user in result.scalars():
+                    # 已有用户只更新最后活跃时间
+                    db_user.last_active = new_users.pop(db_user.user_id)['last_active']
+
+                session.add_all([User(**fields) for fields in new_users.values()])
+
+            session.add_all([DownloadHistory(**fields) for fields in history])
+            await session.commit()
+
+    def stats(self) -> Dict:
+        """获取写入统计信息"""
+        return {
+            'pending_users': len(self._users),
+            'pending_history': len(self._history) + len(self._writing_history),
+            'flushes': self.flushes,
+            'users_written': self.users_written,
+            'users_coalesced': self.users_coalesced,
+            'history_written': self.history_written,
+            'failures': self.failures,
+        }
+
+
+# 全局实例
+db_writer = WriteBehindQueue(
+    flush_interval=config.DB_FLUSH_INTERVAL_MS / 1000,
+    max_batch=config.DB_FLUSH_MAX_ROWS
+)
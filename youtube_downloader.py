@@ -3,20 +3,168 @@ YouTube音乐下载器 - 使用yt-dlp下载音频
 """
 import os
 import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from pathlib import Path
-from typing import List, Dict, Optional
+from typing import Callable, List, Dict, Optional
 import yt_dlp
 from loguru import logger
 import config
+from circuit_breaker import BackendUnavailable, CircuitBreaker
+from download_store import download_store
+from metrics import DOWNLOADS, DOWNLOAD_BYTES, DOWNLOAD_DURATION, TRANSCODE_DURATION
+from progress import ProgressForwarder
+
+
+# 音质配置，对应 UserPreference.preferred_quality
+# high 为直通模式：优先下载YouTube的M4A(AAC)音频流，不重新编码；
+# 只有拿不到AAC音频时才转为M4A。medium/low 转码为MP3。
+QUALITY_PROFILES = {
+    'high': {
+        'format': 'bestaudio[ext=m4a]/bestaudio/best',
+        'codec': 'm4a',
+        'bitrate': None,
+        'label': '原始音质 (M4A直通)',
+    },
+    'medium': {
+        'format': 'bestaudio/best',
+        'codec': 'mp3',
+        'bitrate': '128',
+        'label': '中等音质 (MP3 128kbps)',
+    },
+    'low': {
+        'format': 'bestaudio/best',
+        'codec': 'mp3',
+        'bitrate': '64',
+        'label': '低音质 (MP3 64kbps)',
+    },
+}
+DEFAULT_QUALITY = 'high'
+
+# yt-dlp错误信息中表示YouTube限流或网络故障的特征；
+# 视频不存在、需要登录、文件过大等错误说明YouTube工作正常，不计入熔断也不重试
+BACKEND_FAILURE_MARKERS = (
+    'http error 429',
+    'too many requests',
+    'http error 403',
+    'http error 5',
+    'timed out',
+    'connection',
+    'temporary failure in name resolution',
+    'unable to download webpage',
+    "sign in to confirm you're not a bot",
+)
+
+
+def classify_youtube_error(error: BaseException):
+    """熔断器的错误分类：(是否为YouTube故障, Retry-After)，yt-dlp不提供响应头"""
+    message = str(error).lower()
+    return any(marker in message for marker in BACKEND_FAILURE_MARKERS), None
+
+
+class YoutubeDLPool:
+    """YoutubeDL实例池
+
+    YoutubeDL不是线程安全的，所以每个线程为每种选项配置各保留一个实例，
+    重复使用以省去提取器初始化和HTTP会话的创建。
+    实例使用 max_uses 次或执行出错后丢弃，下次使用时重新创建。
+    """
+
+    def __init__(self, max_uses: int):
+        self.max_uses = max_uses
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+        # 统计计数
+        self.created = 0
+        self.reused = 0
+        self.recycled = 0
+
+    @contextmanager
+    def get(self, profile: str, ydl_opts: dict):
+        """
+        获取当前线程中指定配置的实例
+
+        Args:
+            profile: 配置名称，相同名称的选项必须相同
+            ydl_opts: 创建新实例时使用的选项
+
+        Yields:
+            YoutubeDL实例
+        """
+        instances = self._instances()
+        entry = instances.get(profile)
+
+        if entry is None:
+            entry = instances[profile] = [yt_dlp.YoutubeDL(ydl_opts), 0]
+            self._count('created')
+        else:
+            self._count('reused')
+
+        entry[1] += 1
+        try:
+            yield entry[0]
+        except Exception:
+            self._discard(instances, profile)
+            raise
+
+        if entry[1] >= self.max_uses:
+            self._discard(instances, profile)
+
+    def _instances(self) -> Dict:
+        if not hasattr(self._local, 'instances'):
+            self._local.instances = {}  # {profile: [ydl, 使用次数]}
+        return self._local.instances
+
+    def _discard(self, instances: Dict, profile: str):
+        entry = instances.pop(profile, None)
+        if entry:
+            self._count('recycled')
+            try:
+                entry[0].close()
+            except Exception as e:
+                logger.warning(f"关闭YoutubeDL实例失败: {e}")
+
+    def _count(self, name: str):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def stats(self) -> Dict:
+        """获取实例池统计信息"""
+        return {
+            'created': self.created,
+            'reused': self.reused,
+            'recycled': self.recycled,
+        }
 
 
 class YouTubeDownloader:
     """YouTube下载器类"""
 
     def __init__(self):
-        self.download_path = config.DOWNLOAD_PATH
+        self.store = download_store
         self.max_duration = config.MAX_SONG_DURATION
         self.max_file_size = config.MAX_FILE_SIZE_MB * 1024 * 1024
+        self.ydl_pool = YoutubeDLPool(max_uses=config.YTDL_INSTANCE_MAX_USES)
+        self._current = threading.local()  # 当前线程中下载任务的转码计时和进度回调
+
+        # 搜索和下载分别熔断：下载被限流时搜索可能仍然正常
+        self.search_breaker = CircuitBreaker('youtube_search', classify_youtube_error, label='YouTube搜索')
+        self.download_breaker = CircuitBreaker(
+            'youtube_download', classify_youtube_error, label='YouTube下载', retries=1
+        )
+
+        # 搜索和下载使用各自的线程池，下载再多也不会占用搜索线程
+        self.search_executor = ThreadPoolExecutor(
+            max_workers=config.SEARCH_WORKERS,
+            thread_name_prefix='yt-search'
+        )
+        self.download_executor = ThreadPoolExecutor(
+            max_workers=config.DOWNLOAD_WORKERS,
+            thread_name_prefix='yt-download'
+        )
 
     async def search(self, query: str, limit: int = 5) -> List[Dict]:
         """
@@ -28,6 +176,10 @@ class YouTubeDownloader:
 
         Returns:
             搜索结果列表
+
+        Raises:
+            BackendUnavailable: YouTube搜索熔断中
+            其他异常: 重试后仍然失败
         """
         logger.info(f"YouTube搜索: {query}")
 
@@ -38,25 +190,21 @@ class YouTubeDownloader:
             'skip_download': True,
         }
 
-        try:
-            # 在线程池中运行同步代码
-            loop = asyncio.get_event_loop()
-            results = await loop.run_in_executor(
-                None,
+        # 在线程池中运行同步代码，出错时抛出，由调用方区分"没有结果"和"搜索失败"
+        loop = asyncio.get_event_loop()
+        return await self.search_breaker.call(
+            lambda: loop.run_in_executor(
+                self.search_executor,
                 self._search_sync,
                 query,
                 limit,
                 ydl_opts
             )
-            return results
-
-        except Exception as e:
-            logger.error(f"YouTube搜索失败: {e}")
-            return []
+        )
 
     def _search_sync(self, query: str, limit: int, ydl_opts: dict) -> List[Dict]:
         """同步搜索方法"""
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        with self.ydl_pool.get('search', ydl_opts) as ydl:
             search_results = ydl.extract_info(f"ytsearch{limit}:{query}", download=False)
 
             if not search_results or 'entries' not in search_results:
@@ -85,68 +233,159 @@ class YouTubeDownloader:
 
             return results
 
-    async def download(self, video_url: str, user_id: int) -> Optional[Path]:
+    async def download(self, video_url: str, user_id: int, quality: str = DEFAULT_QUALITY,
+                       on_progress: Optional[Callable[[str, Dict], None]] = None) -> Optional[Path]:
         """
         下载YouTube视频的音频
 
         Args:
             video_url: 视频URL
             user_id: 用户ID
+            quality: 音质，'high', 'medium' 或 'low'
+            on_progress: 进度回调 (阶段, 数据)，在事件循环中调用，
+                阶段为 'downloading'（percent、speed）或 'converting'
 
         Returns:
-            下载的文件路径，失败返回None
+            任务临时目录中的文件路径（需要交给 download_store.commit），失败返回None
         """
-        logger.info(f"开始下载YouTube音频: {video_url}")
+        logger.info(f"开始下载YouTube音频: {video_url} ({quality})")
 
-        # 生成唯一文件名
-        output_template = str(self.download_path / f"{user_id}_%(title)s.%(ext)s")
+        profile = QUALITY_PROFILES.get(quality, QUALITY_PROFILES[DEFAULT_QUALITY])
+
+        with self.store.job() as job_dir:
+            file_path = await self._download_to(job_dir, video_url, quality, profile, on_progress)
+            if file_path is None:
+                # 失败时连同 .part 等中间文件一起删除
+                self.store.discard(job_dir)
+            return file_path
+
+    async def _download_to(self, job_dir: Path, video_url: str, quality: str, profile: dict,
+                           on_progress=None) -> Optional[Path]:
+        # 每个任务使用独立目录，同名歌曲的并发任务不会互相覆盖
+        output_template = str(job_dir / "%(title)s.%(ext)s")
 
         ydl_opts = {
-            'format': 'bestaudio/best',
+            'format': profile['format'],
             'outtmpl': output_template,
             'postprocessors': [{
+                # 音频已是目标编码时只做封装转换或直接跳过，不重新编码
                 'key': 'FFmpegExtractAudio',
-                'preferredcodec': 'mp3',
-                'preferredquality': '192',
+                'preferredcodec': profile['codec'],
+                'preferredquality': profile['bitrate'],
             }],
+            # 实例池中的实例会被复用，回调固定为本对象的方法，再按线程分发给当前任务
+            'progress_hooks': [self._progress_hook],
+            'postprocessor_hooks': [self._postprocessor_hook],
             'quiet': True,
             'no_warnings': True,
             'max_filesize': self.max_file_size,
         }
+        quality = quality if quality in QUALITY_PROFILES else DEFAULT_QUALITY
 
         try:
             loop = asyncio.get_event_loop()
-            file_path = await loop.run_in_executor(
-                None,
-                self._download_sync,
-                video_url,
-                ydl_opts
-            )
+            forwarder = None
+            if on_progress:
+                forwarder = ProgressForwarder(loop, on_progress, config.PROGRESS_HOOK_INTERVAL)
+            cancel = threading.Event()
+            try:
+                file_path, elapsed, transcode = await self.download_breaker.call(
+                    lambda: loop.run_in_executor(
+                        self.download_executor,
+                        self._timed_download_sync,
+                        video_url,
+                        ydl_opts,
+                        profile['codec'],
+                        f"download_{quality}",
+                        forwarder,
+                        cancel
+                    )
+                )
+            except asyncio.CancelledError:
+                # 线程中的下载无法直接取消，由下一次进度回调中止，释放下载线程
+                cancel.set()
+                raise
+
+            DOWNLOAD_DURATION.observe(elapsed - transcode, quality=quality)
+            TRANSCODE_DURATION.observe(transcode, quality=quality)
 
             if file_path and file_path.exists():
                 logger.info(f"下载成功: {file_path}")
+                DOWNLOADS.inc(quality=quality, outcome='ok')
+                DOWNLOAD_BYTES.inc(file_path.stat().st_size, quality=quality)
                 return file_path
             else:
                 logger.error("下载失败: 文件不存在")
+                DOWNLOADS.inc(quality=quality, outcome='missing')
                 return None
 
+        except BackendUnavailable:
+            # 熔断中不发出请求，交给调用方提示用户稍后再试
+            DOWNLOADS.inc(quality=quality, outcome='rejected')
+            raise
+
         except Exception as e:
             logger.error(f"下载失败: {e}")
+            DOWNLOADS.inc(quality=quality, outcome='error')
             return None
 
-    def _download_sync(self, video_url: str, ydl_opts: dict) -> Optional[Path]:
+    def _timed_download_sync(self, video_url: str, ydl_opts: dict, codec: str, profile: str,
+                             progress=None, cancel: Optional[threading.Event] = None):
+        """执行下载并返回 (文件路径, 总耗时, 转码耗时)"""
+        self._current.transcode = 0.0
+        self._current.progress = progress
+        self._current.cancel = cancel
+        start = time.perf_counter()
+        try:
+            file_path = self._download_sync(video_url, ydl_opts, codec, profile)
+        finally:
+            self._current.progress = None
+            self._current.cancel = None
+        return file_path, time.perf_counter() - start, self._current.transcode
+
+    def _progress_hook(self, status: Dict):
+        """yt-dlp下载进度回调，在下载线程中执行，转发给本线程当前任务的进度回调"""
+        cancel = getattr(self._current, 'cancel', None)
+        if cancel is not None and cancel.is_set():
+            raise yt_dlp.utils.DownloadCancelled('下载已取消')
+
+        progress = getattr(self._current, 'progress', None)
+        if progress is None or status.get('status') != 'downloading':
+            return
+
+        total = status.get('total_bytes') or status.get('total_bytes_estimate')
+        downloaded = status.get('downloaded_bytes') or 0
+        progress('downloading', {
+            'percent': min(downloaded * 100 / total, 100.0) if total else None,
+            'speed': status.get('speed'),
+        })
+
+    def _postprocessor_hook(self, status: Dict):
+        """yt-dlp后处理回调，在下载线程中执行，累计本线程当前任务的转码耗时"""
+        if status.get('status') == 'started':
+            self._current.started = time.perf_counter()
+            progress = getattr(self._current, 'progress', None)
+            if progress and status.get('postprocessor') == 'ExtractAudio':
+                progress('converting')
+        elif status.get('status') == 'finished' and hasattr(self._current, 'started'):
+            self._current.transcode = getattr(self._current, 'transcode', 0.0) + time.perf_counter() - self._current.started
+            del self._current.started
+
+    def _download_sync(self, video_url: str, ydl_opts: dict, codec: str, profile: str) -> Optional[Path]:
         """同步下载方法"""
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        with self.ydl_pool.get(profile, ydl_opts) as ydl:
+            # 复用的实例需要换成本次任务的文件名模板
+            ydl.params['outtmpl']['default'] = ydl_opts['outtmpl']
             info = ydl.extract_info(video_url, download=True)
 
             # 获取下载的文件路径
             if info:
-                # 构建mp3文件路径
+                # 构建目标格式的文件路径
                 base_path = ydl.prepare_filename(info)
-                mp3_path = Path(base_path).with_suffix('.mp3')
+                target_path = Path(base_path).with_suffix(f'.{codec}')
 
-                if mp3_path.exists():
-                    return mp3_path
+                if target_path.exists():
+                    return target_path
 
                 # 尝试其他可能的路径
                 for ext in ['.mp3', '.m4a', '.opus']:
@@ -175,7 +414,7 @@ class YouTubeDownloader:
         try:
             loop = asyncio.get_event_loop()
             info = await loop.run_in_executor(
-                None,
+                self.search_executor,
                 self._get_info_sync,
                 video_url,
                 ydl_opts
@@ -188,7 +427,7 @@ class YouTubeDownloader:
 
     def _get_info_sync(self, video_url: str, ydl_opts: dict) -> Optional[Dict]:
         """同步获取信息方法"""
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        with self.ydl_pool.get('info', ydl_opts) as ydl:
             info = ydl.extract_info(video_url, download=False)
 
             if info:
@@ -201,6 +440,11 @@ class YouTubeDownloader:
                 }
             return None
 
+    def close(self):
+        """关闭线程池"""
+        self.search_executor.shutdown(wait=False, cancel_futures=True)
+        self.download_executor.shutdown(wait=False, cancel_futures=True)
+
 
 # 全局实例
 youtube_downloader = YouTubeDownloader()